@@ -1,24 +1,55 @@
 # app.py - Updated with student groups
-from flask import Flask, render_template, request, jsonify, session, redirect, Response
+from flask import Flask, render_template, request, jsonify, session, redirect, Response, stream_with_context, url_for, send_from_directory, g, has_request_context
+from flask.sessions import SecureCookieSessionInterface
+from werkzeug.middleware.proxy_fix import ProxyFix
+from markupsafe import Markup, escape
 import json
 import os
+import sys
 import datetime
 import uuid
-from openai import OpenAI
+import openai
+from openai import AsyncOpenAI, DefaultAsyncHttpxClient
+import httpx
+import asyncio
+import queue
 import requests
 from flask_cors import CORS
 import csv
+import threading
+import time
+import random
+import atexit
+import sqlite3
+import re
+import hashlib
+import math
+import mimetypes
+import base64
+import bisect
+import contextlib
+import gzip
+from collections import deque, OrderedDict
+import concurrent.futures
+from concurrent.futures import ThreadPoolExecutor
 from io import StringIO
+from urllib.parse import urlencode
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
 
 app = Flask(__name__)
 app.secret_key = os.environ.get("SECRET_KEY", "your-secret-key-here")
+# 部署在 Render 的反向代理之后：只信任代理追加的那一跳 X-Forwarded-For，客户端自己填的前几项不算数
+TRUSTED_PROXY_HOPS = int(os.environ.get("TRUSTED_PROXY_HOPS", "1"))
+if TRUSTED_PROXY_HOPS:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=TRUSTED_PROXY_HOPS)
 
 # 启用CORS支持
 CORS(app)
 
-# 初始化OpenAI客户端
-client = OpenAI(api_key=os.environ.get("OPENAI_API_KEY"))
-
 # 添加调试信息
 print(f"OpenAI API Key configured: {'Yes' if os.environ.get('OPENAI_API_KEY') else 'No'}")
 print(f"Secret Key configured: {'Yes' if os.environ.get('SECRET_KEY') else 'No'}")
@@ -193,17 +224,1086 @@ scene_options = [
     "Custom scenario"
 ]
 
+# ================================
+# 运行指标 - Prometheus 文本格式
+# ================================
+
+class Metric:
+    def __init__(self, name, help_text, kind, labelnames=()):
+        self.name = name
+        self.help_text = help_text
+        self.kind = kind
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def key(self, labels):
+        return tuple(str(labels.get(name, '')) for name in self.labelnames)
+
+    def format_labels(self, key, extra=()):
+        pairs = list(zip(self.labelnames, key)) + list(extra)
+        if not pairs:
+            return ''
+        escaped = (value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in pairs)
+        return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+
+    def header(self):
+        return [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(Metric):
+    def __init__(self, name, help_text, labelnames=()):
+        super().__init__(name, help_text, 'counter', labelnames)
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def render(self):
+        with self.lock:
+            items = sorted(self.values.items())
+        return self.header() + [f"{self.name}{self.format_labels(key)} {value}" for key, value in items]
+
+
+class Gauge(Metric):
+    """A value read from a callback at scrape time (kind='counter' for running totals)."""
+
+    def __init__(self, name, help_text, callback, kind='gauge'):
+        super().__init__(name, help_text, kind)
+        self.callback = callback
+
+    def render(self):
+        return self.header() + [f"{self.name} {self.callback()}"]
+
+
+class Histogram(Metric):
+    def __init__(self, name, help_text, labelnames=(), buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)):
+        super().__init__(name, help_text, 'histogram', labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            entry = self.values.get(key)
+            if entry is None:
+                entry = self.values[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry[0][i] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def render(self):
+        with self.lock:
+            items = sorted((key, ([*entry[0]], entry[1], entry[2])) for key, entry in self.values.items())
+        lines = self.header()
+        for key, (counts, total, count) in items:
+            for bound, bucket_count in zip(self.buckets, counts):
+                lines.append(f"{self.name}_bucket{self.format_labels(key, [('le', repr(float(bound)))])} {bucket_count}")
+            lines.append(f"{self.name}_bucket{self.format_labels(key, [('le', '+Inf')])} {count}")
+            lines.append(f"{self.name}_sum{self.format_labels(key)} {total}")
+            lines.append(f"{self.name}_count{self.format_labels(key)} {count}")
+        return lines
+
+
+class MetricsRegistry:
+    """Per-process metrics; with several gunicorn workers each scrape sees one worker."""
+
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, help_text, labelnames=()):
+        return self.register(Counter(name, help_text, labelnames))
+
+    def gauge(self, name, help_text, callback, kind='gauge'):
+        return self.register(Gauge(name, help_text, callback, kind))
+
+    def histogram(self, name, help_text, labelnames=(), buckets=None):
+        if buckets is None:
+            return self.register(Histogram(name, help_text, labelnames))
+        return self.register(Histogram(name, help_text, labelnames, buckets))
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+LLM_BUCKETS = (0.1, 0.25, 0.5, 1, 2, 4, 8, 15, 30, 60)
+
+metrics = MetricsRegistry()
+http_request_seconds = metrics.histogram(
+    'chat_http_request_seconds', 'Request duration including streamed bodies', ['endpoint', 'status'], LLM_BUCKETS)
+openai_request_seconds = metrics.histogram(
+    'chat_openai_request_seconds', 'OpenAI completion duration including retries', ['model', 'mode', 'outcome'], LLM_BUCKETS)
+openai_first_token_seconds = metrics.histogram(
+    'chat_openai_first_token_seconds', 'Time to first streamed token', ['model'], LLM_BUCKETS)
+llm_queue_wait_seconds = metrics.histogram(
+    'chat_llm_queue_wait_seconds', 'Time spent waiting for an LLM concurrency slot')
+prompt_tokens_total = metrics.counter('chat_prompt_tokens_total', 'Prompt tokens sent', ['student_id'])
+completion_tokens_total = metrics.counter('chat_completion_tokens_total', 'Completion tokens received', ['student_id'])
+cached_tokens_total = metrics.counter('chat_cached_tokens_total', 'Prompt tokens served from the provider cache', ['student_id'])
+storage_write_seconds = metrics.histogram(
+    'chat_storage_write_seconds', 'save_data_to_file duration', ['backend'])
+github_sync_seconds = metrics.histogram(
+    'chat_github_sync_seconds', 'Duration of one GitHub segment upload', ['outcome'], LLM_BUCKETS)
+github_sync_failures_total = metrics.counter('chat_github_sync_failures_total', 'Failed GitHub segment uploads')
+rejections_total = metrics.counter('chat_rejections_total', 'Chat requests answered with 429', ['reason'])
+llm_attempts_total = metrics.counter(
+    'chat_llm_attempts_total', 'Completion attempts made by the dispatcher', ['route', 'hedge', 'outcome'])
+chats_in_progress = {'count': 0, 'lock': threading.Lock()}
+metrics.gauge('chat_requests_in_progress', 'send_message requests currently being served',
+              lambda: chats_in_progress['count'])
+
+# ================================
+# 对话存储后端
+# ================================
+
+def conversation_key(conv):
+    # 所有存储和索引共用的排序键：时间戳相同时按 id 区分
+    return (conv.get('timestamp', ''), conv.get('id') or 0)
+
+
+def next_month(month):
+    year, number = int(month[:4]), int(month[5:7])
+    return f"{year + number // 12:04d}-{number % 12 + 1:02d}"
+
+
+def connect_sqlite(path):
+    conn = sqlite3.connect(path, timeout=30)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    return conn
+
+
+class JsonConversationStore:
+    """Legacy storage: the whole history lives in one JSON file that is rewritten on every save."""
+
+    shared = False
+
+    def __init__(self, data_file='conversation_data.json'):
+        self.data_file = data_file
+
+    def load(self):
+        if not os.path.exists(self.data_file):
+            return None
+        try:
+            with open(self.data_file, 'r', encoding='utf-8') as f:
+                return json.load(f).get('conversations', [])
+        except Exception as e:
+            print(f"Error loading data: {e}")
+            return None
+
+    def append(self, conversation, data):
+        self.save(data)
+        return self.data_file
+
+    def save(self, data):
+        if 'students_chatted' in data and isinstance(data['students_chatted'], set):
+            data['students_chatted'] = list(data['students_chatted'])
+
+        data['last_updated'] = datetime.datetime.now().isoformat()
+        try:
+            with open(self.data_file, 'w', encoding='utf-8') as f:
+                json.dump(data, f, indent=2, ensure_ascii=False, default=str)
+            print(f"Data saved: {len(data.get('conversations', []))} conversations")
+            return True
+        except Exception as e:
+            print(f"Error saving data: {e}")
+            return False
+
+    def files(self):
+        return [self.data_file] if os.path.exists(self.data_file) else []
+
+    def read_segment(self, path):
+        with open(path, 'r', encoding='utf-8') as f:
+            return f.read()
+
+
+class JsonlConversationStore:
+    """Append-only storage: one JSON line per conversation, sharded into daily segment files.
+
+    Daily segments older than a cutoff are rolled into gzip-compressed monthly archives, which
+    are read back only when a query or export reaches their time range.
+    """
+
+    shared = False
+
+    def __init__(self, log_dir='conversation_log', legacy_file='conversation_data.json',
+                 archive_dir='conversation_archive', cache_records=20000):
+        self.log_dir = log_dir
+        self.legacy_file = legacy_file
+        self.archive_dir = archive_dir
+        self.cache_records = cache_records
+        self.cached_records = 0
+        self.segment_cache = OrderedDict()
+        self.cache_lock = threading.Lock()
+        self.archive_lock = threading.Lock()
+
+    def segment_path(self, timestamp):
+        return os.path.join(self.log_dir, f"{timestamp[:10]}.jsonl")
+
+    def archive_path(self, month):
+        return os.path.join(self.archive_dir, f"{month}.jsonl.gz")
+
+    def manifest_path(self):
+        return os.path.join(self.archive_dir, 'manifest.json')
+
+    def files(self):
+        if not os.path.isdir(self.log_dir):
+            return []
+        return sorted(
+            os.path.join(self.log_dir, name)
+            for name in os.listdir(self.log_dir)
+            if name.endswith('.jsonl')
+        )
+
+    def read_segment(self, path):
+        with open(path, 'r', encoding='utf-8') as f:
+            return f.read()
+
+    def read_records(self, path):
+        conversations = []
+        opener = gzip.open if path.endswith('.gz') else open
+        with opener(path, 'rt', encoding='utf-8') as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    conversations.append(json.loads(line))
+                except ValueError:
+                    # 进程中途退出可能留下半行，跳过即可
+                    print(f"Skipping corrupt line in {path}")
+        return conversations
+
+    def read_month(self, month, paths):
+        # 一个月的归档加上尚未归档的日分段，合并排序后缓存；任一文件改动（mtime 变化）就重新读取。
+        # 按记录条数限制缓存（cache_records），超出时淘汰最久没用的月份；单月就超限的不缓存，
+        # 这样整库导出时内存里最多只有缓存上限加上正在读的那一个月
+        key = (month,) + tuple((path, os.path.getmtime(path)) for path in paths if os.path.exists(path))
+        with self.cache_lock:
+            if key in self.segment_cache:
+                self.segment_cache.move_to_end(key)
+                return self.segment_cache[key]
+        conversations = []
+        for path, _ in key[1:]:
+            conversations.extend(self.read_records(path))
+        conversations.sort(key=conversation_key)
+        entry = ([conversation_key(conv) for conv in conversations], conversations)
+        if len(conversations) > self.cache_records:
+            return entry
+        with self.cache_lock:
+            if key not in self.segment_cache:
+                self.segment_cache[key] = entry
+                self.cached_records += len(conversations)
+            while self.cached_records > self.cache_records:
+                _, (_, evicted) = self.segment_cache.popitem(last=False)
+                self.cached_records -= len(evicted)
+        return entry
+
+    def load(self):
+        self.migrate_legacy_file()
+        return list(self.iter_range())
+
+    def load_recent(self, limit):
+        """Return (newest `limit` conversations in key order, whether older ones exist on disk)."""
+        self.migrate_legacy_file()
+        files = self.files()
+        months = self.archived_months()
+        conversations = []
+        remaining = len(files)
+        # 从最新的一天往前读，够数就停，更早的分段不碰；日分段不够时接着读最新的月归档，
+        # 否则归档之后重启，热数据会是空的，所有查询都落到 gzip 上
+        while (remaining or months) and len(conversations) <= limit:
+            if remaining:
+                remaining -= 1
+                conversations.extend(self.read_records(files[remaining]))
+            else:
+                conversations.extend(self.read_records(self.archive_path(months.pop())))
+        conversations.sort(key=conversation_key)
+        has_older = len(conversations) > limit or remaining > 0 or bool(months)
+        return conversations[-limit:] if limit else [], has_older
+
+    def archived_months(self):
+        if not os.path.isdir(self.archive_dir):
+            return []
+        return sorted(name[:7] for name in os.listdir(self.archive_dir) if name.endswith('.jsonl.gz'))
+
+    def archived_days(self):
+        try:
+            with open(self.manifest_path(), 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def has_segment(self, path):
+        day = os.path.basename(path)[:10]
+        return os.path.exists(path) or day in self.archived_days().get(day[:7], [])
+
+    def iter_range(self, lower=None, upper=None, reverse=False):
+        """Yield conversations with lower <= (timestamp, id) < upper in key order, one month at a time.
+
+        Only the archive segments and daily files of months overlapping the range are read.
+        """
+        if lower and upper and lower >= upper:
+            return
+        daily = {}
+        for path in self.files():
+            daily.setdefault(os.path.basename(path)[:7], []).append(path)
+        months = sorted(set(self.archived_months()) | set(daily), reverse=reverse)
+        for month in months:
+            if upper and month > upper[0]:
+                continue
+            if lower and next_month(month) <= lower[0]:
+                continue
+            keys, conversations = self.read_month(month, [self.archive_path(month)] + daily.get(month, []))
+            lo = bisect.bisect_left(keys, lower) if lower else 0
+            hi = bisect.bisect_left(keys, upper) if upper else len(keys)
+            for i in (range(hi - 1, lo - 1, -1) if reverse else range(lo, hi)):
+                yield conversations[i]
+
+    def roll_archive(self, before_day, skip=()):
+        """Merge daily segments older than before_day into gzip monthly archives; returns days archived."""
+        with self.archive_lock:
+            by_month = {}
+            for path in self.files():
+                day = os.path.basename(path)[:10]
+                if day < before_day and path not in skip:
+                    by_month.setdefault(day[:7], []).append(path)
+            if not by_month:
+                return 0
+
+            os.makedirs(self.archive_dir, exist_ok=True)
+            manifest = self.archived_days()
+            for month, paths in sorted(by_month.items()):
+                archive = self.archive_path(month)
+                conversations = self.read_records(archive) if os.path.exists(archive) else []
+                seen = {conv.get('id') for conv in conversations}
+                for path in paths:
+                    for conv in self.read_records(path):
+                        if conv.get('id') is None or conv['id'] not in seen:
+                            seen.add(conv.get('id'))
+                            conversations.append(conv)
+                conversations.sort(key=conversation_key)
+
+                # 先写临时文件再替换，中途退出时旧归档和日分段都还在
+                with gzip.open(archive + '.tmp', 'wt', encoding='utf-8', compresslevel=6) as f:
+                    for conv in conversations:
+                        f.write(json.dumps(conv, ensure_ascii=False, default=str) + "\n")
+                os.replace(archive + '.tmp', archive)
+                days = set(manifest.get(month, []))
+                days.update(os.path.basename(path)[:10] for path in paths)
+                manifest[month] = sorted(days)
+                with open(self.manifest_path() + '.tmp', 'w', encoding='utf-8') as f:
+                    json.dump(manifest, f, indent=1)
+                os.replace(self.manifest_path() + '.tmp', self.manifest_path())
+                for path in paths:
+                    os.remove(path)
+
+            archived = sum(len(paths) for paths in by_month.values())
+            print(f"Archived {archived} daily segments into {self.archive_dir}/")
+            return archived
+
+    def append(self, conversation, data=None):
+        os.makedirs(self.log_dir, exist_ok=True)
+        path = self.segment_path(conversation['timestamp'])
+        line = json.dumps(conversation, ensure_ascii=False, default=str) + "\n"
+        with open(path, 'a', encoding='utf-8') as f:
+            f.write(line)
+        return path
+
+    def migrate_legacy_file(self):
+        # 把旧的 conversation_data.json 拆分成按日期的分段文件。旧文件改名为 .migrated 才算迁移完成，
+        # 中途退出的话下次启动会重跑：分段里已有的记录逐行去重，只补写缺的
+        if not os.path.exists(self.legacy_file):
+            return False
+        try:
+            with open(self.legacy_file, 'r', encoding='utf-8') as f:
+                legacy = json.load(f)
+        except Exception as e:
+            print(f"Error reading legacy data for migration: {e}")
+            return False
+
+        os.makedirs(self.log_dir, exist_ok=True)
+        segments = {}
+        for conv in legacy.get('conversations', []):
+            path = self.segment_path(conv.get('timestamp', datetime.datetime.now().isoformat()))
+            segments.setdefault(path, []).append(json.dumps(conv, ensure_ascii=False, default=str))
+        written = 0
+        for path, lines in segments.items():
+            existing = self.read_segment(path) if os.path.exists(path) else ''
+            present = set(existing.splitlines())
+            missing = [line for line in lines if line not in present]
+            if not missing:
+                continue
+            # 上次中断可能留下半行，先换行再追加，半行由 read_records 跳过
+            prefix = "\n" if existing and not existing.endswith("\n") else ""
+            with open(path, 'a', encoding='utf-8') as f:
+                f.write(prefix + "\n".join(missing) + "\n")
+            written += len(missing)
+
+        os.replace(self.legacy_file, self.legacy_file + '.migrated')
+        print(f"Migrated {written} of {len(legacy.get('conversations', []))} conversations into {self.log_dir}/")
+        return True
+
+
+class SqliteConversationStore:
+    """Conversations in a WAL-mode SQLite database that every gunicorn worker appends to.
+
+    The autoincrement id gives a single global order; each worker catches up on rows written
+    by other workers with load_since(). Daily JSONL shards for GitHub sync are rendered from
+    the database on demand.
+    """
+
+    shared = True
+
+    def __init__(self, path='conversations.db', log_dir='conversation_log', legacy_file='conversation_data.json'):
+        self.path = path
+        self.log_dir = log_dir
+        self.legacy_file = legacy_file
+        self.local = threading.local()
+        with self.connection() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS conversations ("
+                "id INTEGER PRIMARY KEY AUTOINCREMENT, timestamp TEXT NOT NULL, student_id TEXT, "
+                "session_id TEXT, scene_context TEXT, record TEXT NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS conversations_timestamp ON conversations (timestamp)")
+            conn.execute("CREATE INDEX IF NOT EXISTS conversations_student ON conversations (student_id, id)")
+
+    def connection(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = self.local.conn = connect_sqlite(self.path)
+        return conn
+
+    def segment_path(self, timestamp):
+        return os.path.join(self.log_dir, f"{timestamp[:10]}.jsonl")
+
+    def files(self):
+        rows = self.connection().execute("SELECT DISTINCT substr(timestamp, 1, 10) FROM conversations").fetchall()
+        return sorted(self.segment_path(row[0]) for row in rows)
+
+    def insert(self, conn, conversation):
+        cursor = conn.execute(
+            "INSERT INTO conversations (timestamp, student_id, session_id, scene_context, record) "
+            "VALUES (?, ?, ?, ?, ?)",
+            (conversation['timestamp'], conversation.get('student_id'), conversation.get('session_id'),
+             conversation.get('scene_context'), json.dumps(conversation, ensure_ascii=False, default=str))
+        )
+        return cursor.lastrowid
+
+    def append(self, conversation, data=None):
+        with self.connection() as conn:
+            conversation['id'] = self.insert(conn, conversation)
+        return self.segment_path(conversation['timestamp'])
+
+    def row_to_conversation(self, row):
+        conversation = json.loads(row[1])
+        conversation['id'] = row[0]
+        return conversation
+
+    def load_since(self, last_id):
+        rows = self.connection().execute(
+            "SELECT id, record FROM conversations WHERE id > ? ORDER BY id", (last_id,)
+        ).fetchall()
+        return [self.row_to_conversation(row) for row in rows]
+
+    def load(self):
+        self.import_existing()
+        return self.load_since(0)
+
+    def load_recent(self, limit):
+        self.import_existing()
+        rows = self.connection().execute(
+            "SELECT id, record FROM conversations ORDER BY id DESC LIMIT ?", (limit + 1,)
+        ).fetchall()
+        conversations = [self.row_to_conversation(row) for row in rows[:limit]]
+        conversations.sort(key=conversation_key)
+        return conversations, len(rows) > limit
+
+    def iter_range(self, lower=None, upper=None, reverse=False, chunk_size=1000):
+        """Yield conversations with lower <= (timestamp, id) < upper in key order, chunk by chunk."""
+        order = "DESC" if reverse else "ASC"
+        while True:
+            where, params = [], []
+            if lower:
+                where.append("(timestamp, id) >= (?, ?)")
+                params.extend(lower)
+            if upper:
+                where.append("(timestamp, id) < (?, ?)")
+                params.extend(upper)
+            sql = "SELECT id, record, timestamp FROM conversations"
+            if where:
+                sql += " WHERE " + " AND ".join(where)
+            rows = self.connection().execute(
+                f"{sql} ORDER BY timestamp {order}, id {order} LIMIT ?", params + [chunk_size]
+            ).fetchall()
+            for row in rows:
+                yield self.row_to_conversation(row)
+            if len(rows) < chunk_size:
+                return
+            # 键集分页：下一块从这一块的最后一条之后开始
+            if reverse:
+                upper = (rows[-1][2], rows[-1][0])
+            else:
+                lower = (rows[-1][2], rows[-1][0] + 1)
+
+    def import_existing(self):
+        # 数据库为空时导入已有的 JSONL 分段或旧 JSON 文件；多个 worker 同时启动时只有一个会导入
+        conn = self.connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            if conn.execute("SELECT 1 FROM conversations LIMIT 1").fetchone():
+                conn.rollback()
+                return 0
+            conversations = JsonlConversationStore(self.log_dir, self.legacy_file).load()
+            for conv in conversations:
+                self.insert(conn, conv)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        if conversations:
+            print(f"Imported {len(conversations)} conversations into {self.path}")
+        return len(conversations)
+
+    def read_segment(self, path):
+        day = os.path.basename(path)[:10]
+        next_day = (datetime.date.fromisoformat(day) + datetime.timedelta(days=1)).isoformat()
+        rows = self.connection().execute(
+            "SELECT id, record FROM conversations WHERE timestamp >= ? AND timestamp < ? ORDER BY id",
+            (day, next_day)
+        ).fetchall()
+        return ''.join(
+            json.dumps(self.row_to_conversation(row), ensure_ascii=False, default=str) + "\n" for row in rows
+        )
+
+
+def create_conversation_store():
+    backend = os.environ.get("CONVERSATION_STORAGE", "jsonl")
+    if backend == "json":
+        return JsonConversationStore()
+    if backend == "sqlite":
+        return SqliteConversationStore(os.environ.get("CONVERSATION_DB", "conversations.db"))
+    return JsonlConversationStore(cache_records=int(os.environ.get("ARCHIVE_CACHE_RECORDS", "20000")))
+
+# ================================
+# GitHub 后台同步
+# ================================
+
+class GitHubSyncWorker:
+    """Uploads dirty segment files from a background thread.
+
+    Writes only mark a file dirty. The worker waits until the oldest pending change is
+    `interval` seconds old or `batch_size` changes have piled up, then uploads each dirty
+    file once, retrying failures with exponential backoff. Pending changes are flushed
+    at interpreter exit.
+    """
+
+    def __init__(self, upload, interval=30, batch_size=50, max_retries=5, backoff_base=2.0, backoff_max=60.0):
+        self.upload = upload
+        self.interval = interval
+        self.batch_size = batch_size
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.pending = {}
+        self.pending_changes = 0
+        self.first_dirty_at = None
+        self.condition = threading.Condition()
+        self.thread = None
+        self.stopping = False
+        atexit.register(self.stop)
+
+    def mark_dirty(self, path):
+        with self.condition:
+            self.pending[path] = self.pending.get(path, 0) + 1
+            self.pending_changes += 1
+            if self.first_dirty_at is None:
+                self.first_dirty_at = time.monotonic()
+            self.ensure_started()
+            self.condition.notify()
+
+    def request_flush(self):
+        with self.condition:
+            self.first_dirty_at = time.monotonic() - self.interval
+            self.ensure_started()
+            self.condition.notify()
+
+    def ensure_started(self):
+        # 懒启动，避免 gunicorn fork 之前创建线程
+        if self.thread is None or not self.thread.is_alive():
+            self.thread = threading.Thread(target=self.run, name="github-sync", daemon=True)
+            self.thread.start()
+
+    def take_batch(self):
+        with self.condition:
+            while not self.stopping:
+                if self.pending:
+                    age = time.monotonic() - self.first_dirty_at
+                    if age >= self.interval or self.pending_changes >= self.batch_size:
+                        break
+                    self.condition.wait(self.interval - age)
+                else:
+                    self.condition.wait()
+            batch = self.pending
+            self.pending = {}
+            self.pending_changes = 0
+            self.first_dirty_at = None
+            return batch
+
+    def run(self):
+        while True:
+            batch = self.take_batch()
+            if batch:
+                self.upload_batch(batch)
+            if self.stopping:
+                return
+
+    def upload_batch(self, batch):
+        for path, changes in batch.items():
+            if not self.upload_with_retry(path):
+                # 放弃本轮，留待下次合并上传
+                with self.condition:
+                    self.pending[path] = self.pending.get(path, 0) + changes
+                    self.pending_changes += changes
+                    if self.first_dirty_at is None:
+                        self.first_dirty_at = time.monotonic()
+
+    def upload_with_retry(self, path):
+        attempts = 0
+        for attempt in range(self.max_retries):
+            attempts += 1
+            if self.upload(path):
+                return True
+            if self.stopping and attempt >= 1:
+                break
+            # 最后一次失败后不用再等；退出时立即重试，不拖慢 atexit 刷盘
+            if attempt == self.max_retries - 1 or self.stopping:
+                continue
+            delay = min(self.backoff_max, self.backoff_base * (2 ** attempt))
+            time.sleep(delay * random.uniform(0.5, 1.0))
+        print(f"GitHub sync failed for {path} after {attempts} attempts")
+        return False
+
+    def stop(self, timeout=30):
+        with self.condition:
+            if self.stopping:
+                return
+            self.stopping = True
+            self.condition.notify()
+        if self.thread is not None and self.thread.is_alive():
+            self.thread.join(timeout)
+        elif self.pending:
+            self.upload_batch(self.take_batch())
+
+# ================================
+# 增量统计
+# ================================
+
+class ConversationAnalytics:
+    """Running aggregates for the admin dashboard, updated on every logged conversation."""
+
+    recent_window = datetime.timedelta(days=1)
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.student_stats = {}
+        self.hourly_distribution = {}
+        self.student_ids = set()
+        self.total_conversations = 0
+        self.prompt_tokens = 0
+        self.cached_tokens = 0
+        self.recent_timestamps = deque()
+
+    def rebuild(self, conversations):
+        with self.lock:
+            self.reset()
+            for conv in conversations:
+                self._add(conv)
+            # 迁移或合并的历史不一定按时间排序，加载时排一次即可
+            self.recent_timestamps = deque(sorted(self.recent_timestamps))
+
+    def add(self, conv):
+        with self.lock:
+            self._add(conv)
+
+    def _add(self, conv):
+        student = conv['student_name']
+        stats = self.student_stats.get(student)
+        if stats is None:
+            stats = self.student_stats[student] = {
+                'total_conversations': 0,
+                'avg_response_time': 0,
+                'total_response_time': 0
+            }
+        stats['total_conversations'] += 1
+        stats['total_response_time'] += conv.get('response_time_ms', 0)
+        stats['avg_response_time'] = stats['total_response_time'] / stats['total_conversations']
+
+        hour = conv.get('hour', 0)
+        self.hourly_distribution[hour] = self.hourly_distribution.get(hour, 0) + 1
+        self.student_ids.add(conv['student_id'])
+        self.total_conversations += 1
+        self.prompt_tokens += conv.get('prompt_tokens', 0)
+        self.cached_tokens += conv.get('cached_tokens', 0)
+
+        timestamp = datetime.datetime.fromisoformat(conv['timestamp'])
+        if datetime.datetime.now() - timestamp < self.recent_window:
+            self.recent_timestamps.append(timestamp)
+
+    def snapshot(self):
+        with self.lock:
+            cutoff = datetime.datetime.now() - self.recent_window
+            while self.recent_timestamps and self.recent_timestamps[0] <= cutoff:
+                self.recent_timestamps.popleft()
+
+            student_stats = {student: dict(stats) for student, stats in self.student_stats.items()}
+            return {
+                'student_stats': student_stats,
+                'hourly_distribution': dict(self.hourly_distribution),
+                'total_conversations': self.total_conversations,
+                'unique_students': len(self.student_ids),
+                'recent_conversations': len(self.recent_timestamps),
+                'prompt_tokens': self.prompt_tokens,
+                'cached_tokens': self.cached_tokens,
+                'cache_hit_rate': self.cached_tokens / self.prompt_tokens if self.prompt_tokens else 0,
+                'most_active_student': max(student_stats.items(), key=lambda x: x[1]['total_conversations'])[0] if student_stats else 'None'
+            }
+
+# ================================
+# 对话索引 - 按学生/会话/场景和时间排序
+# ================================
+
+class InvalidCursor(ValueError):
+    pass
+
+def encode_cursor(key):
+    return base64.urlsafe_b64encode(json.dumps(key).encode()).decode().rstrip('=')
+
+def decode_cursor(cursor):
+    try:
+        timestamp, conv_id = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+        return str(timestamp), int(conv_id)
+    except (ValueError, TypeError):
+        raise InvalidCursor('Invalid cursor')
+
+class ConversationIndex:
+    """Sorted (timestamp, id, position) lists over the in-memory conversation list.
+
+    One list covers everything, plus one per student_id, session_id and scene_context.
+    A query scans the most selective list between bisected time bounds, so a page costs
+    O(log n + page) rather than a walk over the whole history.
+    """
+
+    fields = ('student_id', 'session_id', 'scene_context')
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.all = []
+        self.by_field = {field: {} for field in self.fields}
+
+    def rebuild(self, conversations):
+        with self.lock:
+            self.reset()
+            for position, conv in enumerate(conversations):
+                self._add(conv, position)
+
+    def add(self, conv, position):
+        with self.lock:
+            self._add(conv, position)
+
+    def _add(self, conv, position):
+        entry = (conv.get('timestamp', ''), conv.get('id') or 0, position)
+        # 新记录几乎总是最新的，直接追加；乱序的历史数据才需要插入
+        for entries in [self.all] + [self.by_field[field].setdefault(conv.get(field) or '', []) for field in self.fields]:
+            if not entries or entries[-1] <= entry:
+                entries.append(entry)
+            else:
+                bisect.insort(entries, entry)
+
+    def query(self, conversations, limit, cursor=None, order='desc', start=None, end=None, **filters):
+        """Return (page, next_cursor) for conversations matching every given filter."""
+        filters = {field: value for field, value in filters.items() if value}
+        with self.lock:
+            entries = self.all
+            for field in self.fields:
+                if field in filters:
+                    candidate = self.by_field[field].get(filters[field], [])
+                    if len(candidate) < len(entries) or entries is self.all:
+                        entries = candidate
+
+            lo = bisect.bisect_left(entries, (start,)) if start else 0
+            hi = bisect.bisect_left(entries, (end,)) if end else len(entries)
+            if cursor:
+                key = decode_cursor(cursor)
+                if order == 'desc':
+                    hi = min(hi, bisect.bisect_left(entries, key))
+                else:
+                    lo = max(lo, bisect.bisect_right(entries, key + (float('inf'),)))
+            positions = range(hi - 1, lo - 1, -1) if order == 'desc' else range(lo, hi)
+
+            page = []
+            last = None
+            for i in positions:
+                conv = conversations[entries[i][2]]
+                if any(conv.get(field) != value for field, value in filters.items()):
+                    continue
+                if len(page) == limit:
+                    return page, encode_cursor(list(last[:2]))
+                page.append(conv)
+                last = entries[i]
+            return page, None
+
+# ================================
+# 全文检索 - SQLite FTS5 旁路索引
+# ================================
+
+SEARCH_FIELDS = ('user_message', 'ai_response')
+SNIPPET_OPEN, SNIPPET_CLOSE = '\ue000', '\ue001'
+
+def build_fts_query(text, field=None):
+    """Turn a search box string into an FTS5 MATCH expression.
+
+    Double-quoted text is a phrase, a trailing * is a prefix match, OR joins alternatives and
+    everything else must all appear. Other punctuation is never interpreted as FTS syntax.
+    """
+    terms = []
+    for phrase, word in re.findall(r'"([^"]*)"|(\S+)', text):
+        if word == 'OR':
+            if terms and terms[-1] != 'OR':
+                terms.append('OR')
+            continue
+        value = (phrase or word).replace('"', '')
+        prefix = word.endswith('*') and len(word) > 1
+        value = value.rstrip('*') if prefix else value
+        if value.strip():
+            terms.append('"' + value + '"' + ('*' if prefix else ''))
+    while terms and terms[-1] == 'OR':
+        terms.pop()
+    if terms and terms[0] == 'OR':
+        terms.pop(0)
+    if not terms:
+        return None
+    expression = ' '.join(terms)
+    if field in SEARCH_FIELDS:
+        expression = '{' + field + '} : (' + expression + ')'
+    return expression
+
+def render_snippet(snippet):
+    return Markup(str(escape(snippet)).replace(SNIPPET_OPEN, '<mark>').replace(SNIPPET_CLOSE, '</mark>'))
+
+class ConversationSearchIndex:
+    """Full-text index over user_message and ai_response in a sidecar SQLite FTS5 table.
+
+    Filter columns live in an ordinary indexed table joined on the conversation id, so student
+    and date filters are B-tree lookups instead of reads of FTS row content. Rows are keyed by
+    conversation id, so the index survives restarts and only conversations newer than the last
+    indexed id are added at startup (in the background).
+    """
+
+    def __init__(self, path='search_index.db'):
+        self.path = path
+        self.local = threading.local()
+        self.catching_up = False
+        with self.connection() as conn:
+            conn.execute(
+                "CREATE VIRTUAL TABLE IF NOT EXISTS conversation_fts USING fts5("
+                "user_message, ai_response, tokenize='porter unicode61')"
+            )
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS conversation_meta ("
+                "id INTEGER PRIMARY KEY, student_id TEXT, student_name TEXT, session_id TEXT, "
+                "scene_context TEXT, timestamp TEXT)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS conversation_meta_timestamp ON conversation_meta (timestamp)")
+
+    def connection(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = self.local.conn = connect_sqlite(self.path)
+        return conn
+
+    def insert(self, conn, conversations):
+        for conv in conversations:
+            # 多个 worker 共享同一个库时，同一条对话可能被各自补索引，按 id 去重
+            cursor = conn.execute(
+                "INSERT OR IGNORE INTO conversation_meta (id, student_id, student_name, session_id, scene_context, timestamp) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (conv['id'], conv.get('student_id'), conv.get('student_name'), conv.get('session_id'),
+                 conv.get('scene_context'), conv.get('timestamp', ''))
+            )
+            if cursor.rowcount:
+                conn.execute(
+                    "INSERT INTO conversation_fts (rowid, user_message, ai_response) VALUES (?, ?, ?)",
+                    (conv['id'], conv.get('user_message', ''), conv.get('ai_response', ''))
+                )
+
+    def add(self, conv):
+        if not conv.get('id'):
+            return
+        try:
+            with self.connection() as conn:
+                self.insert(conn, [conv])
+        except sqlite3.Error as e:
+            print(f"Error indexing conversation {conv.get('id')}: {e}")
+
+    def last_indexed_id(self):
+        return self.connection().execute("SELECT max(id) FROM conversation_meta").fetchone()[0] or 0
+
+    def catch_up(self, conversations, batch_size=2000):
+        # conversations 可以是从存储流式读取的迭代器，一次只攒一批
+        last_id = self.last_indexed_id()
+        self.catching_up = True
+        indexed = 0
+        batch = []
+        try:
+            for conv in conversations:
+                if (conv.get('id') or 0) > last_id:
+                    batch.append(conv)
+                if len(batch) >= batch_size:
+                    with self.connection() as conn:
+                        self.insert(conn, batch)
+                    indexed += len(batch)
+                    batch = []
+            if batch:
+                with self.connection() as conn:
+                    self.insert(conn, batch)
+                indexed += len(batch)
+            if indexed:
+                print(f"Indexed {indexed} conversations for search")
+        except sqlite3.Error as e:
+            print(f"Error building search index: {e}")
+        finally:
+            self.catching_up = False
+
+    def start_catch_up(self, conversations):
+        threading.Thread(target=self.catch_up, args=(conversations,), daemon=True).start()
+
+    def search(self, text, field=None, student_id=None, start=None, end=None, limit=20, offset=0):
+        """Return (total, results) ranked by bm25; raises ValueError for an empty query."""
+        expression = build_fts_query(text, field)
+        if expression is None:
+            raise ValueError('Empty search query')
+        where = ["conversation_fts MATCH ?"]
+        params = [expression]
+        if student_id:
+            where.append("m.student_id = ?")
+            params.append(student_id)
+        if start:
+            where.append("m.timestamp >= ?")
+            params.append(start)
+        if end:
+            where.append("m.timestamp < ?")
+            params.append(end)
+        source = "FROM conversation_fts"
+        if len(where) > 1:
+            # CROSS JOIN 固定先走全文索引再按 id 查元数据，避免查询规划器反过来逐行匹配
+            source += " CROSS JOIN conversation_meta m ON m.id = conversation_fts.rowid"
+        source += " WHERE " + ' AND '.join(where)
+
+        conn = self.connection()
+        total = conn.execute(f"SELECT count(*) {source}", params).fetchone()[0]
+        rows = conn.execute(
+            "SELECT conversation_fts.rowid, "
+            f"snippet(conversation_fts, 0, '{SNIPPET_OPEN}', '{SNIPPET_CLOSE}', '…', 16), "
+            f"snippet(conversation_fts, 1, '{SNIPPET_OPEN}', '{SNIPPET_CLOSE}', '…', 16), "
+            f"bm25(conversation_fts) AS score {source} ORDER BY score LIMIT ? OFFSET ?",
+            params + [limit, offset]
+        ).fetchall()
+        meta = {row[0]: row for row in conn.execute(
+            "SELECT id, student_id, student_name, session_id, scene_context, timestamp FROM conversation_meta "
+            f"WHERE id IN ({','.join('?' * len(rows))})", [row[0] for row in rows]
+        )} if rows else {}
+        return total, [{
+            'id': conv_id,
+            'student_id': meta[conv_id][1],
+            'student_name': meta[conv_id][2],
+            'session_id': meta[conv_id][3],
+            'scene_context': meta[conv_id][4],
+            'timestamp': meta[conv_id][5],
+            'user_snippet': render_snippet(user_snippet),
+            'ai_snippet': render_snippet(ai_snippet),
+            'score': -score
+        } for conv_id, user_snippet, ai_snippet, score in rows]
+
+def create_search_index():
+    if os.environ.get("SEARCH_ENABLED", "true").lower() != "true":
+        return None
+    try:
+        return ConversationSearchIndex(os.environ.get("SEARCH_INDEX_DB", "search_index.db"))
+    except sqlite3.Error as e:
+        # 部分 SQLite 编译版本没有 FTS5
+        print(f"Full-text search disabled: {e}")
+        return None
+
 # ================================
 # 简化版数据监控系统 - 只记录对话
 # ================================
 
+EXPORT_FIELDS = ['id', 'timestamp', 'student_name', 'user_message', 'ai_response',
+                 'scene_context', 'response_time_ms', 'day_of_week', 'hour', 'ip_address']
+
+def parse_date_filter(value, end=False):
+    """Normalize a date or ISO timestamp filter into a comparable timestamp string.
+
+    A bare date used as an end bound covers that whole day.
+    """
+    if not value:
+        return None
+    if len(value) == 10:
+        day = datetime.date.fromisoformat(value)
+        if end:
+            day += datetime.timedelta(days=1)
+        return datetime.datetime.combine(day, datetime.time()).isoformat()
+    return datetime.datetime.fromisoformat(value).isoformat()
+
+ARCHIVE_CHECK_INTERVAL = 3600
+ANALYTICS_CACHE_SECONDS = 60
+
 class ConversationMonitor:
-    def __init__(self):
-        self.data_file = 'conversation_data.json'
+    def __init__(self, store=None, search_index=None):
+        self.store = store or create_conversation_store()
         self.github_enabled = self.setup_github()
+        self.github_shas = {}
+        self.sync_worker = GitHubSyncWorker(
+            self.upload_to_github,
+            interval=float(os.environ.get("GITHUB_SYNC_INTERVAL", "30")),
+            batch_size=int(os.environ.get("GITHUB_SYNC_BATCH_SIZE", "50"))
+        )
+        self.lock = threading.RLock()
+        # 有新对话时唤醒 /admin/api/feed 的长轮询
+        self.changed = threading.Condition(self.lock)
+        self.analytics_cache = None
+        # 分层存储：内存里只保留最新的 hot_limit 条，更早的留在磁盘上按需读取
+        self.tiered = hasattr(self.store, 'load_recent')
+        self.hot_limit = max(1, int(os.environ.get("HOT_CONVERSATION_LIMIT", "20000")))
+        self.archive_after_days = int(os.environ.get("ARCHIVE_AFTER_DAYS", "7"))
+        self.cold_before = None
+        self.roll_archive()
         self.data = self.load_data()
-        self.operation_count = 0
-        self.save_frequency = 1
+        self.last_id = 0
+        self.analytics = ConversationAnalytics()
+        self.analytics.rebuild(self.track_ids(self.stored_conversations()))
+        self.data['total_conversations'] = self.analytics.total_conversations
+        self.index = ConversationIndex()
+        self.index.rebuild(self.data['conversations'])
+        self.search_index = search_index or create_search_index()
+        if self.search_index:
+            self.search_index.start_catch_up(self.stored_conversations())
 
     def setup_github(self):
         self.github_token = os.environ.get("GITHUB_TOKEN")
@@ -220,17 +1320,24 @@ class ConversationMonitor:
         if self.github_enabled:
             self.download_from_github()
 
-        if os.path.exists(self.data_file):
-            try:
-                with open(self.data_file, 'r', encoding='utf-8') as f:
-                    data = json.load(f)
-                    # 修复点：确保 students_chatted 是 set
-                    if 'students_chatted' in data and isinstance(data['students_chatted'], list):
-                        data['students_chatted'] = set(data['students_chatted'])
-                    print(f"Loaded {len(data.get('conversations', []))} conversations")
-                    return data
-            except Exception as e:
-                print(f"Error loading data: {e}")
+        if self.tiered:
+            conversations, has_older = self.store.load_recent(self.hot_limit)
+            if has_older:
+                # 比最旧的热数据更早的记录都在磁盘上；热数据为空时以当前时间为界
+                self.cold_before = conversation_key(conversations[0]) if conversations else (
+                    datetime.datetime.now().isoformat(), 0)
+        else:
+            conversations = self.store.load()
+        if conversations is not None:
+            data = {
+                'conversations': conversations,
+                'last_updated': datetime.datetime.now().isoformat(),
+                'total_conversations': len(conversations),
+                'students_chatted': set(conv.get('student_id') for conv in conversations),
+                'version': '3.0'
+            }
+            print(f"Loaded {len(conversations)} conversations" + (" (older ones on disk)" if self.cold_before else ""))
+            return data
 
         empty_data = {
             'conversations': [],
@@ -240,21 +1347,55 @@ class ConversationMonitor:
             'version': '3.0'
         }
 
-        self.save_data_to_file(empty_data)
-        print("Created new conversation data file")
+        if isinstance(self.store, JsonConversationStore):
+            self.store.save(empty_data)
+            empty_data['students_chatted'] = set()
+            print("Created new conversation data file")
         return empty_data
 
+    def stored_conversations(self):
+        # 完整历史：有冷数据时从存储流式读取，否则直接用内存里的副本
+        if self.cold_before:
+            return self.store.iter_range()
+        return list(self.data['conversations'])
+
+    def track_ids(self, conversations):
+        for conv in conversations:
+            self.last_id = max(self.last_id, conv.get('id') or 0)
+            yield conv
+
+    def roll_archive(self):
+        self.archived_at = time.monotonic()
+        if not hasattr(self.store, 'roll_archive') or self.archive_after_days <= 0:
+            return 0
+        cutoff = (datetime.date.today() - datetime.timedelta(days=self.archive_after_days)).isoformat()
+        # 还没上传到 GitHub 的分段先不归档，等下一轮
+        with self.sync_worker.condition:
+            pending = set(self.sync_worker.pending)
+        try:
+            return self.store.roll_archive(cutoff, skip=pending)
+        except Exception as e:
+            print(f"Error archiving conversation segments: {e}")
+            return 0
+
+    def evict_oldest(self):
+        # 一次淘汰超出上限的最旧记录（都已写入磁盘），再按新位置重建热数据索引
+        conversations = self.data['conversations']
+        del conversations[:len(conversations) - self.hot_limit]
+        self.cold_before = conversation_key(conversations[0])
+        self.index.rebuild(conversations)
+
     def get_student_name(self, student_id):
         return name_dict.get(student_id, "Unknown")
 
     def create_session_id(self):
         return str(uuid.uuid4())
 
-    def log_conversation(self, student_id, user_message, ai_response, scene_context="", response_time_ms=0):
-        session_id = self.create_session_id()
+    def log_conversation(self, student_id, user_message, ai_response, scene_context="", response_time_ms=0, session_id=None, extra=None):
+        session_id = session_id or self.create_session_id()
 
         conversation = {
-            'id': len(self.data['conversations']) + 1,
+            'id': None,
             'session_id': session_id,
             'student_id': student_id,
             'student_name': self.get_student_name(student_id),
@@ -269,139 +1410,315 @@ class ConversationMonitor:
             'ip_address': request.remote_addr if request else 'unknown',
             'user_agent': request.headers.get('User-Agent', 'unknown') if request else 'unknown'
         }
+        if extra:
+            conversation.update(extra)
+
+        if self.store.shared:
+            # 共享存储由数据库分配全局id，再按id顺序把其他worker写入的记录一并追上
+            self.save_data(conversation)
+            with span('conversation_index'):
+                self.refresh()
+        else:
+            with span('conversation_index'), self.lock:
+                conversation['id'] = self.last_id + 1
+                self.add_to_memory(conversation)
+            self.save_data(conversation)
+        if time.monotonic() - self.archived_at > ARCHIVE_CHECK_INTERVAL:
+            self.archived_at = time.monotonic()
+            threading.Thread(target=self.roll_archive, daemon=True).start()
+        print(f"Logged conversation: {student_id} - {user_message[:50]}...")
 
+    def add_to_memory(self, conversation):
         self.data['conversations'].append(conversation)
-        self.data['total_conversations'] = len(self.data['conversations'])
-        # 修改后
         if 'students_chatted' not in self.data:
             self.data['students_chatted'] = set()
         elif isinstance(self.data['students_chatted'], list):
             self.data['students_chatted'] = set(self.data['students_chatted'])
-        self.data['students_chatted'].add(student_id)
+        self.data['students_chatted'].add(conversation['student_id'])
+        self.analytics.add(conversation)
+        self.data['total_conversations'] = self.analytics.total_conversations
+        self.index.add(conversation, len(self.data['conversations']) - 1)
+        if self.search_index:
+            self.search_index.add(conversation)
+        self.last_id = max(self.last_id, conversation['id'])
+        if self.tiered and len(self.data['conversations']) > self.hot_limit + max(1, self.hot_limit // 10):
+            self.evict_oldest()
+        self.changed.notify_all()
 
-        self.save_data()
-        print(f"Logged conversation: {student_id} - {user_message[:50]}...")
+    def refresh(self):
+        """Pick up conversations that other workers appended to a shared store."""
+        if not self.store.shared:
+            return 0
+        with self.lock:
+            new_conversations = self.store.load_since(self.last_id)
+            for conversation in new_conversations:
+                self.add_to_memory(conversation)
+            return len(new_conversations)
 
     def get_analytics_dashboard_data(self):
-        conversations = self.data['conversations']
-        if not conversations:
-            return {
-                'student_stats': {},
-                'hourly_distribution': {},
-                'total_conversations': 0,
-                'unique_students': 0,
-                'recent_conversations': 0
-            }
+        self.refresh()
+        return self.analytics.snapshot()
 
-        student_stats = {}
-        for conv in conversations:
-            student = conv['student_name']
-            if student not in student_stats:
-                student_stats[student] = {
-                    'total_conversations': 0,
-                    'avg_response_time': 0,
-                    'total_response_time': 0
-                }
+    def analytics_json(self):
+        """Return (etag, JSON body) of the dashboard analytics, serialized once per data version.
 
-            student_stats[student]['total_conversations'] += 1
-            student_stats[student]['total_response_time'] += conv.get('response_time_ms', 0)
+        The version is last_id, which every logged conversation bumps and which is the same in
+        every worker sharing a SQLite store. The tag also rolls over every ANALYTICS_CACHE_SECONDS
+        so the sliding 24h count does not go stale while no one is chatting.
+        """
+        self.refresh()
+        etag = f"v{self.last_id}-{int(time.time() // ANALYTICS_CACHE_SECONDS)}"
+        cached = self.analytics_cache
+        if cached and cached[0] == etag:
+            return cached
+        payload = dict(self.analytics.snapshot(), version=self.last_id)
+        self.analytics_cache = (etag, json.dumps(payload, ensure_ascii=False))
+        return self.analytics_cache
 
-        for student, stats in student_stats.items():
-            if stats['total_conversations'] > 0:
-                stats['avg_response_time'] = stats['total_response_time'] / stats['total_conversations']
+    def wait_for_conversations(self, since, timeout=30.0, limit=50):
+        """Block until a conversation with id > since exists or timeout passes.
 
-        hourly_distribution = {}
-        for conv in conversations:
-            hour = conv.get('hour', 0)
-            hourly_distribution[hour] = hourly_distribution.get(hour, 0) + 1
+        Returns (version, newest conversations after `since`), read together under the lock.
+        """
+        deadline = time.monotonic() + timeout
+        with self.changed:
+            while True:
+                self.refresh()
+                remaining = deadline - time.monotonic()
+                if self.last_id > since or remaining <= 0:
+                    break
+                # 其他 worker 写入共享库时不会通知本进程，每秒自己查一次
+                self.changed.wait(min(remaining, 1.0) if self.store.shared else remaining)
+            conversations = []
+            for conv in reversed(self.data['conversations']):
+                if (conv.get('id') or 0) <= since or len(conversations) == limit:
+                    break
+                conversations.append(conv)
+            return self.last_id, conversations[::-1]
 
-        recent_conversations = len([c for c in conversations 
-                                  if (datetime.datetime.now() - datetime.datetime.fromisoformat(c['timestamp'])).days < 1])
+    def query_conversations(self, limit=50, cursor=None, order='desc', student_id=None, session_id=None,
+                            scene_context=None, start=None, end=None):
+        self.refresh()
+        start, end = parse_date_filter(start), parse_date_filter(end, end=True)
+        filters = {'student_id': student_id, 'session_id': session_id, 'scene_context': scene_context}
 
-        return {
-            'student_stats': student_stats,
-            'hourly_distribution': hourly_distribution,
-            'total_conversations': len(conversations),
-            'unique_students': len(set(conv['student_id'] for conv in conversations)),
-            'recent_conversations': recent_conversations,
-            'most_active_student': max(student_stats.items(), key=lambda x: x[1]['total_conversations'])[0] if student_stats else 'None'
-        }
+        def query_hot(limit, cursor):
+            return self.index.query(self.data['conversations'], limit, cursor=cursor, order=order,
+                                    start=start, end=end, **filters)
+
+        key = decode_cursor(cursor) if cursor else None
+        with self.lock:
+            cold_before = self.cold_before
+            if cold_before is None:
+                return query_hot(limit, cursor)
+            in_cold = key is not None and key < cold_before
+            page = []
+            if order == 'desc' and not in_cold:
+                page, next_cursor = query_hot(limit, cursor)
+                if next_cursor:
+                    return page, next_cursor
+            elif order != 'desc' and key is not None and not in_cold:
+                return query_hot(limit, cursor)
+
+        # 热数据不够一页：从磁盘上的冷数据继续，只读取范围内的分段
+        lower = (start, 0) if start else None
+        upper = min(cold_before, (end, 0)) if end else cold_before
+        if order == 'desc' and in_cold:
+            upper = min(upper, key)
+        elif order != 'desc' and key is not None:
+            lower = max(lower or key, (key[0], key[1] + 1))
+        need = limit - len(page)
+        cold = []
+        for conv in self.store.iter_range(lower, upper, reverse=order == 'desc'):
+            if all(conv.get(field) == value for field, value in filters.items() if value):
+                cold.append(conv)
+                if len(cold) > need:
+                    break
+        page.extend(cold[:need])
+        more = len(cold) > need
+
+        if order != 'desc' and not more:
+            # 正序时冷数据读完再接上热数据
+            with self.lock:
+                hot_page, next_cursor = query_hot(max(limit - len(page), 1), None)
+            if len(page) < limit:
+                return page + hot_page, next_cursor
+            more = bool(hot_page)
+        return page, encode_cursor(list(conversation_key(page[-1]))) if more and page else None
+
+    def search_conversations(self, query, field=None, student_id=None, start=None, end=None, limit=20, offset=0):
+        self.refresh()
+        return self.search_index.search(
+            query, field=field, student_id=student_id,
+            start=parse_date_filter(start), end=parse_date_filter(end, end=True),
+            limit=limit, offset=offset
+        )
+
+    def iter_conversations(self, page_size=1000, **filters):
+        # 按时间顺序分页遍历，导出期间新增的对话不影响已经翻过的部分
+        cursor = None
+        while True:
+            page, cursor = self.query_conversations(limit=page_size, cursor=cursor, order='asc', **filters)
+            yield from page
+            if not cursor:
+                return
 
-    def export_to_csv(self):
+    def iter_csv_export(self, chunk_rows=500, **filters):
         output = StringIO()
-        if self.data['conversations']:
-            fieldnames = ['id', 'timestamp', 'student_name', 'user_message', 'ai_response', 
-                         'scene_context', 'response_time_ms', 'day_of_week', 'hour', 'ip_address']
+        writer = csv.DictWriter(output, fieldnames=EXPORT_FIELDS)
+        writer.writeheader()
 
-            writer = csv.DictWriter(output, fieldnames=fieldnames)
-            writer.writeheader()
+        rows = 0
+        for conv in self.iter_conversations(**filters):
+            writer.writerow({key: conv.get(key, '') for key in EXPORT_FIELDS})
+            rows += 1
+            if rows % chunk_rows == 0:
+                yield output.getvalue()
+                output.seek(0)
+                output.truncate()
+        yield output.getvalue()
 
-            for conv in self.data['conversations']:
-                row = {key: conv.get(key, '') for key in fieldnames}
-                writer.writerow(row)
+    def export_to_csv(self, **filters):
+        return ''.join(self.iter_csv_export(**filters))
 
-        return output.getvalue()
+    def export_to_parquet(self, chunk_rows=10000, **filters):
+        # 分块写入 row group，内存占用只和单个块有关
+        import pandas as pd
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        from io import BytesIO
 
-    def save_data_to_file(self, data=None):
-        if data is None:
-            data = self.data
-        if 'students_chatted' in data and isinstance(data['students_chatted'], set):
-            data['students_chatted'] = list(data['students_chatted'])
+        schema = pa.schema([
+            ('id', pa.int64()), ('timestamp', pa.string()), ('student_id', pa.string()),
+            ('student_name', pa.string()), ('user_message', pa.string()), ('ai_response', pa.string()),
+            ('scene_context', pa.string()), ('response_time_ms', pa.float64()), ('day_of_week', pa.string()),
+            ('hour', pa.int64()), ('ip_address', pa.string())
+        ])
+        columns = schema.names
 
-        data['last_updated'] = datetime.datetime.now().isoformat()
+        def write_chunk(writer, chunk):
+            frame = pd.DataFrame.from_records(chunk, columns=columns)
+            writer.write_table(pa.Table.from_pandas(frame, schema=schema, preserve_index=False))
+
+        output = BytesIO()
+        with pq.ParquetWriter(output, schema, compression='zstd') as writer:
+            chunk = []
+            for conv in self.iter_conversations(**filters):
+                chunk.append({key: conv.get(key) for key in columns})
+                if len(chunk) >= chunk_rows:
+                    write_chunk(writer, chunk)
+                    chunk = []
+            if chunk:
+                write_chunk(writer, chunk)
+        return output.getvalue()
+
+    def save_data_to_file(self, conversation):
+        # 追加写入单条记录，代价与历史长度无关
+        started = time.perf_counter()
         try:
-            with open(self.data_file, 'w', encoding='utf-8') as f:
-                json.dump(data, f, indent=2, ensure_ascii=False, default=str)
-            print(f"Data saved: {len(data.get('conversations', []))} conversations")
-            return True
+            return self.store.append(conversation, self.data)
         except Exception as e:
             print(f"Error saving data: {e}")
-            return False
+            return None
+        finally:
+            storage_write_seconds.observe(time.perf_counter() - started, backend=type(self.store).__name__)
+
+    def save_data(self, conversation, force_upload=False):
+        with span('save_data_to_file'):
+            path = self.save_data_to_file(conversation)
+        if path and self.github_enabled:
+            # 上传本身在 GitHubSyncWorker 线程里进行，请求里只有标记的开销
+            with span('github_sync'):
+                self.sync_worker.mark_dirty(path)
+                if force_upload:
+                    self.sync_worker.request_flush()
+
+    def github_headers(self):
+        return {'Authorization': f'token {self.github_token}', 'Accept': 'application/vnd.github.v3+json'}
 
-    def save_data(self, force_upload=False):
-        self.operation_count += 1
-        self.save_data_to_file()
-        if self.github_enabled and (self.operation_count % self.save_frequency == 0 or force_upload):
-            self.upload_to_github()
+    def github_contents_url(self, path):
+        return f"https://api.github.com/repos/{self.github_repo}/contents/{path.replace(os.sep, '/')}"
+
+    def download_file_from_github(self, path):
+        response = requests.get(self.github_contents_url(path), headers=self.github_headers(), timeout=10)
+        if response.status_code == 200:
+            content = response.json()
+            if content.get('content'):
+                import base64
+                file_content = base64.b64decode(content['content']).decode('utf-8')
+            else:
+                # 超过1MB的文件 contents API 不返回内容，改走 download_url
+                file_content = requests.get(content['download_url'], headers=self.github_headers(), timeout=30).text
+            directory = os.path.dirname(path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            with open(path, 'w', encoding='utf-8') as f:
+                f.write(file_content)
+            return True
+        elif response.status_code == 404:
+            return False
+        print(f"Unexpected GitHub response for {path}: {response.status_code}")
+        return False
 
     def download_from_github(self):
         if not self.github_enabled:
             return False
         try:
-            url = f"https://api.github.com/repos/{self.github_repo}/contents/{self.data_file}"
-            headers = {'Authorization': f'token {self.github_token}', 'Accept': 'application/vnd.github.v3+json'}
-            response = requests.get(url, headers=headers, timeout=10)
-            if response.status_code == 200:
-                content = response.json()
-                import base64
-                file_content = base64.b64decode(content['content']).decode('utf-8')
-                with open(self.data_file, 'w', encoding='utf-8') as f:
-                    f.write(file_content)
-                print("Downloaded latest data from GitHub")
+            if isinstance(self.store, JsonConversationStore):
+                if self.download_file_from_github(self.store.data_file):
+                    print("Downloaded latest data from GitHub")
+                    return True
+                print("No existing data file in GitHub")
+                return False
+
+            response = requests.get(self.github_contents_url(self.store.log_dir),
+                                    headers=self.github_headers(), timeout=10)
+            if response.status_code == 200:
+                local_files = set(self.store.files())
+                has_segment = getattr(self.store, 'has_segment', lambda path: path in local_files)
+                downloaded = 0
+                for item in response.json():
+                    path = os.path.join(self.store.log_dir, item['name'])
+                    # 已经归档的日期不再下载
+                    if item['name'].endswith('.jsonl') and not has_segment(path):
+                        downloaded += self.download_file_from_github(path)
+                print(f"Downloaded {downloaded} conversation segments from GitHub")
                 return True
             elif response.status_code == 404:
+                # 远端尚未分段，拉取旧格式文件以便本地迁移
+                if self.download_file_from_github(self.store.legacy_file):
+                    print("Downloaded legacy data file from GitHub")
+                    return True
                 print("No existing data file in GitHub")
                 return False
         except Exception as e:
             print(f"Failed to download from GitHub: {e}")
         return False
 
-    def upload_to_github(self):
+    def upload_to_github(self, path):
         if not self.github_enabled:
             return False
+        started = time.perf_counter()
+        uploaded = self.put_github_segment(path)
+        github_sync_seconds.observe(time.perf_counter() - started, outcome='ok' if uploaded else 'error')
+        if not uploaded:
+            github_sync_failures_total.inc()
+        return uploaded
+
+    def put_github_segment(self, path):
         try:
-            with open(self.data_file, 'r', encoding='utf-8') as f:
-                content = f.read()
+            content = self.store.read_segment(path)
             import base64
             encoded_content = base64.b64encode(content.encode('utf-8')).decode('utf-8')
 
-            url = f"https://api.github.com/repos/{self.github_repo}/contents/{self.data_file}"
-            headers = {'Authorization': f'token {self.github_token}', 'Accept': 'application/vnd.github.v3+json'}
+            url = self.github_contents_url(path)
+            headers = self.github_headers()
 
-            get_response = requests.get(url, headers=headers, timeout=10)
-            sha = None
-            if get_response.status_code == 200:
-                sha = get_response.json()['sha']
+            sha = self.github_shas.get(path)
+            if sha is None:
+                get_response = requests.get(url, headers=headers, timeout=10)
+                if get_response.status_code == 200:
+                    sha = get_response.json()['sha']
 
             data = {
                 'message': f'Update conversation data - {datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")}',
@@ -413,8 +1730,13 @@ class ConversationMonitor:
 
             response = requests.put(url, headers=headers, json=data, timeout=15)
             if response.status_code in [200, 201]:
-                print("Data uploaded to GitHub successfully")
+                self.github_shas[path] = response.json()['content']['sha']
+                print(f"Uploaded {path} to GitHub")
                 return True
+            if response.status_code in [409, 422]:
+                # sha 已过期（其他进程写过），下次重试时重新获取
+                self.github_shas.pop(path, None)
+            print(f"GitHub upload of {path} returned {response.status_code}")
         except Exception as e:
             print(f"Error uploading to GitHub: {e}")
         return False
@@ -425,33 +1747,1755 @@ monitor = ConversationMonitor()
 # 提示加载函数
 # ================================
 
-def load_shared_prompt():
-    try:
-        with open("shared_prompt.txt", "r") as f:
-            return f.read().strip()
-    except:
-        return "You are a helpful digital assistant roleplaying as a teen student."
-
-def load_prompts():
-    shared_prompt = load_shared_prompt()
-    prompts = {}
-    for i in range(1, 11):
-        path = f"prompts/{i}.json"
+DEFAULT_SHARED_PROMPT = "You are a helpful digital assistant roleplaying as a teen student."
+SURVEY_SENTENCE = re.compile(r'(?<=[.!?])\s+|\s+(?=During the past )')
+LEADING_PERIOD = re.compile(r'^(?:During|In) the past (\d+ \w+), you (.+?)\.?$')
+TRAILING_PERIOD = re.compile(r'^You (.+?),? (?:during|in) the past (\d+ \w+)\.$')
+
+def compact_persona(text):
+    """Group survey answers by time frame so each "in the past 12 months" appears once.
+
+    Sentences without a time frame keep their original wording and order.
+    """
+    general = []
+    periods = {}
+    for sentence in SURVEY_SENTENCE.split(text.strip()):
+        match = LEADING_PERIOD.match(sentence)
+        if match:
+            periods.setdefault(match.group(1), []).append(match.group(2))
+            continue
+        match = TRAILING_PERIOD.match(sentence)
+        if match:
+            periods.setdefault(match.group(2), []).append(match.group(1))
+            continue
+        general.append(sentence)
+
+    lines = [' '.join(general)]
+    for period, facts in periods.items():
+        lines.append(f"\nIn the past {period}, you:")
+        lines.extend(f"- {fact}" for fact in facts)
+    return '\n'.join(lines)
+
+class PromptRegistry:
+    """Persona system prompts, reloaded when shared_prompt.txt or prompts/N.json change on disk.
+
+    get() compares file mtimes at most every `check_interval` seconds and swaps in a freshly
+    built dict with one assignment, so a request never sees a half-reloaded set. A file that
+    fails to read or parse keeps its last good version.
+    """
+
+    def __init__(self, prompt_dir='prompts', shared_path='shared_prompt.txt', persona_count=10,
+                 compact=False, check_interval=2.0):
+        self.prompt_dir = prompt_dir
+        self.shared_path = shared_path
+        self.persona_count = persona_count
+        self.compact = compact
+        self.check_interval = check_interval
+        self.lock = threading.Lock()
+        self.mtimes = None
+        self.checked_at = 0.0
+        self.shared = DEFAULT_SHARED_PROMPT
+        self.personas = {}
+        self.prompts = {}
+        self.versions = {}
+        self.token_counts = None
+        self.loaded_at = None
+        self.reload()
+
+    def persona_path(self, index):
+        return os.path.join(self.prompt_dir, f"{index}.json")
+
+    def current_mtimes(self):
+        mtimes = {}
+        for path in [self.shared_path] + [self.persona_path(i) for i in range(1, self.persona_count + 1)]:
+            try:
+                mtimes[path] = os.path.getmtime(path)
+            except OSError:
+                mtimes[path] = None
+        return mtimes
+
+    def read_shared(self):
+        try:
+            with open(self.shared_path, 'r', encoding='utf-8') as f:
+                return f.read().strip()
+        except OSError as e:
+            print(f"Error loading {self.shared_path}: {e}")
+            return self.shared
+
+    def read_persona(self, index):
+        student_id = f"student{index:03d}"
+        path = self.persona_path(index)
+        if not os.path.exists(path):
+            return None
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                return json.load(f)['prompt']
+        except (OSError, ValueError, KeyError) as e:
+            print(f"Error loading {path}: {e}")
+            return self.personas.get(student_id, f"You are student {index}.")
+
+    def reload(self):
+        with self.lock:
+            mtimes = self.current_mtimes()
+            if mtimes == self.mtimes:
+                return False
+            shared = self.read_shared()
+            personas = {}
+            for i in range(1, self.persona_count + 1):
+                persona = self.read_persona(i)
+                if persona is not None:
+                    personas[f"student{i:03d}"] = persona
+
+            prompts = {}
+            for student_id, persona in personas.items():
+                prompts[student_id] = shared + "\n\n" + (compact_persona(persona) if self.compact else persona)
+            self.shared = shared
+            self.personas = personas
+            self.versions = {student_id: hashlib.sha1(prompt.encode('utf-8')).hexdigest()[:12]
+                             for student_id, prompt in prompts.items()}
+            self.token_counts = None
+            self.prompts = prompts
+            self.mtimes = mtimes
+            self.loaded_at = datetime.datetime.now().isoformat()
+            print(f"Loaded {len(prompts)} persona prompts ({'compact' if self.compact else 'full'} format)")
+            return True
+
+    def maybe_reload(self):
+        now = time.monotonic()
+        if now - self.checked_at < self.check_interval:
+            return
+        self.checked_at = now
+        self.reload()
+
+    def get(self, student_id, default="You are a helpful assistant."):
+        self.maybe_reload()
+        return self.prompts.get(student_id, default)
+
+    def version(self, student_id):
+        self.maybe_reload()
+        return self.versions.get(student_id, '')
+
+    def stats(self):
+        self.maybe_reload()
+        prompts = self.prompts
+        token_counts = self.token_counts
+        if token_counts is None:
+            # 每个版本只数一次，之后直接返回
+            token_counts = self.token_counts = {student_id: token_counter.count(prompt)
+                                                for student_id, prompt in prompts.items()}
+        return {
+            'format': 'compact' if self.compact else 'full',
+            'loaded_at': self.loaded_at,
+            'personas': {student_id: {
+                'name': name_dict.get(student_id, student_id),
+                'tokens': token_counts.get(student_id, 0),
+                'characters': len(prompt),
+                'version': self.versions.get(student_id, '')
+            } for student_id, prompt in prompts.items()}
+        }
+
+prompt_registry = PromptRegistry(
+    compact=os.environ.get("PROMPT_FORMAT", "full") == "compact",
+    check_interval=float(os.environ.get("PROMPT_RELOAD_INTERVAL", "2"))
+)
+
+# ================================
+# 准入控制与限流
+# ================================
+
+class AdmissionRejected(Exception):
+    def __init__(self, message, retry_after, reason='queue_full'):
+        super().__init__(message)
+        self.retry_after = retry_after
+        self.reason = reason
+
+
+def parse_reset_duration(value):
+    """Parse OpenAI's x-ratelimit-reset-* durations such as '20ms', '1.5s' or '6m0s' into seconds."""
+    units = {'ms': 0.001, 's': 1, 'm': 60, 'h': 3600}
+    parts = re.findall(r"(\d+(?:\.\d+)?)(ms|s|m|h)", value or '')
+    if not parts:
+        return None
+    return sum(float(number) * units[unit] for number, unit in parts)
+
+
+def provider_retry_after(headers):
+    if headers.get('retry-after-ms'):
+        try:
+            return float(headers['retry-after-ms']) / 1000
+        except ValueError:
+            pass
+    if headers.get('retry-after'):
+        try:
+            return float(headers['retry-after'])
+        except ValueError:
+            pass
+    resets = [parse_reset_duration(headers.get(name))
+              for name in ('x-ratelimit-reset-requests', 'x-ratelimit-reset-tokens')]
+    resets = [reset for reset in resets if reset is not None]
+    return max(resets) if resets else None
+
+
+class TokenBucketLimiter:
+    """Per-key token buckets (LRU-bounded) refilled at `rate` tokens per second up to `burst`."""
+
+    def __init__(self, rate, burst, max_keys=10000):
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys
+        self.buckets = OrderedDict()
+        self.lock = threading.Lock()
+
+    def acquire(self, key, cost=1):
+        """Take `cost` tokens; returns 0 when allowed, otherwise seconds until enough are available."""
+        now = time.monotonic()
+        # 超过 burst 的请求只要桶满就放行，差额记成欠账，之后的请求要等欠账还清
+        needed = min(cost, self.burst)
+        with self.lock:
+            tokens, updated = self.buckets.get(key, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - updated) * self.rate)
+            if tokens >= needed:
+                self.buckets[key] = (tokens - cost, now)
+                wait = 0
+            else:
+                self.buckets[key] = (tokens, now)
+                wait = (needed - tokens) / self.rate
+            self.buckets.move_to_end(key)
+            while len(self.buckets) > self.max_keys:
+                self.buckets.popitem(last=False)
+        return wait
+
+session_limiter = TokenBucketLimiter(
+    rate=float(os.environ.get("RATE_LIMIT_SESSION_PER_MIN", "20")) / 60,
+    burst=float(os.environ.get("RATE_LIMIT_SESSION_BURST", "5"))
+)
+# 一个教室通常共用一个出口IP，所以按IP的额度要宽松得多
+ip_limiter = TokenBucketLimiter(
+    rate=float(os.environ.get("RATE_LIMIT_IP_PER_MIN", "300")) / 60,
+    burst=float(os.environ.get("RATE_LIMIT_IP_BURST", "60"))
+)
+
+def client_ip():
+    # remote_addr 已由 ProxyFix 按可信跳数改写，不再直接读客户端可伪造的 X-Forwarded-For
+    return request.remote_addr or 'unknown'
+
+def admit_chat_request(chat_sid, completions=1):
+    """Raise AdmissionRejected unless this client is under its rate limits and the LLM queue has room."""
+    # 会话额度按"提问次数"计：一次广播只算一问；IP 额度保护上游，按实际补全数计
+    for limiter, key, cost, reason in ((session_limiter, chat_sid, 1, 'session_rate'),
+                                       (ip_limiter, client_ip(), completions, 'ip_rate')):
+        wait = limiter.acquire(key, cost)
+        if wait:
+            raise AdmissionRejected("You're sending messages too quickly. Please slow down.", math.ceil(wait), reason)
+    llm.check_capacity()
+
+def too_many_requests(message, retry_after, reason):
+    rejections_total.inc(reason=reason)
+    response = jsonify({'error': message, 'retry_after': retry_after})
+    response.status_code = 429
+    response.headers['Retry-After'] = str(retry_after)
+    return response
+
+# ================================
+# OpenAI 调用网关 - 共享事件循环与连接池
+# ================================
+
+STREAM_END = object()
+
+class LLMGateway:
+    """Runs every OpenAI call on one background asyncio loop with a shared connection pool.
+
+    Request threads only wait on a future, so a gthread worker can keep hundreds of chats
+    waiting on the model, while a global semaphore caps completions in flight per process.
+    """
+
+    def __init__(self, max_concurrency=64, timeout=60.0, max_queue=200, max_retries=3,
+                 backoff_base=0.5, backoff_max=20.0):
+        self.max_concurrency = max_concurrency
+        self.timeout = timeout
+        self.max_queue = max_queue
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.loop = None
+        self.client = None
+        self.clients = {}
+        self.semaphore = None
+        self.in_flight = 0
+        self.waiting = 0
+        self.cooldown_until = 0.0
+        self.avg_latency = 2.0
+        self.start_lock = threading.Lock()
+
+    def ensure_started(self):
+        # 懒启动，保证事件循环线程在 gunicorn fork 之后才创建
+        if self.loop is not None:
+            return self.loop
+        with self.start_lock:
+            if self.loop is None:
+                self.http_client = DefaultAsyncHttpxClient(
+                    limits=httpx.Limits(
+                        max_connections=self.max_concurrency,
+                        max_keepalive_connections=self.max_concurrency
+                    ),
+                    timeout=httpx.Timeout(self.timeout, connect=10.0)
+                )
+                self.client = AsyncOpenAI(
+                    api_key=os.environ.get("OPENAI_API_KEY"),
+                    max_retries=0,
+                    http_client=self.http_client
+                )
+                loop = asyncio.new_event_loop()
+                ready = threading.Event()
+
+                def run():
+                    asyncio.set_event_loop(loop)
+                    self.semaphore = asyncio.Semaphore(self.max_concurrency)
+                    ready.set()
+                    loop.run_forever()
+
+                threading.Thread(target=run, name="llm-gateway", daemon=True).start()
+                ready.wait()
+                self.loop = loop
+        return self.loop
+
+    def run(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self.ensure_started()).result()
+
+    def client_for(self, endpoint=None):
+        # 其他端点各用一个客户端，但共用同一个连接池；只在事件循环线程里调用
+        if not endpoint:
+            return self.client
+        client = self.clients.get(endpoint)
+        if client is None:
+            base_url, api_key = endpoint
+            client = self.clients[endpoint] = AsyncOpenAI(
+                api_key=api_key or os.environ.get("OPENAI_API_KEY"),
+                base_url=base_url or None,
+                max_retries=0,
+                http_client=self.http_client
+            )
+        return client
+
+    def retry_after(self):
+        # 按当前排队长度和平均耗时估算多久后再来
+        return max(1, math.ceil(self.avg_latency * (self.waiting + 1) / self.max_concurrency))
+
+    def check_capacity(self):
+        if self.in_flight >= self.max_concurrency and self.waiting >= self.max_queue:
+            raise AdmissionRejected("Too many chats in progress. Please try again shortly.", self.retry_after())
+
+    async def acquire(self):
+        self.check_capacity()
+        self.waiting += 1
+        started = time.monotonic()
+        try:
+            await self.semaphore.acquire()
+        finally:
+            self.waiting -= 1
+        llm_queue_wait_seconds.observe(time.monotonic() - started)
+        self.in_flight += 1
+
+    def release(self, started):
+        self.in_flight -= 1
+        self.semaphore.release()
+        elapsed = time.monotonic() - started
+        self.avg_latency = 0.9 * self.avg_latency + 0.1 * elapsed
+
+    def retry_delay(self, error, attempt):
+        headers = getattr(getattr(error, 'response', None), 'headers', None) or {}
+        delay = provider_retry_after(headers)
+        if delay is None:
+            delay = random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** attempt)))
+        return min(self.backoff_max, delay)
+
+    def should_retry(self, error, attempt):
+        if attempt >= self.max_retries:
+            return False
+        if isinstance(error, openai.RateLimitError):
+            # 额度用完重试也没用
+            return getattr(error, 'code', None) != 'insufficient_quota'
+        return isinstance(error, (openai.APIConnectionError, openai.InternalServerError))
+
+    async def create_with_retry(self, kwargs, endpoint=None):
+        client = self.client_for(endpoint)
+        attempt = 0
+        while True:
+            wait = self.cooldown_until - self.loop.time()
+            if wait > 0:
+                await asyncio.sleep(wait)
+            try:
+                return await client.chat.completions.create(**kwargs)
+            except Exception as e:
+                if not self.should_retry(e, attempt):
+                    raise
+                delay = self.retry_delay(e, attempt)
+                if isinstance(e, openai.RateLimitError):
+                    # 全局冷却，避免所有排队请求一起撞上限
+                    self.cooldown_until = max(self.cooldown_until, self.loop.time() + delay)
+                else:
+                    await asyncio.sleep(delay)
+                attempt += 1
+
+    async def _complete(self, kwargs, endpoint=None):
+        await self.acquire()
+        started = time.monotonic()
+        outcome = 'error'
+        try:
+            response = await self.create_with_retry(kwargs, endpoint)
+            outcome = 'ok'
+            return response
+        finally:
+            self.release(started)
+            openai_request_seconds.observe(time.monotonic() - started, model=kwargs.get('model'), mode='complete', outcome=outcome)
+
+    def complete(self, **kwargs):
+        return self.run(self._complete(kwargs))
+
+    def submit(self, **kwargs):
+        """Start a completion without waiting for it; returns a concurrent.futures.Future."""
+        return asyncio.run_coroutine_threadsafe(self._complete(kwargs), self.ensure_started())
+
+    async def _stream(self, kwargs, chunks, endpoint=None):
+        try:
+            await self.acquire()
+        except Exception as e:
+            chunks.put(e)
+            chunks.put(STREAM_END)
+            return
+        started = time.monotonic()
+        outcome = 'error'
+        first_token = True
+        try:
+            stream = await self.create_with_retry(dict(kwargs, stream=True), endpoint)
+            async for chunk in stream:
+                if first_token and chunk.choices:
+                    openai_first_token_seconds.observe(time.monotonic() - started, model=kwargs.get('model'))
+                    first_token = False
+                chunks.put(chunk)
+            outcome = 'ok'
+        except Exception as e:
+            chunks.put(e)
+        finally:
+            self.release(started)
+            openai_request_seconds.observe(time.monotonic() - started, model=kwargs.get('model'), mode='stream', outcome=outcome)
+            chunks.put(STREAM_END)
+
+    def stream(self, **kwargs):
+        chunks = queue.Queue()
+        future = asyncio.run_coroutine_threadsafe(self._stream(kwargs, chunks), self.ensure_started())
+        try:
+            while True:
+                item = chunks.get()
+                if item is STREAM_END:
+                    return
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            # 浏览器断开时取消上游请求，释放并发名额
+            if not future.done():
+                future.cancel()
+
+llm = LLMGateway(
+    max_concurrency=int(os.environ.get("LLM_MAX_CONCURRENCY", "64")),
+    timeout=float(os.environ.get("LLM_TIMEOUT", "60")),
+    max_queue=int(os.environ.get("LLM_MAX_QUEUE", "200")),
+    max_retries=int(os.environ.get("LLM_MAX_RETRIES", "3"))
+)
+metrics.gauge('chat_openai_in_flight', 'OpenAI completions currently running', lambda: llm.in_flight)
+metrics.gauge('chat_llm_queue_depth', 'Completions waiting for a concurrency slot', lambda: llm.waiting)
+
+# ================================
+# 模型调度 - 对冲请求与熔断回退
+# ================================
+
+class CircuitBreaker:
+    """Opens when at least `error_threshold` of the last `window` calls failed.
+
+    While open, allow() is False; after `cooldown` seconds one trial call is let through and
+    its outcome decides whether the breaker closes again.
+    """
+
+    def __init__(self, window=20, error_threshold=0.5, min_calls=10, cooldown=30.0):
+        self.outcomes = deque(maxlen=window)
+        self.error_threshold = error_threshold
+        self.min_calls = min_calls
+        self.cooldown = cooldown
+        self.opened_at = None
+        self.trial = False
+        self.lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return 'closed'
+        return 'half_open' if self.trial else 'open'
+
+    def allow(self):
+        with self.lock:
+            if self.opened_at is None:
+                return True
+            if not self.trial and time.monotonic() - self.opened_at >= self.cooldown:
+                self.trial = True
+                return True
+            return False
+
+    def release_trial(self):
+        # 试探请求被取消或没真正发出时没有结论：保持熔断，下一次调用重新试探
+        with self.lock:
+            self.trial = False
+
+    def record(self, ok):
+        with self.lock:
+            if self.opened_at is not None:
+                # 熔断期间只有试探请求的结果算数
+                if self.trial:
+                    self.trial = False
+                    if ok:
+                        self.opened_at = None
+                        self.outcomes.clear()
+                    else:
+                        self.opened_at = time.monotonic()
+                return
+            self.outcomes.append(ok)
+            failures = self.outcomes.count(False)
+            if len(self.outcomes) >= self.min_calls and failures >= self.error_threshold * len(self.outcomes):
+                self.opened_at = time.monotonic()
+                print(f"Circuit opened after {failures}/{len(self.outcomes)} failed completions")
+
+
+class ModelRoute:
+    """One model at one endpoint, with its own latency samples and circuit breaker."""
+
+    def __init__(self, name, model, base_url=None, api_key=None, breaker=None, samples=200):
+        self.name = name
+        self.model = model
+        self.endpoint = (base_url, api_key) if base_url or api_key else None
+        self.breaker = breaker or CircuitBreaker()
+        self.latencies = deque(maxlen=samples)
+        self.first_token_latencies = deque(maxlen=samples)
+
+    def p95(self, samples, min_samples=20):
+        if len(samples) < min_samples:
+            return None
+        ordered = sorted(samples)
+        return ordered[int(0.95 * (len(ordered) - 1))]
+
+
+def failover_worthy(error):
+    # 只有服务端的问题（5xx、超时、连接失败、429）才说明这个路由不健康；
+    # 本地排队满了或请求本身有问题（4xx）时换个模型也没用，也不计入熔断
+    if isinstance(error, (openai.APIConnectionError, openai.RateLimitError, openai.InternalServerError)):
+        return True
+    return isinstance(error, openai.APIStatusError) and error.status_code >= 500
+
+
+class TaggedQueue:
+    """Lets several streams share one queue; each item arrives as (tag, item)."""
+
+    def __init__(self, target, tag):
+        self.target = target
+        self.tag = tag
+
+    def put(self, item):
+        self.target.put((self.tag, item))
+
+
+class CompletionDispatcher:
+    """Picks a model route for each completion, hedges slow calls and fails over on errors.
+
+    A call that has not finished (or, when streaming, produced its first chunk) within the
+    route's observed p95 gets a second identical request; the first to answer wins and the
+    other is cancelled. Hedges draw from a budget refilled by `hedge_ratio` per call, and are
+    skipped while the gateway already has a queue. When the primary route's breaker is open
+    calls go to the fallback route, and a failed primary call is retried once on the fallback.
+    Every call returns a list of per-attempt timings for the conversation log.
+    """
+
+    def __init__(self, gateway, primary, fallback=None, hedging=True, hedge_delay=3.0, hedge_min_delay=0.5,
+                 hedge_ratio=0.1, hedge_burst=5.0):
+        self.gateway = gateway
+        self.primary = primary
+        self.fallback = fallback
+        self.hedging = hedging
+        self.hedge_delay = hedge_delay
+        self.hedge_min_delay = hedge_min_delay
+        self.hedge_ratio = hedge_ratio
+        self.hedge_burst = hedge_burst
+        self.hedge_tokens = hedge_burst
+        self.lock = threading.Lock()
+
+    def choose_route(self):
+        if self.fallback is None or self.primary.breaker.allow():
+            return self.primary
+        return self.fallback
+
+    def hedge_after(self, route, stream=False):
+        # 没有足够样本时用配置的初始值，之后跟随观测到的 p95
+        if not self.hedging:
+            return None
+        p95 = route.p95(route.first_token_latencies if stream else route.latencies)
+        return self.hedge_delay if p95 is None else max(self.hedge_min_delay, p95)
+
+    def earn_hedge(self):
+        with self.lock:
+            self.hedge_tokens = min(self.hedge_burst, self.hedge_tokens + self.hedge_ratio)
+
+    def spend_hedge(self):
+        with self.lock:
+            if self.gateway.waiting or self.hedge_tokens < 1:
+                return False
+            self.hedge_tokens -= 1
+            return True
+
+    def new_attempt(self, route, hedge, started, attempts):
+        record = {'route': route.name, 'model': route.model, 'hedge': hedge,
+                  'start_ms': round((time.monotonic() - started) * 1000)}
+        attempts.append(record)
+        return record
+
+    def finish_attempt(self, route, record, outcome, started, error=None):
+        # 耗时从发出这次尝试算起（含排队），started 是整个调用的开始时间
+        elapsed = time.monotonic() - started - record['start_ms'] / 1000
+        if 'outcome' in record:
+            return elapsed
+        record['outcome'] = outcome
+        record['elapsed_ms'] = round(elapsed * 1000)
+        if error is not None:
+            record['error'] = type(error).__name__
+        llm_attempts_total.inc(route=route.name, hedge=str(record['hedge']).lower(), outcome=outcome)
+        if outcome == 'ok':
+            route.breaker.record(True)
+        elif outcome == 'error':
+            route.breaker.record(False)
+        else:
+            route.breaker.release_trial()
+        return elapsed
+
+    def failure_outcome(self, error):
+        return 'error' if failover_worthy(error) else 'rejected'
+
+    async def attempt(self, route, kwargs, record, started):
+        try:
+            response = await self.gateway._complete(dict(kwargs, model=route.model), route.endpoint)
+        except asyncio.CancelledError:
+            self.finish_attempt(route, record, 'cancelled', started)
+            raise
+        except Exception as e:
+            self.finish_attempt(route, record, self.failure_outcome(e), started, e)
+            raise
+        route.latencies.append(self.finish_attempt(route, record, 'ok', started))
+        return response
+
+    async def hedged(self, route, kwargs, started, attempts):
+        launched = {}
+
+        def launch(hedge):
+            record = self.new_attempt(route, hedge, started, attempts)
+            launched[asyncio.ensure_future(self.attempt(route, kwargs, record, started))] = record
+
+        launch(False)
+        try:
+            done, _ = await asyncio.wait(launched, timeout=self.hedge_after(route))
+            if not done and self.spend_hedge():
+                launch(True)
+            pending = set(launched)
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        return task.result()
+            raise next(iter(launched)).exception()
+        finally:
+            # 输的一方（或调用方断开时的全部请求）立即取消，释放并发名额
+            for task, record in launched.items():
+                if not task.done():
+                    task.cancel()
+                    self.finish_attempt(route, record, 'cancelled', started)
+
+    async def _dispatch(self, kwargs):
+        started = time.monotonic()
+        attempts = []
+        self.earn_hedge()
+        route = self.choose_route()
+        try:
+            response = await self.hedged(route, kwargs, started, attempts)
+        except Exception as e:
+            if route is not self.primary or self.fallback is None or not failover_worthy(e):
+                raise
+            record = self.new_attempt(self.fallback, False, started, attempts)
+            response = await self.attempt(self.fallback, kwargs, record, started)
+        return response, attempts
+
+    def complete(self, **kwargs):
+        """Return (response, attempts); `model` comes from the chosen route."""
+        return self.gateway.run(self._dispatch(kwargs))
+
+    def submit(self, **kwargs):
+        """Start a dispatched completion; the future resolves to (response, attempts)."""
+        return asyncio.run_coroutine_threadsafe(self._dispatch(kwargs), self.gateway.ensure_started())
+
+    def stream(self, attempts, **kwargs):
+        """Yield chunks from whichever attempt produces a first chunk first; timings go into `attempts`."""
+        started = time.monotonic()
+        self.earn_hedge()
+        shared = queue.Queue()
+        launched = []
+
+        def launch(route, hedge):
+            record = self.new_attempt(route, hedge, started, attempts)
+            future = asyncio.run_coroutine_threadsafe(
+                self.gateway._stream(dict(kwargs, model=route.model), TaggedQueue(shared, len(launched)), route.endpoint),
+                self.gateway.ensure_started()
+            )
+            launched.append((route, record, future))
+
+        route = self.choose_route()
+        launch(route, False)
+        delay = self.hedge_after(route, stream=True)
+        hedge_at = started + delay if delay is not None else None
+        winner = None
+        errors = []
+        live = 1
         try:
-            if os.path.exists(path):
-                with open(path, "r") as f:
-                    data = json.load(f)
-                    prompts[f"student{i:03d}"] = shared_prompt + "\n\n" + data["prompt"]
-        except:
-            prompts[f"student{i:03d}"] = shared_prompt + f"\n\nYou are student {i}."
-    return prompts
+            while True:
+                try:
+                    timeout = max(0.0, hedge_at - time.monotonic()) if hedge_at is not None else None
+                    tag, item = shared.get(timeout=timeout)
+                except queue.Empty:
+                    hedge_at = None
+                    if self.spend_hedge():
+                        launch(route, True)
+                        live += 1
+                    continue
+
+                attempt_route, record, _ = launched[tag]
+                if winner is not None and tag != winner:
+                    continue
+                if isinstance(item, Exception):
+                    self.finish_attempt(attempt_route, record, self.failure_outcome(item), started, item)
+                    if tag == winner:
+                        raise item
+                    errors.append(item)
+                    continue
+                if item is STREAM_END:
+                    if tag == winner:
+                        attempt_route.latencies.append(self.finish_attempt(attempt_route, record, 'ok', started))
+                        return
+                    live -= 1
+                    if live:
+                        continue
+                    # 所有尝试都没产出内容就失败了：主路由失败时再试一次备用模型
+                    if (len(errors) == len(launched) and route is self.primary and self.fallback is not None
+                            and failover_worthy(errors[0])):
+                        hedge_at = None
+                        route = self.fallback
+                        launch(route, False)
+                        live = 1
+                        continue
+                    if errors:
+                        raise errors[-1]
+                    return
+
+                if winner is None:
+                    winner = tag
+                    hedge_at = None
+                    first_token = time.monotonic() - started - record['start_ms'] / 1000
+                    record['first_token_ms'] = round(first_token * 1000)
+                    attempt_route.first_token_latencies.append(first_token)
+                    for other, (other_route, other_record, future) in enumerate(launched):
+                        if other != tag and not future.done():
+                            future.cancel()
+                            self.finish_attempt(other_route, other_record, 'cancelled', started)
+                yield item
+        finally:
+            for attempt_route, record, future in launched:
+                if not future.done():
+                    future.cancel()
+                    self.finish_attempt(attempt_route, record, 'cancelled', started)
+
+    def stats(self):
+        def to_ms(seconds):
+            return round(seconds * 1000) if seconds is not None else None
+
+        return {
+            route.name: {
+                'model': route.model,
+                'circuit': route.breaker.state,
+                'p95_ms': to_ms(route.p95(route.latencies)),
+                'first_token_p95_ms': to_ms(route.p95(route.first_token_latencies)),
+                'hedge_after_ms': to_ms(self.hedge_after(route))
+            }
+            for route in (self.primary, self.fallback) if route is not None
+        }
+
+def create_dispatcher(gateway):
+    primary = ModelRoute('primary', os.environ.get("CHAT_MODEL", "gpt-4o-mini"),
+                         os.environ.get("CHAT_BASE_URL"), os.environ.get("CHAT_API_KEY"))
+    fallback = None
+    if os.environ.get("FALLBACK_MODEL"):
+        fallback = ModelRoute('fallback', os.environ["FALLBACK_MODEL"],
+                              os.environ.get("FALLBACK_BASE_URL"), os.environ.get("FALLBACK_API_KEY"))
+    return CompletionDispatcher(
+        gateway, primary, fallback,
+        hedging=os.environ.get("LLM_HEDGING", "1") != "0",
+        hedge_delay=float(os.environ.get("LLM_HEDGE_DELAY", "3")),
+        hedge_min_delay=float(os.environ.get("LLM_HEDGE_MIN_DELAY", "0.5")),
+        hedge_ratio=float(os.environ.get("LLM_HEDGE_BUDGET", "0.1"))
+    )
 
-all_prompts = load_prompts()
+chat_dispatcher = create_dispatcher(llm)
+metrics.gauge('chat_llm_primary_circuit_open', 'Whether the primary model route is failing over',
+              lambda: int(chat_dispatcher.primary.breaker.state != 'closed'))
+
+# ================================
+# 上下文构建 - 按token预算打包历史
+# ================================
+
+class TokenCounter:
+    """Counts tokens with tiktoken when it is installed, otherwise estimates ~4 characters per token."""
+
+    message_overhead = 4
+
+    def __init__(self, model="gpt-4o-mini"):
+        self.encoding = None
+        if tiktoken is not None:
+            try:
+                self.encoding = tiktoken.encoding_for_model(model)
+            except Exception:
+                self.encoding = tiktoken.get_encoding("o200k_base")
+
+    def count(self, text):
+        if self.encoding is not None:
+            return len(self.encoding.encode(text))
+        return (len(text) + 3) // 4
+
+    def count_message(self, message):
+        return self.count(message['content']) + self.message_overhead
+
+
+class ContextBuilder:
+    """Packs the newest turns that fit the prompt budget; older turns live on as a running summary.
+
+    The summary is extractive and grows one line per folded turn, trimming its oldest lines once
+    it exceeds `summary_budget` tokens, so each request only does work for newly folded turns.
+    """
+
+    def __init__(self, counter, budget=4000, summary_budget=400, excerpt_words=30):
+        self.counter = counter
+        self.budget = budget
+        self.summary_budget = summary_budget
+        self.excerpt_words = excerpt_words
+
+    def excerpt(self, text):
+        words = text.split()
+        if len(words) <= self.excerpt_words:
+            return ' '.join(words)
+        return ' '.join(words[:self.excerpt_words]) + '...'
+
+    def fold(self, state, upto):
+        start = state.get('summarized', 0)
+        if upto <= start:
+            return
+        lines = state.get('summary', '').splitlines()
+        for user_msg, bot_reply in state['history'][start:upto]:
+            lines.append(f"- They said: {self.excerpt(user_msg)} / You said: {self.excerpt(bot_reply)}")
+        while len(lines) > 1 and self.counter.count('\n'.join(lines)) > self.summary_budget:
+            lines.pop(0)
+        state['summary'] = '\n'.join(lines)
+        state['summarized'] = upto
+
+    def summary_message(self, summary):
+        return {"role": "system", "content": "Summary of earlier parts of this conversation:\n" + summary}
+
+    def build(self, system_messages, state, message):
+        history = state['history']
+        user_message = {"role": "user", "content": message}
+        fixed_tokens = sum(self.counter.count_message(m) for m in system_messages) + self.counter.count_message(user_message)
+        summary_tokens = self.counter.count_message(self.summary_message(state['summary'])) if state.get('summary') else 0
+
+        packed = []
+        used = fixed_tokens + summary_tokens
+        for user_msg, bot_reply in reversed(history[state.get('summarized', 0):]):
+            turn_tokens = self.counter.count(user_msg) + self.counter.count(bot_reply) + 2 * self.counter.message_overhead
+            if used + turn_tokens > self.budget:
+                break
+            packed.append((user_msg, bot_reply, turn_tokens))
+            used += turn_tokens
+        packed.reverse()
+
+        # 折叠会让摘要变长：折叠后重新计量，超出预算就把最老的已装入轮次也折进摘要
+        first_packed = len(history) - len(packed)
+        while first_packed > state.get('summarized', 0):
+            self.fold(state, first_packed)
+            summary_tokens = self.counter.count_message(self.summary_message(state['summary'])) if state.get('summary') else 0
+            if not packed or fixed_tokens + summary_tokens + sum(turn[2] for turn in packed) <= self.budget:
+                break
+            packed.pop(0)
+            first_packed += 1
+
+        messages = list(system_messages)
+        if state.get('summary'):
+            messages.append(self.summary_message(state['summary']))
+        for user_msg, bot_reply, _ in packed:
+            messages.append({"role": "user", "content": user_msg})
+            messages.append({"role": "assistant", "content": bot_reply})
+        messages.append(user_message)
+
+        stats = {
+            'context_tokens': sum(self.counter.count_message(m) for m in messages),
+            'context_turns': len(packed),
+            'summarized_turns': state.get('summarized', 0)
+        }
+        return messages, stats
+
+token_counter = TokenCounter()
+context_builder = ContextBuilder(
+    token_counter,
+    budget=int(os.environ.get("CONTEXT_TOKEN_BUDGET", "4000")),
+    summary_budget=int(os.environ.get("CONTEXT_SUMMARY_TOKENS", "400"))
+)
+
+# ================================
+# 开场白回复缓存
+# ================================
+
+class ResponseCache:
+    """Caches replies to identical openers, keyed on persona, scene, history and message.
+
+    Each key holds a small pool of replies; until the pool is full every lookup is a miss so
+    new variants keep being generated, after which hits pick a random variant.
+    """
+
+    def __init__(self, enabled=False, max_entries=2000, ttl_seconds=3600, variants=3, max_history_turns=1):
+        self.enabled = enabled
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.variants = variants
+        self.max_history_turns = max_history_turns
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def normalize(text):
+        return ' '.join(re.sub(r"[^\w\s]", " ", text.lower()).split())
+
+    def make_key(self, student_id, scene_context, history, message):
+        # 只缓存对话开头几轮，长对话几乎不可能重复
+        if not self.enabled or len(history) > self.max_history_turns:
+            return None
+        normalized = [student_id, self.normalize(scene_context), self.normalize(message)]
+        for user_msg, bot_reply in history:
+            normalized += [self.normalize(user_msg), self.normalize(bot_reply)]
+        return hashlib.sha1(json.dumps(normalized).encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        if key is None:
+            return None
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] < time.time():
+                del self.entries[key]
+                entry = None
+            if entry is None or len(entry[1]) < self.variants:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return random.choice(entry[1])
+
+    def add(self, key, reply):
+        if key is None or not reply:
+            return
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                entry = self.entries[key] = (time.time() + self.ttl_seconds, [])
+            if len(entry[1]) < self.variants:
+                entry[1].append(reply)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'enabled': self.enabled,
+            'entries': len(self.entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0
+        }
+
+response_cache = ResponseCache(
+    enabled=os.environ.get("RESPONSE_CACHE_ENABLED", "false").lower() == "true",
+    max_entries=int(os.environ.get("RESPONSE_CACHE_SIZE", "2000")),
+    ttl_seconds=int(os.environ.get("RESPONSE_CACHE_TTL", "3600")),
+    variants=int(os.environ.get("RESPONSE_CACHE_VARIANTS", "3")),
+    max_history_turns=int(os.environ.get("RESPONSE_CACHE_MAX_HISTORY", "1"))
+)
+metrics.gauge('chat_response_cache_hits_total', 'Opener cache hits', lambda: response_cache.hits, 'counter')
+metrics.gauge('chat_response_cache_misses_total', 'Opener cache misses', lambda: response_cache.misses, 'counter')
+
+# ================================
+# 服务端会话状态存储
+# ================================
+
+class MemoryChatStateBackend:
+    """In-process LRU of chat states with a per-entry TTL."""
+
+    def __init__(self, max_entries=5000, ttl_seconds=6 * 3600):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            expires_at, state = entry
+            if expires_at < time.time():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return state
+
+    def set(self, key, state):
+        with self.lock:
+            self.entries[key] = (time.time() + self.ttl_seconds, state)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def delete(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+
+class SqliteChatStateBackend:
+    """Chat states in a local SQLite file so that every gunicorn worker sees the same history."""
+
+    def __init__(self, path='chat_state.db', max_entries=50000, ttl_seconds=6 * 3600, evict_every=200):
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.evict_every = evict_every
+        self.writes = 0
+        self.local = threading.local()
+        with self.connection() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS chat_state ("
+                "key TEXT PRIMARY KEY, state TEXT NOT NULL, updated_at REAL NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS chat_state_updated ON chat_state (updated_at)")
+
+    def connection(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = self.local.conn = connect_sqlite(self.path)
+        return conn
+
+    def get(self, key):
+        row = self.connection().execute(
+            "SELECT state FROM chat_state WHERE key = ? AND updated_at > ?",
+            (key, time.time() - self.ttl_seconds)
+        ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def set(self, key, state):
+        with self.connection() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO chat_state (key, state, updated_at) VALUES (?, ?, ?)",
+                (key, json.dumps(state, ensure_ascii=False), time.time())
+            )
+        self.writes += 1
+        if self.writes % self.evict_every == 0:
+            self.evict()
+
+    def delete(self, key):
+        with self.connection() as conn:
+            conn.execute("DELETE FROM chat_state WHERE key = ?", (key,))
+
+    def evict(self):
+        with self.connection() as conn:
+            conn.execute("DELETE FROM chat_state WHERE updated_at <= ?", (time.time() - self.ttl_seconds,))
+            conn.execute(
+                "DELETE FROM chat_state WHERE key IN ("
+                "SELECT key FROM chat_state ORDER BY updated_at DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,)
+            )
+
+
+class ChatStateStore:
+    """Per-session, per-student conversation state; the cookie only carries the session id."""
+
+    def __init__(self, backend, max_turns=40):
+        self.backend = backend
+        self.max_turns = max_turns
+
+    def key(self, session_id, student_id):
+        return f"{session_id}:{student_id}"
+
+    def get_state(self, session_id, student_id):
+        return self.backend.get(self.key(session_id, student_id)) or {'history': [], 'summary': '', 'summarized': 0}
+
+    def get_history(self, session_id, student_id):
+        return self.get_state(session_id, student_id)['history']
+
+    def append_turn(self, session_id, student_id, message, reply, state=None):
+        if state is None:
+            state = self.get_state(session_id, student_id)
+        state['history'] = state['history'] + [[message, reply]]
+        overflow = len(state['history']) - self.max_turns
+        if overflow > 0:
+            # 超出上限的旧轮次先并入摘要再丢弃
+            context_builder.fold(state, overflow)
+            state['history'] = state['history'][overflow:]
+            state['summarized'] -= overflow
+        self.backend.set(self.key(session_id, student_id), state)
+
+    def clear(self, session_id, student_id):
+        self.backend.delete(self.key(session_id, student_id))
+
+
+def create_chat_state_store():
+    ttl_seconds = int(os.environ.get("CHAT_STATE_TTL", str(6 * 3600)))
+    max_entries = int(os.environ.get("CHAT_STATE_MAX_ENTRIES", "5000"))
+    if os.environ.get("CHAT_STATE_BACKEND", "memory") == "sqlite":
+        backend = SqliteChatStateBackend(
+            os.environ.get("CHAT_STATE_DB", "chat_state.db"),
+            max_entries=max_entries,
+            ttl_seconds=ttl_seconds
+        )
+    else:
+        backend = MemoryChatStateBackend(max_entries=max_entries, ttl_seconds=ttl_seconds)
+    return ChatStateStore(backend, max_turns=int(os.environ.get("CHAT_HISTORY_MAX_TURNS", "40")))
+
+chat_states = create_chat_state_store()
+
+def get_chat_session_id():
+    chat_sid = session.get('chat_sid')
+    if not chat_sid:
+        chat_sid = session['chat_sid'] = str(uuid.uuid4())
+    return chat_sid
+
+# ================================
+# 静态资源 - 内容哈希与预压缩
+# ================================
+
+ASSET_DIST_DIR = os.path.join(app.static_folder, 'dist')
+ASSET_MANIFEST = os.path.join(ASSET_DIST_DIR, 'manifest.json')
+ASSET_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+_asset_manifest = None
+
+def load_asset_manifest():
+    # build_assets.py 生成；没跑构建时 url_for 保持原样
+    global _asset_manifest
+    if _asset_manifest is None:
+        try:
+            with open(ASSET_MANIFEST, 'r', encoding='utf-8') as f:
+                _asset_manifest = json.load(f)
+        except (OSError, ValueError):
+            _asset_manifest = {}
+    return _asset_manifest
+
+@app.template_global('url_for')
+def asset_url_for(endpoint, **values):
+    """url_for that resolves static files to their fingerprinted copy when one was built."""
+    if endpoint == 'static':
+        hashed = load_asset_manifest().get(values.get('filename'))
+        if hashed:
+            values['filename'] = hashed
+            return url_for('asset', **values)
+    return url_for(endpoint, **values)
+
+@app.route('/assets/<path:filename>')
+def asset(filename):
+    # 文件名带内容哈希，可以永久缓存；按 Accept-Encoding 选择预压缩版本
+    mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+    # 按 q 值挑选，q=0 表示明确拒绝；q 相同时优先 br
+    served, encoding, best = filename, None, 0
+    for suffix, name in (('.br', 'br'), ('.gz', 'gzip')):
+        quality = request.accept_encodings[name]
+        if quality > best and os.path.isfile(os.path.join(ASSET_DIST_DIR, filename + suffix)):
+            served, encoding, best = filename + suffix, name, quality
+
+    response = send_from_directory(ASSET_DIST_DIR, served, mimetype=mimetype, max_age=31536000)
+    if encoding:
+        response.headers['Content-Encoding'] = encoding
+    response.headers['Cache-Control'] = ASSET_CACHE_CONTROL
+    response.vary.add('Accept-Encoding')
+    return response
+
+# ================================
+# 头像图片 - 响应式缩略图
+# ================================
+
+AVATAR_VARIANT_MANIFEST = os.path.join(app.static_folder, 'images', 'avatar', 'variants', 'manifest.json')
+_avatar_manifest = None
+
+def load_avatar_manifest():
+    # build_assets.py 生成；没跑构建时退回原始 PNG
+    global _avatar_manifest
+    if _avatar_manifest is None:
+        try:
+            with open(AVATAR_VARIANT_MANIFEST, 'r', encoding='utf-8') as f:
+                _avatar_manifest = json.load(f)
+        except (OSError, ValueError):
+            _avatar_manifest = {}
+    return _avatar_manifest
+
+def avatar_variant_url(filename):
+    return asset_url_for('static', filename=f'images/avatar/variants/{filename}')
+
+def pick_variant(variants, width):
+    for variant in variants:
+        if variant['width'] >= width:
+            return variant
+    return variants[-1]
+
+@app.template_global()
+def avatar_url(name, display_width=80, fmt='webp'):
+    """Single best-fit URL for a 2x screen, for places that cannot use srcset (JS, favicon)."""
+    entry = load_avatar_manifest().get(name)
+    if not entry or not entry['variants'].get(fmt):
+        return asset_url_for('static', filename=f'images/avatar/{name}.png')
+    return avatar_variant_url(pick_variant(entry['variants'][fmt], display_width * 2)['file'])
+
+@app.template_global()
+def avatar_image(name, alt='', display_width=80, **attrs):
+    """Render a lazily loaded <picture> with AVIF/WebP srcsets and a resized PNG fallback."""
+    attrs.setdefault('loading', 'lazy')
+    attrs.setdefault('decoding', 'async')
+    extra = ''.join(f' {key.replace("_", "-")}="{escape(value)}"' for key, value in attrs.items())
+
+    entry = load_avatar_manifest().get(name)
+    if not entry:
+        src = asset_url_for('static', filename=f'images/avatar/{name}.png')
+        return Markup(f'<img src="{src}" alt="{escape(alt)}"{extra}>')
+
+    sizes = f'{display_width}px'
+    sources = ''
+    for fmt in ('avif', 'webp'):
+        variants = entry['variants'].get(fmt)
+        if variants:
+            srcset = ', '.join(f"{avatar_variant_url(v['file'])} {v['width']}w" for v in variants)
+            sources += f'<source type="image/{fmt}" srcset="{srcset}" sizes="{sizes}">'
+
+    fallback = pick_variant(entry['variants']['png'], display_width * 2)
+    height = round(display_width * entry['aspect'])
+    return Markup(
+        f'<picture>{sources}<img src="{avatar_variant_url(fallback["file"])}" alt="{escape(alt)}" '
+        f'width="{display_width}" height="{height}"{extra}></picture>'
+    )
+
+# ================================
+# 批量访谈 - 人物 × 场景网格
+# ================================
+
+BATCH_RUN_DIR = os.environ.get("BATCH_RUN_DIR", "batch_runs")
+
+def load_questionnaire(path):
+    """Read questions from a JSON list / {"questions": [...]} file or a text file, one per line."""
+    with open(path, 'r', encoding='utf-8') as f:
+        if path.endswith('.json'):
+            data = json.load(f)
+            questions = data['questions'] if isinstance(data, dict) else data
+        else:
+            questions = [line.strip() for line in f if line.strip() and not line.startswith('#')]
+    questions = [str(question).strip() for question in questions if str(question).strip()]
+    if not questions:
+        raise ValueError(f"No questions found in {path}")
+    return questions
+
+class BatchInterviewRun:
+    """One questionnaire asked of every persona in every scene.
+
+    Each persona × scene pair is an interview: the questions are asked in order with the
+    earlier answers as history. Every answer is appended to a JSONL checkpoint and logged
+    through the conversation monitor as soon as it arrives, so a failed or interrupted run
+    resumes from the checkpoint and only asks what is still missing.
+
+    mode='live' runs interviews on a bounded thread pool through the chat dispatcher;
+    mode='batch' submits one provider Batch API job per question round to the primary route's
+    endpoint, which is cheaper but can take up to the 24h completion window.
+    """
+
+    def __init__(self, run_id, questions, student_ids, scenes, mode='live', workers=8, model=None,
+                 run_dir=BATCH_RUN_DIR):
+        if mode not in ('live', 'batch'):
+            raise ValueError("mode must be 'live' or 'batch'")
+        unknown = [student_id for student_id in student_ids if student_id not in name_dict]
+        if unknown:
+            raise ValueError(f"Unknown student_ids: {', '.join(unknown)}")
+        self.run_id = run_id
+        self.questions = questions
+        self.student_ids = student_ids
+        self.scenes = scenes
+        self.mode = mode
+        self.workers = workers
+        # 模型和端点一起取自主路由（CHAT_MODEL / CHAT_BASE_URL），不会把模型名发到别家服务；
+        # 恢复运行时沿用检查点里记下的模型
+        self.model = model or chat_dispatcher.primary.model
+        self.checkpoint_path = os.path.join(run_dir, f"{run_id}.jsonl")
+        self.lock = threading.Lock()
+        self.answers = {}
+        self.provider_batches = {}
+        self.errors = {}
+        self.status = 'pending'
+        self.started_at = None
+        self.finished_at = None
+
+        os.makedirs(run_dir, exist_ok=True)
+        if os.path.exists(self.checkpoint_path):
+            self.load_checkpoint()
+        else:
+            self.write_checkpoint({'run': self.config()})
+
+    def config(self):
+        return {'run_id': self.run_id, 'questions': self.questions, 'student_ids': self.student_ids,
+                'scenes': self.scenes, 'mode': self.mode, 'model': self.model}
+
+    @classmethod
+    def resume(cls, run_id, workers=8, run_dir=BATCH_RUN_DIR):
+        with open(os.path.join(run_dir, f"{run_id}.jsonl"), 'r', encoding='utf-8') as f:
+            config = json.loads(f.readline())['run']
+        return cls(run_id, config['questions'], config['student_ids'], config['scenes'], mode=config['mode'],
+                   workers=workers, model=config['model'], run_dir=run_dir)
+
+    def load_checkpoint(self):
+        torn = False
+        with open(self.checkpoint_path, 'r', encoding='utf-8') as f:
+            for line in f:
+                torn = not line.endswith("\n")
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    # 进程在写入中途被杀时最后一行可能不完整，丢弃后重新提问即可
+                    continue
+                if 'answer' in entry:
+                    answers = self.answers.setdefault((entry['student_id'], entry['scene_index']), [])
+                    if entry['question_index'] == len(answers):
+                        answers.append(entry['answer'])
+                elif 'provider_batch' in entry:
+                    self.provider_batches[entry['question_index']] = entry['provider_batch']
+        if torn:
+            # 先补上换行，后续追加的记录才不会接在半行后面一起作废
+            with open(self.checkpoint_path, 'a', encoding='utf-8') as f:
+                f.write("\n")
+
+    def write_checkpoint(self, entry):
+        with self.lock:
+            with open(self.checkpoint_path, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+
+    def interviews(self):
+        return [(student_id, scene_index) for student_id in self.student_ids for scene_index in range(len(self.scenes))]
+
+    def done_count(self, interview):
+        return len(self.answers.get(interview, []))
+
+    def messages_for(self, interview, question_index):
+        student_id, scene_index = interview
+        messages = build_system_messages(student_id, self.scenes[scene_index])
+        for question, answer in zip(self.questions, self.answers.get(interview, [])[:question_index]):
+            messages.append({"role": "user", "content": question})
+            messages.append({"role": "assistant", "content": answer})
+        messages.append({"role": "user", "content": self.questions[question_index]})
+        return messages
+
+    def record(self, interview, question_index, reply, stats, response_time_ms):
+        student_id, scene_index = interview
+        self.write_checkpoint({'student_id': student_id, 'scene_index': scene_index,
+                               'question_index': question_index, 'answer': reply})
+        with self.lock:
+            self.answers.setdefault(interview, []).append(reply)
+        monitor.log_conversation(
+            student_id=student_id,
+            user_message=self.questions[question_index],
+            ai_response=reply,
+            scene_context=self.scenes[scene_index],
+            response_time_ms=response_time_ms,
+            session_id=f"batch-{self.run_id}-{student_id}-{scene_index}",
+            extra=dict(stats, batch_run=self.run_id, question_index=question_index)
+        )
+
+    def run_interview(self, interview):
+        for question_index in range(self.done_count(interview), len(self.questions)):
+            started = time.monotonic()
+            # 和网页聊天走同一个调度器：熔断、备用模型和各路由的端点配置都生效
+            response, attempts = chat_dispatcher.complete(messages=self.messages_for(interview, question_index),
+                                                          temperature=0.7, max_tokens=500)
+            reply = response.choices[0].message.content.strip()
+            stats = dict(usage_stats(response.usage), model=response.model, attempts=attempts)
+            self.record(interview, question_index, reply, stats, (time.monotonic() - started) * 1000)
+
+    def run_live(self):
+        pending = [interview for interview in self.interviews() if self.done_count(interview) < len(self.questions)]
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            futures = {interview: pool.submit(self.run_interview, interview) for interview in pending}
+            for interview, future in futures.items():
+                try:
+                    future.result()
+                except Exception as e:
+                    self.errors[interview] = describe_openai_error(e)
+
+    def run_provider_batches(self, poll_interval):
+        # 批处理接口没有备用路由可切换，固定发到主路由配置的端点
+        base_url, api_key = chat_dispatcher.primary.endpoint or (None, None)
+        client = openai.OpenAI(api_key=api_key or os.environ.get("OPENAI_API_KEY"), base_url=base_url or None,
+                               max_retries=5)
+        for question_index in range(len(self.questions)):
+            pending = [interview for interview in self.interviews()
+                       if self.done_count(interview) == question_index and interview not in self.errors]
+            if not pending:
+                continue
+            batch_id = self.provider_batches.get(question_index)
+            if batch_id is None:
+                # 一轮一个批次：第 k 个问题的请求需要前 k-1 个回答作为历史
+                lines = [json.dumps({
+                    'custom_id': f"{student_id}|{scene_index}|{question_index}",
+                    'method': 'POST',
+                    'url': '/v1/chat/completions',
+                    'body': {'model': self.model, 'messages': self.messages_for((student_id, scene_index), question_index),
+                             'temperature': 0.7, 'max_tokens': 500}
+                }, ensure_ascii=False) for student_id, scene_index in pending]
+                upload = client.files.create(file=(f"{self.run_id}-{question_index}.jsonl",
+                                                   ("\n".join(lines) + "\n").encode('utf-8')), purpose='batch')
+                batch_id = client.batches.create(input_file_id=upload.id, endpoint='/v1/chat/completions',
+                                                 completion_window='24h').id
+                self.provider_batches[question_index] = batch_id
+                self.write_checkpoint({'question_index': question_index, 'provider_batch': batch_id})
+
+            batch = client.batches.retrieve(batch_id)
+            while batch.status not in ('completed', 'failed', 'expired', 'cancelled'):
+                time.sleep(poll_interval)
+                batch = client.batches.retrieve(batch_id)
+            if not batch.output_file_id:
+                for interview in pending:
+                    self.errors[interview] = f"Provider batch {batch_id} ended with status {batch.status}"
+                continue
+
+            results = {}
+            for line in client.files.content(batch.output_file_id).text.splitlines():
+                if line.strip():
+                    item = json.loads(line)
+                    results[item['custom_id']] = item
+            for student_id, scene_index in pending:
+                item = results.get(f"{student_id}|{scene_index}|{question_index}")
+                response = (item or {}).get('response') or {}
+                if response.get('status_code') != 200:
+                    self.errors[(student_id, scene_index)] = str((item or {}).get('error') or 'Missing from batch output')
+                    continue
+                body = response['body']
+                usage = body.get('usage') or {}
+                stats = {'prompt_tokens': usage.get('prompt_tokens', 0),
+                         'completion_tokens': usage.get('completion_tokens', 0),
+                         'cached_tokens': (usage.get('prompt_tokens_details') or {}).get('cached_tokens', 0) or 0}
+                self.record((student_id, scene_index), question_index,
+                            body['choices'][0]['message']['content'].strip(), stats, 0)
+
+    def run(self, poll_interval=30):
+        self.status = 'running'
+        self.started_at = datetime.datetime.now().isoformat()
+        self.errors = {}
+        try:
+            if self.mode == 'batch':
+                self.run_provider_batches(poll_interval)
+            else:
+                self.run_live()
+        except Exception as e:
+            self.errors[('run', -1)] = describe_openai_error(e)
+        self.finished_at = datetime.datetime.now().isoformat()
+        self.status = 'failed' if self.errors else 'completed'
+        return self.status
+
+    def progress(self):
+        total = len(self.interviews()) * len(self.questions)
+        return {
+            'run_id': self.run_id,
+            'status': self.status,
+            'mode': self.mode,
+            'interviews': len(self.interviews()),
+            'questions': len(self.questions),
+            'answered': sum(self.done_count(interview) for interview in self.interviews()),
+            'total': total,
+            'errors': [{'student_id': student_id, 'scene_index': scene_index, 'error': error}
+                       for (student_id, scene_index), error in self.errors.items()],
+            'started_at': self.started_at,
+            'finished_at': self.finished_at,
+            'checkpoint': self.checkpoint_path
+        }
+
+BATCH_RUN_ID_PATTERN = re.compile(r'^[A-Za-z0-9_-]{1,64}$')
+
+def group_student_ids(key):
+    """student_ids for a student_groups key, e.g. "middle_adolescence" or "middle_adolescence.mental_health_issues"."""
+    group_key, _, subgroup_key = key.partition('.')
+    group = student_groups.get(group_key)
+    if group is None or (subgroup_key and subgroup_key not in group):
+        raise ValueError(f"Unknown student group: {key}")
+    subgroups = [group[subgroup_key]] if subgroup_key else [value for value in group.values() if isinstance(value, dict)]
+    return [student['id'] for subgroup in subgroups for student in subgroup['students']]
+
+def default_batch_scenes():
+    return [scene for scene in scene_options if scene != "Custom scenario"]
+
+def new_batch_run_id():
+    return datetime.datetime.now().strftime('%Y%m%d-%H%M%S-') + uuid.uuid4().hex[:6]
+
+batch_runs = {}
+
+# ================================
+# 请求耗时分解 - Server-Timing、慢请求日志与采样分析
+# ================================
+
+SERVER_TIMING_ENABLED = os.environ.get("SERVER_TIMING", "1") != "0"
+SLOW_REQUEST_MS = float(os.environ.get("SLOW_REQUEST_MS", "5000"))
+SLOW_REQUEST_LOG = os.environ.get("SLOW_REQUEST_LOG", "slow_requests.jsonl")
+PROFILE_DIR = os.environ.get("PROFILE_DIR", "profiles")
+PROFILE_NAME_PATTERN = re.compile(r'^[A-Za-z0-9_.-]+\.folded$')
+
+class RequestSpans:
+    """Durations of the named stages of one request, in the order they finished."""
+
+    def __init__(self):
+        self.spans = []
+
+    def add(self, name, seconds):
+        self.spans.append((name, seconds))
+
+    def totals(self):
+        # 同名阶段（例如一次广播里多次写存储）合并成一项
+        totals = {}
+        for name, seconds in self.spans:
+            totals[name] = totals.get(name, 0.0) + seconds
+        return totals
+
+    def header(self, extra=None):
+        totals = self.totals()
+        if extra:
+            totals.update(extra)
+        return ', '.join(f"{name};dur={seconds * 1000:.1f}" for name, seconds in totals.items())
+
+def current_spans():
+    if not has_request_context():
+        return None
+    if 'spans' not in g:
+        g.spans = RequestSpans()
+    return g.spans
+
+@contextlib.contextmanager
+def span(name):
+    """Time a block as one stage of the current request; a no-op outside a request."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        spans = current_spans()
+        if spans is not None:
+            spans.add(name, time.perf_counter() - started)
+
+
+class TimedSessionInterface(SecureCookieSessionInterface):
+    """Flask's signed-cookie sessions, with verification and signing recorded as spans.
+
+    The session is saved after every after_request hook has run, so save_session adds its
+    own Server-Timing header.
+    """
+
+    def open_session(self, app, request):
+        with span('session_open'):
+            return super().open_session(app, request)
+
+    def save_session(self, app, session, response):
+        started = time.perf_counter()
+        super().save_session(app, session, response)
+        elapsed = time.perf_counter() - started
+        spans = current_spans()
+        if spans is not None:
+            spans.add('session_save', elapsed)
+        if SERVER_TIMING_ENABLED and request.endpoint not in UNTIMED_ENDPOINTS:
+            response.headers.add('Server-Timing', f"session_save;dur={elapsed * 1000:.1f}")
+
+app.session_interface = TimedSessionInterface()
+
+
+class SamplingProfiler:
+    """Samples the call stacks of threads that are serving requests.
+
+    Off by default. The admin flag is a file under PROFILE_DIR so that every gunicorn worker
+    sees it; each worker checks for it at most once per second. Samples are kept per request
+    and folded into `frame;frame;frame count` lines, the input format of flamegraph.pl and
+    speedscope.
+    """
+
+    def __init__(self, profile_dir, interval=0.01, max_depth=64, check_interval=1.0):
+        self.profile_dir = profile_dir
+        self.interval = interval
+        self.max_depth = max_depth
+        self.check_interval = check_interval
+        self.enabled = False
+        self.checked_at = 0.0
+        self.threads = {}
+        self.lock = threading.Lock()
+        self.sampler = None
+
+    def flag_path(self):
+        return os.path.join(self.profile_dir, 'enabled')
+
+    def set_enabled(self, enabled):
+        os.makedirs(self.profile_dir, exist_ok=True)
+        if enabled:
+            with open(self.flag_path(), 'w', encoding='utf-8') as f:
+                f.write(datetime.datetime.now().isoformat())
+        elif os.path.exists(self.flag_path()):
+            os.remove(self.flag_path())
+        self.checked_at = 0.0
+        self.refresh()
+
+    def refresh(self):
+        now = time.monotonic()
+        if now - self.checked_at < self.check_interval:
+            return self.enabled
+        self.checked_at = now
+        self.enabled = os.path.exists(self.flag_path())
+        if self.enabled and (self.sampler is None or not self.sampler.is_alive()):
+            self.sampler = threading.Thread(target=self.run, name="request-profiler", daemon=True)
+            self.sampler.start()
+        return self.enabled
+
+    def start(self):
+        if not self.refresh():
+            return None
+        samples = {}
+        with self.lock:
+            self.threads[threading.get_ident()] = samples
+        return samples
+
+    def stop(self, samples):
+        # teardown 不一定和 start 在同一线程，按对象而不是线程 id 移除
+        with self.lock:
+            for ident, thread_samples in list(self.threads.items()):
+                if thread_samples is samples:
+                    del self.threads[ident]
+        return samples
+
+    def stack_key(self, frame):
+        names = []
+        while frame is not None and len(names) < self.max_depth:
+            code = frame.f_code
+            names.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+            frame = frame.f_back
+        return ';'.join(reversed(names))
+
+    def run(self):
+        # 只在开启期间运行；关闭后线程自然退出
+        while self.enabled:
+            time.sleep(self.interval)
+            with self.lock:
+                threads = list(self.threads.items())
+            if not threads:
+                continue
+            frames = sys._current_frames()
+            for ident, samples in threads:
+                frame = frames.get(ident)
+                if frame is not None:
+                    key = self.stack_key(frame)
+                    samples[key] = samples.get(key, 0) + 1
+            del frames
+
+    def save(self, samples, label):
+        os.makedirs(self.profile_dir, exist_ok=True)
+        name = f"{datetime.datetime.now().strftime('%Y%m%d-%H%M%S')}-{label}-{uuid.uuid4().hex[:6]}.folded"
+        with open(os.path.join(self.profile_dir, name), 'w', encoding='utf-8') as f:
+            for stack, count in sorted(samples.items(), key=lambda item: -item[1]):
+                f.write(f"{stack} {count}\n")
+        return name
+
+    def profiles(self, limit=50):
+        if not os.path.isdir(self.profile_dir):
+            return []
+        names = sorted((name for name in os.listdir(self.profile_dir) if name.endswith('.folded')), reverse=True)
+        return names[:limit]
+
+profiler = SamplingProfiler(PROFILE_DIR, interval=float(os.environ.get("PROFILE_INTERVAL_MS", "10")) / 1000)
+slow_log_lock = threading.Lock()
+
+def log_slow_request(duration, status, spans, profile=None):
+    entry = {
+        'timestamp': datetime.datetime.now().isoformat(),
+        'method': request.method,
+        'path': request.path,
+        'endpoint': request.endpoint,
+        'status': status,
+        'duration_ms': round(duration * 1000, 1),
+        'spans_ms': {name: round(seconds * 1000, 1) for name, seconds in spans.totals().items()},
+        'profile': profile
+    }
+    try:
+        with slow_log_lock, open(SLOW_REQUEST_LOG, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+    except OSError as e:
+        print(f"Error writing slow request log: {e}")
+    print(f"Slow request: {request.method} {request.path} {entry['duration_ms']:.0f}ms {entry['spans_ms']}")
 
 # ================================
 # Flask路由定义
 # ================================
 
+UNTIMED_ENDPOINTS = (None, 'static', 'asset', 'metrics_endpoint')
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+    g.profile_samples = profiler.start() if request.endpoint not in UNTIMED_ENDPOINTS else None
+    if request.endpoint == 'send_message':
+        with chats_in_progress['lock']:
+            chats_in_progress['count'] += 1
+
+@app.teardown_request
+def finish_request_timer(error=None):
+    # 流式响应的 teardown 在流结束后才触发，因此时长包含整个回复
+    if 'request_started' not in g:
+        return
+    if request.endpoint == 'send_message':
+        with chats_in_progress['lock']:
+            chats_in_progress['count'] -= 1
+    samples = g.get('profile_samples')
+    if samples is not None:
+        profiler.stop(samples)
+    if request.endpoint in UNTIMED_ENDPOINTS:
+        return
+    duration = time.perf_counter() - g.request_started
+    status = g.get('response_status', 500 if error else 200)
+    http_request_seconds.observe(duration, endpoint=request.endpoint, status=status)
+    if duration * 1000 >= SLOW_REQUEST_MS:
+        # 只有慢请求才把采样结果写盘
+        profile = profiler.save(samples, request.endpoint) if samples else None
+        log_slow_request(duration, status, current_spans(), profile)
+
+@app.after_request
+def record_response_status(response):
+    g.response_status = response.status_code
+    if SERVER_TIMING_ENABLED and request.endpoint not in UNTIMED_ENDPOINTS:
+        # 流式响应的头在回复开始前就发出，只包含到这一刻为止的阶段；完整分解见慢请求日志
+        elapsed = time.perf_counter() - g.get('request_started', time.perf_counter())
+        response.headers.add('Server-Timing', current_spans().header({'app': elapsed}))
+    return response
+
+@app.route('/metrics')
+def metrics_endpoint():
+    token = os.environ.get("METRICS_TOKEN")
+    if token and request.headers.get('Authorization') != f'Bearer {token}':
+        return Response('unauthorized\n', status=401, mimetype='text/plain')
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
 @app.route('/')
 def index():
     return render_template('index.html', student_groups=student_groups)
@@ -485,69 +3529,277 @@ def send_message():
 
         if not message:
             return jsonify({'error': 'Empty message'}), 400
+        # student_id 会成为指标的标签，只接受已知人物，避免客户端随意制造新的时间序列
+        if student_id not in name_dict:
+            return jsonify({'error': f'Unknown student_id: {student_id}'}), 400
 
         if not os.environ.get("OPENAI_API_KEY"):
             return jsonify({'error': 'OpenAI API key not configured'}), 500
 
-        base_prompt = all_prompts.get(student_id, "You are a helpful assistant.")
-        if scene_context:
-            system_prompt = base_prompt + f"\n\nCurrent scenario context: {scene_context}"
-        else:
-            system_prompt = base_prompt
+        chat_sid = get_chat_session_id()
+        with span('admission'):
+            admit_chat_request(chat_sid)
+        with span('chat_state'):
+            chat_state = chat_states.get_state(chat_sid, student_id)
+        with span('prompt'):
+            messages, context_stats = context_builder.build(
+                build_system_messages(student_id, scene_context), chat_state, message
+            )
+        with span('response_cache'):
+            # 人设文件热更新后旧版本的缓存回复不再命中
+            cache_key = response_cache.make_key(f"{student_id}@{prompt_registry.version(student_id)}", scene_context,
+                                                chat_state['history'], message)
+            cached_reply = response_cache.get(cache_key)
+
+        turn = {
+            'chat_sid': chat_sid,
+            'chat_state': chat_state,
+            'student_id': student_id,
+            'message': message,
+            'scene_context': scene_context,
+            'cache_key': cache_key,
+            'stats': context_stats
+        }
 
-        chat_history = session.get(f'history_{student_id}', [])
+        if cached_reply is not None:
+            context_stats['cached_response'] = True
+            if data.get('stream'):
+                return stream_response(stream_cached_reply(turn, cached_reply))
+            return jsonify(finish_turn(turn, cached_reply, 0))
 
-        messages = [{"role": "system", "content": system_prompt}]
-        for user_msg, bot_reply in chat_history[-10:]:
-            messages.append({"role": "user", "content": user_msg})
-            messages.append({"role": "assistant", "content": bot_reply})
-        messages.append({"role": "user", "content": message})
+        if data.get('stream'):
+            return stream_response(stream_chat_reply(turn, messages))
 
         start_time = datetime.datetime.now()
-        response = client.chat.completions.create(
-            model="gpt-4o-mini",
+        with span('openai'):
+            response, attempts = chat_dispatcher.complete(
+                messages=messages,
+                temperature=0.7,
+                max_tokens=500
+            )
+        reply = response.choices[0].message.content.strip()
+        response_time_ms = (datetime.datetime.now() - start_time).total_seconds() * 1000
+        context_stats.update(usage_stats(response.usage), model=response.model, attempts=attempts)
+
+        return jsonify(finish_turn(turn, reply, response_time_ms))
+
+    except AdmissionRejected as e:
+        return too_many_requests(str(e), e.retry_after, e.reason)
+    except openai.RateLimitError as e:
+        if getattr(e, 'code', None) == 'insufficient_quota':
+            return jsonify({'error': describe_openai_error(e)}), 500
+        headers = getattr(getattr(e, 'response', None), 'headers', None) or {}
+        return too_many_requests(describe_openai_error(e), math.ceil(provider_retry_after(headers) or 5), 'provider')
+    except Exception as e:
+        return jsonify({'error': describe_openai_error(e)}), 500
+
+def finish_turn(turn, reply, response_time_ms):
+    # 回复完成后：写入会话状态、缓存、对话日志，返回给前端的结果
+    stats = turn['stats']
+    prompt_tokens_total.inc(stats.get('prompt_tokens', 0), student_id=turn['student_id'])
+    completion_tokens_total.inc(stats.get('completion_tokens', 0), student_id=turn['student_id'])
+    cached_tokens_total.inc(stats.get('cached_tokens', 0), student_id=turn['student_id'])
+    with span('chat_state_save'):
+        chat_states.append_turn(turn['chat_sid'], turn['student_id'], turn['message'], reply, state=turn['chat_state'])
+    if not stats.get('cached_response'):
+        response_cache.add(turn['cache_key'], reply)
+
+    monitor.log_conversation(
+        student_id=turn['student_id'],
+        user_message=turn['message'],
+        ai_response=reply,
+        scene_context=turn['scene_context'],
+        response_time_ms=response_time_ms,
+        session_id=turn['chat_sid'],
+        extra=stats
+    )
+
+    return {
+        'success': True,
+        'reply': reply,
+        'student_name': name_dict.get(turn['student_id'], 'Student'),
+        'context_tokens': stats['context_tokens']
+    }
+
+def build_system_messages(student_id, scene_context):
+    # 共享提示+人物设定放在最前面且保持逐字节不变，场景单独成条，
+    # 这样切换场景或换用户时仍能命中服务端的 prompt cache
+    messages = [{"role": "system", "content": prompt_registry.get(student_id)}]
+    if scene_context:
+        messages.append({"role": "system", "content": f"Current scenario context: {scene_context}"})
+    return messages
+
+def usage_stats(usage):
+    if usage is None:
+        return {}
+    details = getattr(usage, 'prompt_tokens_details', None)
+    return {
+        'prompt_tokens': usage.prompt_tokens,
+        'completion_tokens': usage.completion_tokens,
+        'cached_tokens': (getattr(details, 'cached_tokens', 0) or 0) if details else 0
+    }
+
+def describe_openai_error(e):
+    error_msg = str(e)
+    if isinstance(e, AdmissionRejected):
+        return error_msg
+    if "insufficient_quota" in error_msg:
+        return "OpenAI API quota exceeded. Please check your API usage."
+    elif "invalid_api_key" in error_msg:
+        return "Invalid OpenAI API key. Please check configuration."
+    elif "rate_limit" in error_msg:
+        return "API rate limit exceeded. Please try again in a moment."
+    return f"Service temporarily unavailable: {error_msg}"
+
+def sse_event(payload):
+    return f"data: {json.dumps(payload, ensure_ascii=False)}\n\n"
+
+def stream_response(events):
+    return Response(
+        stream_with_context(events),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
+def stream_chat_reply(turn, messages):
+    # 逐个token转发OpenAI的增量输出，结束后再记录完整回复
+    start_time = datetime.datetime.now()
+    parts = []
+    turn['stats']['attempts'] = []
+    try:
+        stream = chat_dispatcher.stream(
+            turn['stats']['attempts'],
             messages=messages,
             temperature=0.7,
-            max_tokens=500
+            max_tokens=500,
+            stream_options={"include_usage": True}
         )
-        reply = response.choices[0].message.content.strip()
-        response_time_ms = (datetime.datetime.now() - start_time).total_seconds() * 1000
+        # 包含把增量写给浏览器的时间
+        with span('openai_stream'):
+            for chunk in stream:
+                if getattr(chunk, 'usage', None):
+                    turn['stats'].update(usage_stats(chunk.usage), model=chunk.model)
+                if not chunk.choices:
+                    continue
+                delta = chunk.choices[0].delta.content
+                if delta:
+                    parts.append(delta)
+                    yield sse_event({'delta': delta})
+    except Exception as e:
+        yield sse_event({'error': describe_openai_error(e)})
+        return
 
-        chat_history.append([message, reply])
-        session[f'history_{student_id}'] = chat_history
+    reply = ''.join(parts).strip()
+    response_time_ms = (datetime.datetime.now() - start_time).total_seconds() * 1000
+    yield sse_event(dict(finish_turn(turn, reply, response_time_ms), done=True))
 
-        monitor.log_conversation(
-            student_id=student_id,
-            user_message=message,
-            ai_response=reply,
-            scene_context=scene_context,
-            response_time_ms=response_time_ms
+def stream_cached_reply(turn, reply):
+    yield sse_event({'delta': reply})
+    yield sse_event(dict(finish_turn(turn, reply, 0), done=True))
+
+BROADCAST_CONCURRENCY = int(os.environ.get("BROADCAST_CONCURRENCY", "10"))
+
+@app.route('/api/broadcast', methods=['POST'])
+def broadcast_message():
+    """Ask several personas the same question at once and stream each reply as it finishes."""
+    if not request.is_json:
+        return jsonify({'error': 'Content-Type must be application/json'}), 400
+
+    data = request.json
+    message = data.get('message', '').strip()
+    scene_context = data.get('scene_context', '')
+    if not message:
+        return jsonify({'error': 'Empty message'}), 400
+    if not os.environ.get("OPENAI_API_KEY"):
+        return jsonify({'error': 'OpenAI API key not configured'}), 500
+
+    try:
+        student_ids = data.get('student_ids') or (group_student_ids(data['group']) if data.get('group') else [])
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    student_ids = list(dict.fromkeys(student_ids))
+    unknown = [student_id for student_id in student_ids if student_id not in name_dict]
+    if unknown or not student_ids:
+        return jsonify({'error': f"Unknown student_ids: {', '.join(unknown)}" if unknown else 'No students selected'}), 400
+
+    chat_sid = get_chat_session_id()
+    try:
+        # 广播一次发出 N 个补全：会话只扣一次，IP 按 N 次扣
+        admit_chat_request(chat_sid, len(student_ids))
+    except AdmissionRejected as e:
+        return too_many_requests(str(e), e.retry_after, e.reason)
+
+    turns = []
+    for student_id in student_ids:
+        chat_state = chat_states.get_state(chat_sid, student_id)
+        messages, context_stats = context_builder.build(
+            build_system_messages(student_id, scene_context), chat_state, message
         )
+        turns.append(({
+            'chat_sid': chat_sid,
+            'chat_state': chat_state,
+            'student_id': student_id,
+            'message': message,
+            'scene_context': scene_context,
+            'cache_key': response_cache.make_key(f"{student_id}@{prompt_registry.version(student_id)}", scene_context,
+                                                 chat_state['history'], message),
+            'stats': context_stats
+        }, messages))
+    return stream_response(stream_broadcast(turns))
 
-        return jsonify({
-            'success': True,
-            'reply': reply,
-            'student_name': name_dict.get(student_id, 'Student')
-        })
+def stream_broadcast(turns):
+    # 同时发出最多 BROADCAST_CONCURRENCY 个请求，谁先完成先推给前端，总耗时接近最慢的一个
+    started = time.monotonic()
+    pending = list(turns)
+    running = {}
 
-    except Exception as e:
-        error_msg = str(e)
-        if "insufficient_quota" in error_msg:
-            user_error = "OpenAI API quota exceeded. Please check your API usage."
-        elif "invalid_api_key" in error_msg:
-            user_error = "Invalid OpenAI API key. Please check configuration."
-        elif "rate_limit" in error_msg:
-            user_error = "API rate limit exceeded. Please try again in a moment."
+    def submit_next():
+        turn, messages = pending.pop(0)
+        cached_reply = response_cache.get(turn['cache_key'])
+        future = concurrent.futures.Future()
+        if cached_reply is not None:
+            turn['stats']['cached_response'] = True
+            future.set_result(cached_reply)
         else:
-            user_error = f"Service temporarily unavailable: {error_msg}"
+            future = chat_dispatcher.submit(messages=messages, temperature=0.7, max_tokens=500)
+        future.add_done_callback(lambda f: setattr(f, 'finished_at', time.monotonic()))
+        running[future] = (turn, time.monotonic())
 
-        return jsonify({'error': user_error}), 500
+    while pending and len(running) < BROADCAST_CONCURRENCY:
+        submit_next()
+    try:
+        while running:
+            with span('openai'):
+                done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                turn, submitted_at = running.pop(future)
+                if pending:
+                    submit_next()
+                try:
+                    result = future.result()
+                except Exception as e:
+                    yield sse_event({'student_id': turn['student_id'], 'error': describe_openai_error(e)})
+                    continue
+                if isinstance(result, str):
+                    reply, response_time_ms = result, 0
+                else:
+                    response, attempts = result
+                    reply = response.choices[0].message.content.strip()
+                    response_time_ms = (getattr(future, 'finished_at', time.monotonic()) - submitted_at) * 1000
+                    turn['stats'].update(usage_stats(response.usage), model=response.model, attempts=attempts)
+                yield sse_event(dict(finish_turn(turn, reply, response_time_ms),
+                                     student_id=turn['student_id'], response_time_ms=round(response_time_ms)))
+    finally:
+        # 浏览器中途断开时不再等待剩下的回复
+        for future in running:
+            future.cancel()
+    yield sse_event({'done': True, 'elapsed_ms': round((time.monotonic() - started) * 1000)})
 
 @app.route('/api/clear_chat', methods=['POST'])
 def clear_chat():
     data = request.json
     student_id = data.get('student_id', 'student001')
-    session[f'history_{student_id}'] = []
+    chat_states.clear(get_chat_session_id(), student_id)
     return jsonify({'success': True})
 
 @app.route('/api/test')
@@ -556,6 +3808,8 @@ def test_api():
         'status': 'ok',
         'openai_configured': bool(os.environ.get("OPENAI_API_KEY")),
         'secret_key_configured': bool(os.environ.get("SECRET_KEY")),
+        'response_cache': response_cache.stats(),
+        'models': chat_dispatcher.stats(),
         'timestamp': datetime.datetime.now().isoformat()
     })
 
@@ -563,8 +3817,9 @@ def test_api():
 # 管理员路由 (保持之前的代码)
 # ================================
 
-def generate_admin_dashboard_html(analytics_data):
-    html_content = '''<!DOCTYPE html>
+def generate_admin_dashboard_html():
+    # 页面本身不含数据，图表和统计由浏览器从 /admin/api/analytics 拉取后渲染
+    return """<!DOCTYPE html>
 <html>
 <head>
     <title>Conversation Monitor</title>
@@ -586,7 +3841,10 @@ def generate_admin_dashboard_html(analytics_data):
         th, td { padding: 12px; text-align: left; border-bottom: 1px solid #ddd; }
         th { background-color: #f8f9fa; font-weight: bold; }
         .message-preview { max-width: 300px; overflow: hidden; text-overflow: ellipsis; white-space: nowrap; }
+        .chart { height: 320px; }
+        .live { color: #888; font-size: 0.9em; }
     </style>
+    <script src="/admin/static/plotly.min.js"></script>
 </head>
 <body>
     <div class="container">
@@ -595,64 +3853,206 @@ def generate_admin_dashboard_html(analytics_data):
             <p>Clean data - only actual conversations tracked</p>
             <a href="/admin/logout" class="btn logout">Logout</a>
         </div>
-        
+
         <div class="card">
             <h2>Overview Statistics</h2>
             <div class="stats">
-                <div class="stat-item">
-                    <div class="stat-number">''' + str(analytics_data['total_conversations']) + '''</div>
-                    <div>Total Conversations</div>
-                </div>
-                <div class="stat-item">
-                    <div class="stat-number">''' + str(analytics_data['unique_students']) + '''</div>
-                    <div>Students Chatted With</div>
-                </div>
-                <div class="stat-item">
-                    <div class="stat-number">''' + str(analytics_data['recent_conversations']) + '''</div>
-                    <div>Last 24h Conversations</div>
-                </div>
-                <div class="stat-item">
-                    <div class="stat-number">''' + str(analytics_data['most_active_student']) + '''</div>
-                    <div>Most Active Student</div>
-                </div>
+                <div class="stat-item"><div class="stat-number" id="total_conversations">-</div><div>Total Conversations</div></div>
+                <div class="stat-item"><div class="stat-number" id="unique_students">-</div><div>Students Chatted With</div></div>
+                <div class="stat-item"><div class="stat-number" id="recent_conversations">-</div><div>Last 24h Conversations</div></div>
+                <div class="stat-item"><div class="stat-number" id="most_active_student">-</div><div>Most Active Student</div></div>
+                <div class="stat-item"><div class="stat-number" id="cache_hit_rate">-</div><div>Prompt Cache Hit Rate</div></div>
             </div>
         </div>
-        
+
         <div class="card">
             <h2>Student Activity</h2>
-            <div class="student-stats">'''
+            <div id="student_chart" class="chart"></div>
+            <div class="student-stats" id="student_stats"></div>
+        </div>
 
-    for student, stats in analytics_data['student_stats'].items():
-        html_content += f'''
-                <div class="student-card">
-                    <h4>{student}</h4>
-                    <p><strong>Conversations:</strong> {stats['total_conversations']}</p>
-                    <p><strong>Avg Response Time:</strong> {stats['avg_response_time']:.0f}ms</p>
-                </div>'''
+        <div class="card">
+            <h2>Conversations by Hour</h2>
+            <div id="hourly_chart" class="chart"></div>
+        </div>
 
-    html_content += '''
-            </div>
+        <div class="card">
+            <h2>New Conversations <span class="live" id="live_status"></span></h2>
+            <table>
+                <thead><tr><th>Time</th><th>Student</th><th>Scene</th><th>Message</th><th>Response ms</th></tr></thead>
+                <tbody id="feed"></tbody>
+            </table>
         </div>
-        
+
+        <div class="card">
+            <h2>Search Conversations</h2>
+            <form action="/admin/search" method="get">
+                <input type="text" name="q" placeholder='vaping OR "left out"' style="padding: 10px; width: 60%;">
+                <button type="submit" class="btn">Search</button>
+            </form>
+        </div>
+
         <div class="card">
             <h2>Data Export</h2>
-            <p>Export conversation data for analysis:</p>
+            <p>Export conversation data for analysis. Add <code>?student_id=&amp;start=YYYY-MM-DD&amp;end=YYYY-MM-DD&amp;scene=</code> to export a subset.</p>
             <a href="/admin/export/csv" class="btn">Download CSV</a>
+            <a href="/admin/export/parquet" class="btn">Download Parquet</a>
             <a href="/admin/data/raw" class="btn">View Raw JSON</a>
         </div>
     </div>
+    <script>
+    let version = null;
+
+    function setText(id, value) {
+        document.getElementById(id).textContent = value;
+    }
+
+    function cell(row, value, className) {
+        const td = row.insertCell();
+        td.textContent = value;
+        if (className) td.className = className;
+    }
+
+    function render(data) {
+        setText('total_conversations', data.total_conversations);
+        setText('unique_students', data.unique_students);
+        setText('recent_conversations', data.recent_conversations);
+        setText('most_active_student', data.most_active_student);
+        setText('cache_hit_rate', Math.round(data.cache_hit_rate * 100) + '%');
+
+        const students = Object.keys(data.student_stats);
+        const cards = document.getElementById('student_stats');
+        cards.replaceChildren();
+        for (const student of students) {
+            const stats = data.student_stats[student];
+            const card = document.createElement('div');
+            card.className = 'student-card';
+            const title = document.createElement('h4');
+            title.textContent = student;
+            const detail = document.createElement('p');
+            detail.textContent = stats.total_conversations + ' conversations, avg ' + Math.round(stats.avg_response_time) + 'ms';
+            card.append(title, detail);
+            cards.append(card);
+        }
+
+        // plotly 加载失败时只显示上面的数字和卡片
+        if (!window.Plotly) return;
+        Plotly.react('student_chart', [{
+            type: 'bar', x: students, y: students.map(s => data.student_stats[s].total_conversations), marker: {color: '#4a90e2'}
+        }], {margin: {t: 10}, yaxis: {title: 'Conversations'}}, {displayModeBar: false, responsive: true});
+        const hours = [...Array(24).keys()];
+        Plotly.react('hourly_chart', [{
+            type: 'bar', x: hours, y: hours.map(h => data.hourly_distribution[h] || 0), marker: {color: '#4a90e2'}
+        }], {margin: {t: 10}, xaxis: {title: 'Hour', dtick: 2}, yaxis: {title: 'Conversations'}}, {displayModeBar: false, responsive: true});
+    }
+
+    async function loadAnalytics() {
+        // 浏览器会自动带上 If-None-Match，数据没变时服务器只回 304
+        const response = await fetch('/admin/api/analytics', {cache: 'no-cache'});
+        if (response.status === 401) { window.location = '/admin/login'; return; }
+        const data = await response.json();
+        version = data.version;
+        render(data);
+    }
+
+    function addToFeed(conversations) {
+        const feed = document.getElementById('feed');
+        for (const conv of conversations) {
+            const row = feed.insertRow(0);
+            cell(row, new Date(conv.timestamp).toLocaleString());
+            cell(row, conv.student_name);
+            cell(row, conv.scene_context || '');
+            cell(row, conv.user_message, 'message-preview');
+            cell(row, conv.response_time_ms);
+        }
+        while (feed.rows.length > 50) feed.deleteRow(-1);
+    }
+
+    async function follow() {
+        // 长轮询：没有新对话时服务器挂起请求，有新对话立即返回
+        while (true) {
+            try {
+                setText('live_status', '(live)');
+                const response = await fetch('/admin/api/feed?since=' + (version || 0));
+                if (response.status === 401) { window.location = '/admin/login'; return; }
+                const data = await response.json();
+                if (data.conversations.length) {
+                    addToFeed(data.conversations);
+                    await loadAnalytics();
+                }
+                version = data.version;
+            } catch (e) {
+                setText('live_status', '(reconnecting)');
+                await new Promise(resolve => setTimeout(resolve, 5000));
+            }
+        }
+    }
+
+    loadAnalytics().then(follow);
+    </script>
 </body>
-</html>'''
+</html>"""
 
-    return html_content
+ADMIN_DASHBOARD_HTML = generate_admin_dashboard_html()
+ADMIN_DASHBOARD_ETAG = hashlib.sha256(ADMIN_DASHBOARD_HTML.encode('utf-8')).hexdigest()[:16]
+
+FEED_TIMEOUT = 25.0
+FEED_FIELDS = ('id', 'timestamp', 'student_id', 'student_name', 'scene_context', 'user_message', 'response_time_ms')
+
+def conditional_response(body, etag, mimetype):
+    # 带 ETag 返回；客户端 If-None-Match 命中时变成 304，不再传输正文
+    response = Response(body, mimetype=mimetype)
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response.make_conditional(request)
 
 @app.route('/admin')
 def admin_dashboard():
     if session.get('admin_authenticated') != True:
         return redirect('/admin/login')
+    return conditional_response(ADMIN_DASHBOARD_HTML, ADMIN_DASHBOARD_ETAG, 'text/html')
+
+@app.route('/admin/api/analytics')
+def analytics_api():
+    if session.get('admin_authenticated') != True:
+        return jsonify({'error': 'Admin login required'}), 401
+    etag, body = monitor.analytics_json()
+    return conditional_response(body, etag, 'application/json')
+
+@app.route('/admin/api/feed')
+def conversation_feed():
+    if session.get('admin_authenticated') != True:
+        return jsonify({'error': 'Admin login required'}), 401
+    try:
+        since = int(request.args.get('since', 0))
+        timeout = min(max(float(request.args.get('timeout', FEED_TIMEOUT)), 0), FEED_TIMEOUT)
+    except ValueError:
+        return jsonify({'error': 'since must be an integer and timeout a number'}), 400
+
+    version, conversations = monitor.wait_for_conversations(since, timeout=timeout)
+    return jsonify({
+        'version': version,
+        'conversations': [{key: conv.get(key) for key in FEED_FIELDS} for conv in conversations]
+    })
+
+@app.route('/admin/static/plotly.min.js')
+def plotly_js():
+    if session.get('admin_authenticated') != True:
+        return '', 401
+    # 直接用 requirements.txt 里 plotly 包自带的 plotly.js，不依赖外部 CDN
+    try:
+        import plotly
+        from plotly.offline import get_plotlyjs
+    except ImportError:
+        return '', 404
+    response = conditional_response(get_plotlyjs(), f"plotly-{plotly.__version__}", 'application/javascript')
+    response.headers['Cache-Control'] = 'private, max-age=86400'
+    return response
 
-    analytics_data = monitor.get_analytics_dashboard_data()
-    return generate_admin_dashboard_html(analytics_data)
+@app.route('/admin/logout')
+def admin_logout():
+    session.pop('admin_authenticated', None)
+    return redirect('/admin/login')
 
 @app.route('/admin/login', methods=['GET', 'POST'])
 def admin_login():
@@ -697,3 +4097,292 @@ def admin_login():
     </div>
 </body>
 </html>'''
+
+    return login_html
+
+def export_filters_from_request():
+    return {
+        'student_id': request.args.get('student_id') or None,
+        'start': request.args.get('start') or None,
+        'end': request.args.get('end') or None,
+        'scene_context': request.args.get('scene') or None,
+        'session_id': request.args.get('session_id') or None
+    }
+
+def export_filename(extension):
+    return f"conversations_{datetime.datetime.now().strftime('%Y%m%d_%H%M%S')}.{extension}"
+
+@app.route('/admin/export/csv')
+def export_csv():
+    if session.get('admin_authenticated') != True:
+        return redirect('/admin/login')
+
+    try:
+        filters = export_filters_from_request()
+        parse_date_filter(filters['start'])
+        parse_date_filter(filters['end'], end=True)
+    except ValueError as e:
+        return jsonify({'error': f'Invalid date filter: {e}'}), 400
+
+    return Response(
+        stream_with_context(monitor.iter_csv_export(**filters)),
+        mimetype='text/csv',
+        headers={'Content-Disposition': f'attachment; filename={export_filename("csv")}'}
+    )
+
+@app.route('/admin/export/parquet')
+def export_parquet():
+    if session.get('admin_authenticated') != True:
+        return redirect('/admin/login')
+
+    try:
+        content = monitor.export_to_parquet(**export_filters_from_request())
+    except ValueError as e:
+        return jsonify({'error': f'Invalid date filter: {e}'}), 400
+    except ImportError:
+        return jsonify({'error': 'Parquet export requires pyarrow to be installed'}), 500
+
+    return Response(
+        content,
+        mimetype='application/vnd.apache.parquet',
+        headers={'Content-Disposition': f'attachment; filename={export_filename("parquet")}'}
+    )
+
+QUERY_PAGE_SIZE = 50
+QUERY_MAX_PAGE_SIZE = 500
+
+@app.route('/admin/api/conversations')
+@app.route('/admin/data/raw')
+def query_conversations():
+    if session.get('admin_authenticated') != True:
+        return jsonify({'error': 'Admin login required'}), 401
+
+    try:
+        limit = min(max(int(request.args.get('limit', QUERY_PAGE_SIZE)), 1), QUERY_MAX_PAGE_SIZE)
+        order = request.args.get('order', 'desc')
+        if order not in ('asc', 'desc'):
+            raise ValueError("order must be 'asc' or 'desc'")
+        page, next_cursor = monitor.query_conversations(
+            limit=limit, cursor=request.args.get('cursor') or None, order=order, **export_filters_from_request()
+        )
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    return jsonify({
+        'conversations': page,
+        'count': len(page),
+        'next_cursor': next_cursor
+    })
+
+SEARCH_PAGE_SIZE = 20
+
+def search_params_from_request():
+    return {
+        'query': request.args.get('q', ''),
+        'field': request.args.get('field') or None,
+        'student_id': request.args.get('student_id') or None,
+        'start': request.args.get('start') or None,
+        'end': request.args.get('end') or None,
+        'limit': min(max(int(request.args.get('limit', SEARCH_PAGE_SIZE)), 1), QUERY_MAX_PAGE_SIZE),
+        'offset': max(int(request.args.get('offset', 0)), 0)
+    }
+
+@app.route('/admin/api/search')
+def search_api():
+    if session.get('admin_authenticated') != True:
+        return jsonify({'error': 'Admin login required'}), 401
+    if not monitor.search_index:
+        return jsonify({'error': 'Full-text search is not available'}), 503
+
+    started = time.perf_counter()
+    try:
+        total, results = monitor.search_conversations(**search_params_from_request())
+    except (ValueError, sqlite3.OperationalError) as e:
+        return jsonify({'error': str(e)}), 400
+
+    return jsonify({
+        'total': total,
+        'results': [dict(result, user_snippet=str(result['user_snippet']), ai_snippet=str(result['ai_snippet']))
+                    for result in results],
+        'indexing': monitor.search_index.catching_up,
+        'took_ms': round((time.perf_counter() - started) * 1000, 2)
+    })
+
+def generate_search_html(params, total, results, took_ms, error_message):
+    field_options = ''.join(
+        f'<option value="{value}"{" selected" if params["field"] == value else ""}>{label}</option>'
+        for value, label in (('', 'Both sides'), ('user_message', 'User messages'), ('ai_response', 'Persona replies'))
+    )
+    student_options = '<option value="">All students</option>' + ''.join(
+        f'<option value="{escape(sid)}"{" selected" if params["student_id"] == sid else ""}>{escape(name)}</option>'
+        for sid, name in name_dict.items()
+    )
+    html_content = '''<!DOCTYPE html>
+<html>
+<head>
+    <title>Search Conversations</title>
+    <style>
+        body { font-family: Arial, sans-serif; margin: 40px; background-color: #f5f5f5; }
+        .container { max-width: 1200px; margin: 0 auto; }
+        .card { background: white; padding: 20px; margin: 20px 0; border-radius: 8px; box-shadow: 0 2px 4px rgba(0,0,0,0.1); }
+        .header { background: #4a90e2; color: white; padding: 20px; border-radius: 8px; margin-bottom: 20px; }
+        .btn { background: #4a90e2; color: white; padding: 10px 20px; text-decoration: none; border-radius: 5px; display: inline-block; margin: 10px 5px 0 0; border: none; cursor: pointer; }
+        .btn:hover { background: #357abd; }
+        input, select { padding: 10px; margin: 5px 5px 0 0; border: 1px solid #ddd; border-radius: 4px; }
+        .result { border-left: 4px solid #4a90e2; background: #f9f9f9; padding: 15px; margin-bottom: 15px; border-radius: 5px; }
+        .meta { color: #666; font-size: 0.9em; margin-bottom: 8px; }
+        mark { background: #ffe08a; }
+        .error { color: #ff6b6b; }
+    </style>
+</head>
+<body>
+    <div class="container">
+        <div class="header">
+            <h1>Search Conversations</h1>
+            <a href="/admin" class="btn">Back to Dashboard</a>
+        </div>
+
+        <div class="card">
+            <form method="get">
+                <input type="text" name="q" value="''' + str(escape(params['query'])) + '''" placeholder='vaping OR "left out"' style="width: 40%;">
+                <select name="field">''' + field_options + '''</select>
+                <select name="student_id">''' + student_options + '''</select>
+                <input type="date" name="start" value="''' + str(escape(params['start'] or '')) + '''">
+                <input type="date" name="end" value="''' + str(escape(params['end'] or '')) + '''">
+                <button type="submit" class="btn">Search</button>
+            </form>
+            <p class="meta">Words must all appear; use "quotes" for phrases, OR for alternatives and a trailing * for prefixes.</p>
+        </div>'''
+
+    if error_message:
+        html_content += f'''
+        <div class="card"><p class="error">{escape(error_message)}</p></div>'''
+    elif params['query']:
+        html_content += f'''
+        <div class="card">
+            <h2>{total} matches <span class="meta">({took_ms:.1f} ms)</span></h2>'''
+        for result in results:
+            html_content += f'''
+            <div class="result">
+                <div class="meta">#{result['id']} · {escape(result['student_name'] or result['student_id'])} · {escape(result['timestamp'][:19])} · {escape(result['scene_context'] or 'No scene')}</div>
+                <p><strong>User:</strong> {result['user_snippet']}</p>
+                <p><strong>Persona:</strong> {result['ai_snippet']}</p>
+            </div>'''
+        if params['offset'] + len(results) < total:
+            next_args = {key: value for key, value in request.args.items() if key != 'offset'}
+            next_args['offset'] = params['offset'] + params['limit']
+            html_content += f'''
+            <a href="/admin/search?{escape(urlencode(next_args))}" class="btn">Next page</a>'''
+        html_content += '''
+        </div>'''
+
+    html_content += '''
+    </div>
+</body>
+</html>'''
+    return html_content
+
+@app.route('/admin/search')
+def search_page():
+    if session.get('admin_authenticated') != True:
+        return redirect('/admin/login')
+
+    total, results, took_ms, error_message = 0, [], 0.0, ''
+    try:
+        params = search_params_from_request()
+    except ValueError:
+        return jsonify({'error': 'Invalid limit or offset'}), 400
+    if not monitor.search_index:
+        error_message = 'Full-text search is not available on this server.'
+    elif params['query']:
+        started = time.perf_counter()
+        try:
+            total, results = monitor.search_conversations(**params)
+        except (ValueError, sqlite3.OperationalError) as e:
+            error_message = str(e)
+        took_ms = (time.perf_counter() - started) * 1000
+    return generate_search_html(params, total, results, took_ms, error_message)
+
+def start_batch_run(run):
+    batch_runs[run.run_id] = run
+    threading.Thread(target=run.run, daemon=True).start()
+    return jsonify(run.progress()), 202
+
+@app.route('/admin/api/batch_runs', methods=['GET', 'POST'])
+def batch_runs_api():
+    if session.get('admin_authenticated') != True:
+        return jsonify({'error': 'Admin login required'}), 401
+    if request.method == 'GET':
+        return jsonify({'runs': [run.progress() for run in batch_runs.values()]})
+
+    data = request.get_json(silent=True) or {}
+    run_id = data.get('run_id') or new_batch_run_id()
+    if not BATCH_RUN_ID_PATTERN.match(run_id) or run_id in batch_runs:
+        return jsonify({'error': 'Invalid or duplicate run_id'}), 400
+    try:
+        student_ids = data.get('student_ids') or (group_student_ids(data['group']) if data.get('group') else list(name_dict))
+        questions = [str(question).strip() for question in data.get('questions', []) if str(question).strip()]
+        if not questions:
+            raise ValueError('questions must be a non-empty list')
+        run = BatchInterviewRun(
+            run_id, questions, student_ids, data.get('scenes') or default_batch_scenes(),
+            mode=data.get('mode', 'live'),
+            workers=min(max(int(data.get('workers', 8)), 1), 32)
+        )
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    return start_batch_run(run)
+
+@app.route('/admin/api/batch_runs/<run_id>')
+def batch_run_status(run_id):
+    if session.get('admin_authenticated') != True:
+        return jsonify({'error': 'Admin login required'}), 401
+    run = batch_runs.get(run_id)
+    if run is None:
+        return jsonify({'error': 'Unknown run'}), 404
+    return jsonify(run.progress())
+
+@app.route('/admin/api/batch_runs/<run_id>/resume', methods=['POST'])
+def resume_batch_run(run_id):
+    if session.get('admin_authenticated') != True:
+        return jsonify({'error': 'Admin login required'}), 401
+    if not BATCH_RUN_ID_PATTERN.match(run_id):
+        return jsonify({'error': 'Invalid run_id'}), 400
+    if run_id in batch_runs and batch_runs[run_id].status == 'running':
+        return jsonify({'error': 'Run is still in progress'}), 409
+    try:
+        run = BatchInterviewRun.resume(run_id)
+    except FileNotFoundError:
+        return jsonify({'error': 'Unknown run'}), 404
+    return start_batch_run(run)
+
+@app.route('/admin/api/prompts')
+def prompt_stats_api():
+    if session.get('admin_authenticated') != True:
+        return jsonify({'error': 'Admin login required'}), 401
+    return jsonify(prompt_registry.stats())
+
+@app.route('/admin/api/profiling', methods=['GET', 'POST'])
+def profiling_api():
+    """GET the profiler state and saved profiles; POST {"enabled": true|false} to switch it for every worker."""
+    if session.get('admin_authenticated') != True:
+        return jsonify({'error': 'Admin login required'}), 401
+    if request.method == 'POST':
+        data = request.get_json(silent=True) or {}
+        if not isinstance(data.get('enabled'), bool):
+            return jsonify({'error': 'enabled must be true or false'}), 400
+        profiler.set_enabled(data['enabled'])
+    return jsonify({
+        'enabled': profiler.refresh(),
+        'interval_ms': profiler.interval * 1000,
+        'slow_request_ms': SLOW_REQUEST_MS,
+        'profiles': profiler.profiles()
+    })
+
+@app.route('/admin/api/profiling/<name>')
+def download_profile(name):
+    if session.get('admin_authenticated') != True:
+        return jsonify({'error': 'Admin login required'}), 401
+    if not PROFILE_NAME_PATTERN.match(name):
+        return jsonify({'error': 'Unknown profile'}), 404
+    return send_from_directory(os.path.abspath(PROFILE_DIR), name, mimetype='text/plain', as_attachment=True)
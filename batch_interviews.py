@@ -0,0 +1,79 @@
+# batch_interviews.py - 对所有人物 × 场景批量跑同一份问卷
+#
+#   python batch_interviews.py questionnaire.txt                       # 10 个人物 × 10 个场景
+#   python batch_interviews.py questionnaire.json --group middle_adolescence --scenes 0,5 --workers 16
+#   python batch_interviews.py questionnaire.txt --mode batch           # 走 Batch API，更便宜但更慢
+#   python batch_interviews.py --resume 20250101-120000-ab12cd          # 从检查点继续
+#
+# 问卷文件是一行一个问题的文本，或 JSON 列表 / {"questions": [...]}。每个回答都会写入
+# batch_runs/<run_id>.jsonl 检查点，并通过 ConversationMonitor 记入对话存储。
+# 如果网站同时在运行，请使用 CONVERSATION_STORAGE=sqlite，否则两个进程会各自分配 id；
+# 也可以改用管理后台的 /admin/api/batch_runs 在服务端运行。
+# 本地测试：先启动 bench/fake_openai.py，再设置 OPENAI_BASE_URL=http://127.0.0.1:8765/v1。
+import argparse
+import sys
+
+import app
+
+
+def parse_scenes(value):
+    if value == "all":
+        return app.default_batch_scenes()
+    if value == "none":
+        return [""]
+    return [app.scene_options[int(index)] for index in value.split(",")]
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Run a questionnaire against every persona and scene")
+    parser.add_argument("questionnaire", nargs="?", help="questions file (.txt or .json)")
+    parser.add_argument("--resume", metavar="RUN_ID", help="continue a previous run from its checkpoint")
+    parser.add_argument("--run-id", help="name for a new run (default: timestamp)")
+    parser.add_argument("--students", help="comma-separated student_ids (default: all ten)")
+    parser.add_argument("--group", help="student_groups key, e.g. middle_adolescence.mental_health_issues")
+    parser.add_argument("--scenes", default="all", help="'all', 'none', or comma-separated scene_options indexes")
+    parser.add_argument("--mode", choices=["live", "batch"], default="live")
+    parser.add_argument("--workers", type=int, default=8, help="interviews running at once in live mode")
+    parser.add_argument("--poll-interval", type=float, default=30.0, help="seconds between Batch API status checks")
+    args = parser.parse_args(argv)
+    if not args.questionnaire and not args.resume:
+        parser.error("a questionnaire file or --resume RUN_ID is required")
+    return args
+
+
+def main():
+    args = parse_args()
+    if args.resume:
+        run = app.BatchInterviewRun.resume(args.resume, workers=args.workers)
+    else:
+        if args.students:
+            student_ids = args.students.split(",")
+        elif args.group:
+            student_ids = app.group_student_ids(args.group)
+        else:
+            student_ids = list(app.name_dict)
+        run = app.BatchInterviewRun(
+            args.run_id or app.new_batch_run_id(),
+            app.load_questionnaire(args.questionnaire),
+            student_ids,
+            parse_scenes(args.scenes),
+            mode=args.mode,
+            workers=args.workers,
+        )
+
+    progress = run.progress()
+    print(f"Run {run.run_id}: {progress['interviews']} interviews x {progress['questions']} questions "
+          f"({progress['answered']} already answered), mode={run.mode}")
+    status = run.run(poll_interval=args.poll_interval)
+
+    progress = run.progress()
+    print(f"{status}: {progress['answered']}/{progress['total']} answers, checkpoint {progress['checkpoint']}")
+    for error in progress["errors"]:
+        print(f"  {error['student_id']} scene {error['scene_index']}: {error['error']}")
+    if status != "completed":
+        print(f"Resume with: python batch_interviews.py --resume {run.run_id}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
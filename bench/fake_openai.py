@@ -0,0 +1,221 @@
+# bench/fake_openai.py - 本地模拟的 OpenAI 兼容服务，压测时代替真实 API（不花钱）
+#
+#   python bench/fake_openai.py --port 8765 --latency 0.3 --tokens-per-second 50
+#   OPENAI_API_KEY=x OPENAI_BASE_URL=http://127.0.0.1:8765/v1 gunicorn app:app
+#
+# 只实现 app.py 用到的 POST /v1/chat/completions（普通和 stream=True 两种），
+# latency 模拟首字延迟，tokens-per-second 模拟生成速度，usage 与真实接口格式一致。
+# slow-rate / slow-latency 模拟偶发的长尾延迟，failing-models 让指定模型一直返回 500，
+# 用来观察对冲请求和熔断回退。
+# 另外有最小化的 /v1/files 和 /v1/batches，批量访谈的 batch 模式可以离线测试：
+# 提交后立即完成，不模拟延迟。
+import argparse
+import itertools
+import json
+import random
+import threading
+import time
+from email.parser import BytesParser
+from email.policy import HTTP
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+WORDS = ("that is a really interesting question and honestly I have been thinking "
+         "about it a lot lately because it matters to me more than I expected").split()
+
+
+class BatchStore:
+    """Uploaded files and batches, kept in memory for the life of the server."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.ids = itertools.count(1)
+        self.files = {}
+        self.batches = {}
+
+    def new_id(self, prefix):
+        with self.lock:
+            return f"{prefix}-{next(self.ids)}"
+
+
+def make_usage(body, config, completion_tokens):
+    prompt_chars = sum(len(str(m.get("content", ""))) for m in body.get("messages", []))
+    prompt_tokens = max(1, prompt_chars // 4)
+    return {
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens,
+        "total_tokens": prompt_tokens + completion_tokens,
+        "prompt_tokens_details": {"cached_tokens": int(prompt_tokens * config.cached_ratio)}
+    }
+
+
+def make_completion(body, config, words):
+    return {
+        "id": "chatcmpl-bench", "object": "chat.completion", "created": int(time.time()),
+        "model": body.get("model", "gpt-4o-mini"),
+        "choices": [{"index": 0, "message": {"role": "assistant", "content": " ".join(words)}, "finish_reason": "stop"}],
+        "usage": make_usage(body, config, len(words))
+    }
+
+
+class FakeOpenAIHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    config = None
+    store = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, status, payload):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def not_found(self):
+        self.send_json(404, {"error": {"message": f"Unknown path {self.path}", "type": "invalid_request_error"}})
+
+    def do_GET(self):
+        path = self.path.rstrip("/")
+        parts = path.split("/")
+        if "/batches/" in path and parts[-1] in self.store.batches:
+            self.send_json(200, self.store.batches[parts[-1]])
+        elif path.endswith("/content") and parts[-2] in self.store.files:
+            content = self.store.files[parts[-2]]["content"]
+            self.send_response(200)
+            self.send_header("Content-Type", "application/octet-stream")
+            self.send_header("Content-Length", str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+        else:
+            self.not_found()
+
+    def do_POST(self):
+        raw = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        path = self.path.rstrip("/")
+        if path.endswith("/files"):
+            self.upload_file(raw)
+            return
+        body = json.loads(raw or b"{}")
+        if path.endswith("/batches"):
+            self.create_batch(body)
+            return
+        if not path.endswith("/chat/completions"):
+            self.not_found()
+            return
+
+        config = self.config
+        model = body.get("model", "gpt-4o-mini")
+        if model in config.failing_models.split(","):
+            self.send_json(500, {"error": {"message": "The server had an error", "type": "server_error"}})
+            return
+        if config.error_rate and random.random() < config.error_rate:
+            self.send_response(429)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("x-ratelimit-reset-requests", "1s")
+            payload = json.dumps({"error": {"message": "Rate limit reached", "type": "requests", "code": "rate_limit_exceeded"}}).encode()
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+            return
+
+        words = [random.choice(WORDS) for _ in range(config.reply_tokens)]
+        usage = make_usage(body, config, len(words))
+        slow = config.slow_rate and random.random() < config.slow_rate
+        time.sleep(config.slow_latency if slow else config.latency)
+
+        if not body.get("stream"):
+            time.sleep(len(words) / config.tokens_per_second)
+            self.send_json(200, make_completion(body, config, words))
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        for i, word in enumerate(words):
+            self.send_event({"id": "chatcmpl-bench", "object": "chat.completion.chunk", "created": 0, "model": model,
+                             "choices": [{"index": 0, "delta": {"content": word if i == 0 else " " + word}, "finish_reason": None}]})
+            time.sleep(1 / config.tokens_per_second)
+        if body.get("stream_options", {}).get("include_usage"):
+            self.send_event({"id": "chatcmpl-bench", "object": "chat.completion.chunk", "created": 0, "model": model,
+                             "choices": [], "usage": usage})
+        self.send_chunk(b"data: [DONE]\n\n")
+        self.send_chunk(b"")
+
+    def upload_file(self, raw):
+        message = BytesParser(policy=HTTP).parsebytes(
+            f"Content-Type: {self.headers['Content-Type']}\r\n\r\n".encode() + raw
+        )
+        fields = {part.get_param("name", header="content-disposition"): part for part in message.iter_parts()}
+        file_id = self.store.new_id("file")
+        content = fields["file"].get_payload(decode=True)
+        self.store.files[file_id] = {"purpose": fields["purpose"].get_content().strip(), "content": content}
+        self.send_json(200, {"id": file_id, "object": "file", "bytes": len(content), "created_at": int(time.time()),
+                             "filename": fields["file"].get_filename() or "upload.jsonl", "purpose": "batch"})
+
+    def create_batch(self, body):
+        # 立即逐行执行，批次直接处于 completed 状态
+        input_file = self.store.files.get(body.get("input_file_id"))
+        if input_file is None:
+            self.send_json(404, {"error": {"message": "No such file", "type": "invalid_request_error"}})
+            return
+        lines = []
+        for line in input_file["content"].decode().splitlines():
+            if not line.strip():
+                continue
+            item = json.loads(line)
+            words = [random.choice(WORDS) for _ in range(self.config.reply_tokens)]
+            lines.append(json.dumps({
+                "id": f"batch_req-{item['custom_id']}", "custom_id": item["custom_id"], "error": None,
+                "response": {"status_code": 200, "request_id": "req-bench", "body": make_completion(item["body"], self.config, words)}
+            }))
+        output_id = self.store.new_id("file")
+        self.store.files[output_id] = {"purpose": "batch_output", "content": ("\n".join(lines) + "\n").encode()}
+        batch_id = self.store.new_id("batch")
+        now = int(time.time())
+        self.store.batches[batch_id] = {
+            "id": batch_id, "object": "batch", "endpoint": body.get("endpoint"), "errors": None,
+            "input_file_id": body["input_file_id"], "completion_window": body.get("completion_window", "24h"),
+            "status": "completed", "output_file_id": output_id, "error_file_id": None,
+            "created_at": now, "completed_at": now,
+            "request_counts": {"total": len(lines), "completed": len(lines), "failed": 0}
+        }
+        self.send_json(200, self.store.batches[batch_id])
+
+    def send_event(self, payload):
+        self.send_chunk(f"data: {json.dumps(payload)}\n\n".encode())
+
+    def send_chunk(self, data):
+        self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+        self.wfile.flush()
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Local OpenAI-compatible server for load tests")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", type=float, default=0.3, help="seconds before the first token")
+    parser.add_argument("--tokens-per-second", type=float, default=50.0)
+    parser.add_argument("--reply-tokens", type=int, default=40)
+    parser.add_argument("--cached-ratio", type=float, default=0.5, help="share of prompt tokens reported as cached")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of calls answered with 429")
+    parser.add_argument("--slow-rate", type=float, default=0.0, help="share of calls that wait --slow-latency instead")
+    parser.add_argument("--slow-latency", type=float, default=20.0, help="seconds before the first token on a slow call")
+    parser.add_argument("--failing-models", default="", help="comma-separated models that always get a 500")
+    return parser.parse_args(argv)
+
+
+def serve(config):
+    handler = type("ConfiguredHandler", (FakeOpenAIHandler,), {"config": config, "store": BatchStore()})
+    server = ThreadingHTTPServer((config.host, config.port), handler)
+    server.daemon_threads = True
+    return server
+
+
+if __name__ == "__main__":
+    config = parse_args()
+    print(f"Fake OpenAI on http://{config.host}:{config.port}/v1 "
+          f"(latency {config.latency}s, {config.tokens_per_second} tok/s, {config.reply_tokens} tokens)")
+    serve(config).serve_forever()
@@ -0,0 +1,224 @@
+# bench/load_test.py - 按不同并发量压测 /api/send_message，输出吞吐和延迟分位数
+#
+#   python bench/load_test.py --spawn --concurrency 1,8,32,64 --duration 20
+#   python bench/load_test.py --url http://127.0.0.1:5000 --stream
+#
+# --spawn 会在本地启动 fake_openai.py 和 gunicorn（gunicorn.conf.py 的配置），
+# 对话写入临时目录里的 SQLite 库，限流调到足够高，不会触碰 GitHub 和真实 API。
+# 不加 --spawn 时压测已经在运行的实例；若其 OPENAI_BASE_URL 指向真实 API 会产生费用。
+import argparse
+import http.cookiejar
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+
+import fake_openai
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MESSAGES = [
+    "Hi! What did you do over the weekend?",
+    "How do you usually study for exams?",
+    "What's the hardest part of school for you right now?",
+    "Tell me about your friends.",
+    "What do you want to do after you graduate?",
+]
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+class VirtualUser:
+    """One browser: its own cookie jar, so every user gets its own chat session."""
+
+    def __init__(self, base_url, student_id, stream):
+        self.base_url = base_url
+        self.student_id = student_id
+        self.stream = stream
+        self.opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()))
+        self.turn = 0
+
+    def send(self, timeout):
+        payload = {
+            "student_id": self.student_id,
+            "message": MESSAGES[self.turn % len(MESSAGES)],
+            "stream": self.stream,
+        }
+        self.turn += 1
+        request = urllib.request.Request(
+            self.base_url + "/api/send_message",
+            data=json.dumps(payload).encode(),
+            headers={"Content-Type": "application/json"},
+        )
+        started = time.perf_counter()
+        first_byte = None
+        try:
+            with self.opener.open(request, timeout=timeout) as response:
+                if self.stream:
+                    for line in response:
+                        if first_byte is None and line.startswith(b"data:") and b'"delta"' in line:
+                            first_byte = time.perf_counter() - started
+                        if b'"error"' in line:
+                            return "error", time.perf_counter() - started, first_byte
+                else:
+                    response.read()
+        except urllib.error.HTTPError as e:
+            e.read()
+            return ("rejected" if e.code == 429 else "error"), time.perf_counter() - started, None
+        except OSError:
+            return "error", time.perf_counter() - started, None
+        return "ok", time.perf_counter() - started, first_byte
+
+
+def run_level(base_url, concurrency, duration, student_ids, stream, timeout):
+    results = []
+    lock = threading.Lock()
+    deadline = time.perf_counter() + duration
+
+    def worker(index):
+        user = VirtualUser(base_url, student_ids[index % len(student_ids)], stream)
+        while time.perf_counter() < deadline:
+            outcome = user.send(timeout)
+            with lock:
+                results.append(outcome)
+
+    started = time.perf_counter()
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    latencies = [latency for status, latency, _ in results if status == "ok"]
+    first_bytes = [first for status, _, first in results if status == "ok" and first is not None]
+    return {
+        "concurrency": concurrency,
+        "requests": len(results),
+        "ok": len(latencies),
+        "rejected": sum(1 for status, _, _ in results if status == "rejected"),
+        "errors": sum(1 for status, _, _ in results if status == "error"),
+        "rps": len(latencies) / elapsed if elapsed else 0.0,
+        "p50": percentile(latencies, 50),
+        "p95": percentile(latencies, 95),
+        "p99": percentile(latencies, 99),
+        "ttft_p50": percentile(first_bytes, 50),
+        "ttft_p95": percentile(first_bytes, 95),
+    }
+
+
+def print_report(rows, stream):
+    header = f"{'conc':>5} {'reqs':>6} {'ok':>6} {'429':>5} {'err':>5} {'req/s':>8} {'p50':>7} {'p95':>7} {'p99':>7}"
+    if stream:
+        header += f" {'ttft50':>7} {'ttft95':>7}"
+    print(header)
+    for row in rows:
+        line = (f"{row['concurrency']:>5} {row['requests']:>6} {row['ok']:>6} {row['rejected']:>5} {row['errors']:>5} "
+                f"{row['rps']:>8.1f} {row['p50']:>7.3f} {row['p95']:>7.3f} {row['p99']:>7.3f}")
+        if stream:
+            line += f" {row['ttft_p50']:>7.3f} {row['ttft_p95']:>7.3f}"
+        print(line)
+
+
+def wait_until_up(url, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            with urllib.request.urlopen(url + "/api/test", timeout=2):
+                return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError(f"{url} did not come up within {timeout}s")
+
+
+def spawn_stack(args, workdir):
+    fake_config = fake_openai.parse_args([
+        "--port", str(args.fake_port), "--latency", str(args.latency),
+        "--tokens-per-second", str(args.tokens_per_second), "--reply-tokens", str(args.reply_tokens),
+    ])
+    fake_server = fake_openai.serve(fake_config)
+    threading.Thread(target=fake_server.serve_forever, daemon=True).start()
+
+    env = {key: value for key, value in os.environ.items() if not key.startswith("GITHUB_")}
+    env.update({
+        "OPENAI_API_KEY": "bench",
+        "OPENAI_BASE_URL": f"http://127.0.0.1:{args.fake_port}/v1",
+        "CONVERSATION_STORAGE": "sqlite",
+        "CONVERSATION_DB": os.path.join(workdir, "conversations.db"),
+        # 全文索引、慢请求日志和采样文件也放进临时目录，项目里的 conversation_log 不归档
+        "SEARCH_INDEX_DB": os.path.join(workdir, "search_index.db"),
+        "SLOW_REQUEST_LOG": os.path.join(workdir, "slow_requests.jsonl"),
+        "PROFILE_DIR": os.path.join(workdir, "profiles"),
+        "ARCHIVE_AFTER_DAYS": "0",
+        "RATE_LIMIT_SESSION_PER_MIN": "1000000",
+        "RATE_LIMIT_SESSION_BURST": "1000000",
+        "RATE_LIMIT_IP_PER_MIN": "1000000",
+        "RATE_LIMIT_IP_BURST": "1000000",
+    })
+    app_server = subprocess.Popen(
+        [sys.executable, "-m", "gunicorn", "app:app", "--bind", f"127.0.0.1:{args.app_port}"],
+        cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    return fake_server, app_server
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Load-test /api/send_message")
+    parser.add_argument("--url", default="http://127.0.0.1:5000", help="running app to test (ignored with --spawn)")
+    parser.add_argument("--concurrency", default="1,8,32,64", help="comma-separated concurrency levels")
+    parser.add_argument("--duration", type=float, default=15.0, help="seconds per concurrency level")
+    parser.add_argument("--stream", action="store_true", help="use the SSE streaming reply path")
+    parser.add_argument("--students", default="student001", help="comma-separated student_ids to rotate through")
+    parser.add_argument("--timeout", type=float, default=120.0)
+    parser.add_argument("--json", action="store_true", help="print results as JSON")
+    parser.add_argument("--spawn", action="store_true", help="start fake_openai.py and gunicorn locally")
+    parser.add_argument("--app-port", type=int, default=5050)
+    parser.add_argument("--fake-port", type=int, default=8765)
+    parser.add_argument("--latency", type=float, default=0.3)
+    parser.add_argument("--tokens-per-second", type=float, default=50.0)
+    parser.add_argument("--reply-tokens", type=int, default=40)
+    return parser.parse_args(argv)
+
+
+def main():
+    args = parse_args()
+    levels = [int(level) for level in args.concurrency.split(",")]
+    student_ids = args.students.split(",")
+
+    with tempfile.TemporaryDirectory() as workdir:
+        fake_server = app_server = None
+        base_url = args.url.rstrip("/")
+        if args.spawn:
+            fake_server, app_server = spawn_stack(args, workdir)
+            base_url = f"http://127.0.0.1:{args.app_port}"
+        try:
+            wait_until_up(base_url)
+            rows = []
+            for concurrency in levels:
+                print(f"running concurrency {concurrency} for {args.duration:.0f}s...", file=sys.stderr)
+                rows.append(run_level(base_url, concurrency, args.duration, student_ids, args.stream, args.timeout))
+        finally:
+            if app_server is not None:
+                app_server.terminate()
+                app_server.wait()
+            if fake_server is not None:
+                fake_server.shutdown()
+
+    if args.json:
+        print(json.dumps(rows, indent=2))
+    else:
+        print_report(rows, args.stream)
+
+
+if __name__ == "__main__":
+    main()
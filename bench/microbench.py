@@ -0,0 +1,191 @@
+# bench/microbench.py - 存储与统计的微基准：log_conversation / get_analytics_dashboard_data / export_to_csv
+#
+#   python bench/microbench.py                          # 10k、100k、1M 条记录，jsonl 后端
+#   python bench/microbench.py --sizes 10000 --backends jsonl,sqlite
+#   python bench/microbench.py --save bench/baseline.json
+#   python bench/microbench.py --compare bench/baseline.json --tolerance 1.5
+#
+# 每个规模都在临时目录里生成按天分段的历史记录，再用对应后端新建 ConversationMonitor，
+# 不会读写项目里的 conversation_log，也不会上传 GitHub。--compare 时任一指标比基线慢
+# tolerance 倍以上就以非零状态退出，可以放在部署前的检查里。
+import argparse
+import contextlib
+import datetime
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+for key in [key for key in os.environ if key.startswith("GITHUB_")]:
+    del os.environ[key]
+os.environ.setdefault("OPENAI_API_KEY", "bench")
+# 导入 app 时会建立模块级的 monitor：不写项目里的全文索引，也不归档项目里的 conversation_log
+os.environ["SEARCH_ENABLED"] = "false"
+os.environ["ARCHIVE_AFTER_DAYS"] = "0"
+os.chdir(ROOT)
+
+with contextlib.redirect_stdout(open(os.devnull, "w")):
+    import app
+
+STUDENTS = [f"student{i:03d}" for i in range(1, 11)]
+SCENES = ["", "School cafeteria", "After class", "Weekend at home"]
+WORDS = "the a school friend weekend homework teacher game music really think maybe always never".split()
+
+
+def sentence(words):
+    return " ".join(random.choice(WORDS) for _ in range(words))
+
+
+def seed_log_dir(log_dir, count, days=30):
+    # 直接写出按天分段的 JSONL，比逐条调用 log_conversation 快得多
+    os.makedirs(log_dir, exist_ok=True)
+    now = datetime.datetime.now()
+    start = now - datetime.timedelta(days=days)
+    step = (now - start) / max(count, 1)
+    handle = None
+    current_day = None
+    for i in range(count):
+        timestamp = start + step * i
+        day = timestamp.strftime('%Y-%m-%d')
+        if day != current_day:
+            if handle:
+                handle.close()
+            handle = open(os.path.join(log_dir, f"{day}.jsonl"), "a", encoding="utf-8")
+            current_day = day
+        student_id = random.choice(STUDENTS)
+        user_message = sentence(random.randint(5, 30))
+        conversation = {
+            'id': i + 1,
+            'session_id': f"session-{i // 20}",
+            'student_id': student_id,
+            'student_name': app.name_dict.get(student_id, student_id),
+            'user_message': user_message,
+            'ai_response': sentence(random.randint(20, 80)),
+            'scene_context': random.choice(SCENES),
+            'timestamp': timestamp.isoformat(),
+            'response_time_ms': random.randint(300, 4000),
+            'message_length': len(user_message),
+            'day_of_week': timestamp.strftime('%A'),
+            'hour': timestamp.hour,
+            'ip_address': '127.0.0.1',
+            'user_agent': 'bench',
+            'prompt_tokens': 900,
+            'completion_tokens': 60,
+            'cached_tokens': 640,
+        }
+        handle.write(json.dumps(conversation, ensure_ascii=False) + "\n")
+    if handle:
+        handle.close()
+
+
+def make_store(backend, workdir):
+    log_dir = os.path.join(workdir, "conversation_log")
+    legacy_file = os.path.join(workdir, "conversation_data.json")
+    if backend == "sqlite":
+        return app.SqliteConversationStore(os.path.join(workdir, "conversations.db"), log_dir=log_dir, legacy_file=legacy_file)
+    return app.JsonlConversationStore(log_dir=log_dir, legacy_file=legacy_file,
+                                      archive_dir=os.path.join(workdir, "conversation_archive"))
+
+
+def timed(func, repeat=1):
+    samples = []
+    result = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = func()
+        samples.append(time.perf_counter() - started)
+    return samples, result
+
+
+def bench_size(backend, count, appends, repeat):
+    with tempfile.TemporaryDirectory() as workdir:
+        seed_log_dir(os.path.join(workdir, "conversation_log"), count)
+        store = make_store(backend, workdir)
+
+        with contextlib.redirect_stdout(open(os.devnull, "w")):
+            search_index = app.ConversationSearchIndex(os.path.join(workdir, "search_index.db"))
+            (load_seconds,), monitor = timed(lambda: app.ConversationMonitor(store=store, search_index=search_index))
+            append_samples, _ = timed(
+                lambda: monitor.log_conversation(random.choice(STUDENTS), sentence(12), sentence(50), session_id="bench"),
+                repeat=appends,
+            )
+        dashboard_samples, _ = timed(monitor.get_analytics_dashboard_data, repeat=repeat)
+        (export_seconds,), csv_text = timed(monitor.export_to_csv)
+
+    append_samples.sort()
+    return {
+        'backend': backend,
+        'records': count,
+        'load_s': load_seconds,
+        'log_conversation_mean_ms': sum(append_samples) / len(append_samples) * 1000,
+        'log_conversation_p95_ms': append_samples[int(len(append_samples) * 0.95) - 1] * 1000,
+        'dashboard_mean_ms': sum(dashboard_samples) / len(dashboard_samples) * 1000,
+        'export_csv_s': export_seconds,
+        'export_csv_mb': len(csv_text.encode('utf-8')) / 1e6,
+    }
+
+
+METRICS = ['load_s', 'log_conversation_mean_ms', 'log_conversation_p95_ms', 'dashboard_mean_ms', 'export_csv_s']
+
+
+def print_report(rows):
+    print(f"{'backend':<8} {'records':>9} {'load s':>8} {'log ms':>8} {'log p95':>8} {'dash ms':>8} {'csv s':>8} {'csv MB':>8}")
+    for row in rows:
+        print(f"{row['backend']:<8} {row['records']:>9} {row['load_s']:>8.2f} {row['log_conversation_mean_ms']:>8.3f} "
+              f"{row['log_conversation_p95_ms']:>8.3f} {row['dashboard_mean_ms']:>8.3f} {row['export_csv_s']:>8.2f} "
+              f"{row['export_csv_mb']:>8.1f}")
+
+
+def compare(rows, baseline_path, tolerance):
+    with open(baseline_path, encoding="utf-8") as f:
+        baseline = {(row['backend'], row['records']): row for row in json.load(f)}
+    regressions = []
+    for row in rows:
+        reference = baseline.get((row['backend'], row['records']))
+        if not reference:
+            continue
+        for metric in METRICS:
+            if reference.get(metric) and row[metric] > reference[metric] * tolerance:
+                regressions.append(f"{row['backend']} {row['records']} {metric}: "
+                                   f"{row[metric]:.3f} vs baseline {reference[metric]:.3f}")
+    for line in regressions:
+        print(f"REGRESSION {line}")
+    return not regressions
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Storage and analytics microbenchmarks")
+    parser.add_argument("--sizes", default="10000,100000,1000000", help="comma-separated record counts")
+    parser.add_argument("--backends", default="jsonl", help="comma-separated: jsonl, sqlite")
+    parser.add_argument("--appends", type=int, default=1000, help="log_conversation calls to time per size")
+    parser.add_argument("--repeat", type=int, default=20, help="dashboard calls to time per size")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--save", help="write results to this JSON file")
+    parser.add_argument("--compare", help="baseline JSON written by --save")
+    parser.add_argument("--tolerance", type=float, default=1.5, help="allowed slowdown factor against the baseline")
+    return parser.parse_args(argv)
+
+
+def main():
+    args = parse_args()
+    random.seed(args.seed)
+    rows = []
+    for backend in args.backends.split(","):
+        for count in (int(size) for size in args.sizes.split(",")):
+            print(f"{backend}: {count} records...", file=sys.stderr)
+            rows.append(bench_size(backend, count, args.appends, args.repeat))
+    print_report(rows)
+
+    if args.save:
+        with open(args.save, "w", encoding="utf-8") as f:
+            json.dump(rows, f, indent=2)
+    if args.compare and not compare(rows, args.compare, args.tolerance):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,138 @@
+# build_assets.py - 部署时生成静态资源（在 render.yaml 的 buildCommand 中运行）
+#
+#   python build_assets.py
+#
+# 头像原图是 300KB-1.5MB 的 PNG，但页面上最大只显示 80px。这里为每张头像生成
+# 几种宽度的 AVIF/WebP/PNG 缩略图，并写出 manifest，供 app.py 的 avatar_image()
+# 生成 srcset。
+#
+# 随后把 static/ 下所有文件按内容哈希复制到 static/dist/，文本类文件额外生成
+# .gz / .br 预压缩版本，app.py 通过 static/dist/manifest.json 解析 url_for。
+import gzip
+import hashlib
+import json
+import os
+import shutil
+
+from PIL import Image, features
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+AVATAR_DIR = os.path.join("static", "images", "avatar")
+VARIANT_DIR = os.path.join(AVATAR_DIR, "variants")
+VARIANT_MANIFEST = os.path.join(VARIANT_DIR, "manifest.json")
+
+# 页面上头像显示为 40px（聊天气泡）和 80px（卡片、档案），覆盖 1x-3x 屏幕
+AVATAR_WIDTHS = [40, 80, 160, 240]
+
+STATIC_DIR = "static"
+DIST_DIR = os.path.join(STATIC_DIR, "dist")
+DIST_MANIFEST = os.path.join(DIST_DIR, "manifest.json")
+COMPRESSIBLE = {".css", ".js", ".json", ".svg", ".txt", ".html"}
+
+FORMATS = {
+    "avif": {"quality": 55},
+    "webp": {"quality": 80, "method": 6},
+    "png": {"optimize": True},
+}
+
+
+def supported_formats():
+    formats = []
+    for name in FORMATS:
+        if name == "png" or features.check(name):
+            formats.append(name)
+        else:
+            print(f"Pillow was built without {name} support, skipping {name} variants")
+    return formats
+
+
+def build_avatar_variants():
+    os.makedirs(VARIANT_DIR, exist_ok=True)
+    formats = supported_formats()
+    manifest = {}
+
+    for filename in sorted(os.listdir(AVATAR_DIR)):
+        name, ext = os.path.splitext(filename)
+        if ext.lower() != ".png":
+            continue
+
+        with Image.open(os.path.join(AVATAR_DIR, filename)) as source:
+            source.load()
+            aspect = source.height / source.width
+            widths = [width for width in AVATAR_WIDTHS if width <= source.width]
+            entry = {"width": source.width, "height": source.height, "aspect": aspect, "variants": {}}
+
+            for fmt in formats:
+                entry["variants"][fmt] = []
+                for width in widths:
+                    height = max(1, round(width * aspect))
+                    resized = source.resize((width, height), Image.LANCZOS)
+                    out_name = f"{name}-{width}.{fmt}"
+                    resized.save(os.path.join(VARIANT_DIR, out_name), **FORMATS[fmt])
+                    entry["variants"][fmt].append({"width": width, "file": out_name})
+
+        manifest[name] = entry
+        sizes = sum(os.path.getsize(os.path.join(VARIANT_DIR, v["file"]))
+                    for variants in entry["variants"].values() for v in variants)
+        print(f"{filename}: {len(widths)} widths x {len(formats)} formats, {sizes / 1024:.0f} KB total")
+
+    with open(VARIANT_MANIFEST, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=2)
+    print(f"Wrote {VARIANT_MANIFEST}")
+
+
+def fingerprint(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(65536), b""):
+            digest.update(block)
+    return digest.hexdigest()[:12]
+
+
+def precompress(path):
+    with open(path, "rb") as f:
+        content = f.read()
+    outputs = {".gz": gzip.compress(content, compresslevel=9, mtime=0)}
+    if brotli is not None:
+        outputs[".br"] = brotli.compress(content, quality=11)
+    for suffix, compressed in outputs.items():
+        # 压缩后没变小就不保留，服务端会回退到原文件
+        if len(compressed) < len(content):
+            with open(path + suffix, "wb") as f:
+                f.write(compressed)
+
+
+def build_static_bundle():
+    if os.path.isdir(DIST_DIR):
+        shutil.rmtree(DIST_DIR)
+    if brotli is None:
+        print("brotli is not installed, only gzip variants will be generated")
+
+    manifest = {}
+    for root, dirs, files in os.walk(STATIC_DIR):
+        dirs[:] = [d for d in dirs if os.path.join(root, d) != DIST_DIR]
+        for filename in files:
+            source = os.path.join(root, filename)
+            logical = os.path.relpath(source, STATIC_DIR).replace(os.sep, "/")
+            name, ext = os.path.splitext(logical)
+            hashed = f"{name}.{fingerprint(source)}{ext}"
+
+            target = os.path.join(DIST_DIR, hashed)
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            shutil.copyfile(source, target)
+            if ext.lower() in COMPRESSIBLE:
+                precompress(target)
+            manifest[logical] = hashed
+
+    with open(DIST_MANIFEST, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    print(f"Fingerprinted {len(manifest)} static files into {DIST_DIR}/")
+
+
+if __name__ == "__main__":
+    build_avatar_variants()
+    build_static_bundle()
@@ -0,0 +1,16 @@
+# gunicorn.conf.py - gunicorn 启动时会自动读取当前目录下的这个文件，
+# 因此 render.yaml 里的 `gunicorn --bind 0.0.0.0:$PORT app:app` 无需修改
+import os
+
+# OpenAI 调用在 app.py 的 LLMGateway 事件循环里执行，请求线程只是在等待结果，
+# 用 gthread 让每个进程能同时挂起上百个聊天
+worker_class = os.environ.get("GUNICORN_WORKER_CLASS", "gthread")
+# 多于一个 worker 时请设置 CONVERSATION_STORAGE=sqlite 和 CHAT_STATE_BACKEND=sqlite，
+# 否则各 worker 的对话记录和聊天历史互不可见
+workers = int(os.environ.get("WEB_CONCURRENCY", "1"))
+threads = int(os.environ.get("GUNICORN_THREADS", "100"))
+
+# 流式回复可能持续较长时间
+timeout = int(os.environ.get("GUNICORN_TIMEOUT", "120"))
+graceful_timeout = 30
+keepalive = 5
@@ -1,12 +1,14 @@
 // 简化版聊天功能
 let currentStudentId = '';
 let currentStudentName = '';
+let avatarUrls = {};
 let isTyping = false;
 
 // 初始化聊天功能
-function initializeChat(studentId, studentName) {
+function initializeChat(studentId, studentName, avatars) {
     currentStudentId = studentId;
     currentStudentName = studentName;
+    avatarUrls = avatars || {};
     
     console.log(`Chat initialized for ${studentName} (${studentId})`);
     
@@ -77,7 +79,7 @@ async function sendMessage() {
             scene_context: sceneContext
         });
         
-        // 发送到API
+        // 发送到API（流式）
         const response = await fetch('/api/send_message', {
             method: 'POST',
             headers: {
@@ -86,21 +88,28 @@ async function sendMessage() {
             body: JSON.stringify({
                 message: message,
                 student_id: currentStudentId,
-                scene_context: sceneContext
+                scene_context: sceneContext,
+                stream: true
             })
         });
         
         console.log('API response status:', response.status);
         
-        const data = await response.json();
-        console.log('API response data:', data);
-        
-        if (data.success) {
-            addMessage(data.reply, 'bot');
-        } else {
-            throw new Error(data.error || 'Unknown error');
+        const contentType = response.headers.get('Content-Type') || '';
+        if (!contentType.includes('text/event-stream')) {
+            const data = await response.json();
+            console.log('API response data:', data);
+            
+            if (data.success) {
+                addMessage(data.reply, 'bot');
+            } else {
+                throw new Error(data.error || 'Unknown error');
+            }
+            return;
         }
         
+        await readReplyStream(response);
+        
     } catch (error) {
         console.error('Send message error:', error);
         addMessage('Sorry, I encountered an error. Please try again.', 'bot', true);
@@ -112,6 +121,59 @@ async function sendMessage() {
     }
 }
 
+// 读取SSE流，逐步渲染回复
+async function readReplyStream(response) {
+    const reader = response.body.getReader();
+    const decoder = new TextDecoder();
+    let buffer = '';
+    let bubble = null;
+    let text = '';
+    
+    while (true) {
+        const { value, done } = await reader.read();
+        if (done) break;
+        buffer += decoder.decode(value, { stream: true });
+        
+        const events = buffer.split('\n\n');
+        buffer = events.pop();
+        
+        for (const event of events) {
+            if (!event.startsWith('data: ')) continue;
+            const data = JSON.parse(event.slice(6));
+            
+            if (data.error) {
+                if (bubble) bubble.parentNode.remove();
+                throw new Error(data.error);
+            }
+            if (data.delta) {
+                if (!bubble) {
+                    hideTyping();
+                    bubble = addMessage('', 'bot');
+                }
+                text += data.delta;
+                bubble.textContent = text;
+                scrollToBottom();
+            }
+            if (data.done) {
+                if (!bubble) {
+                    bubble = addMessage(data.reply, 'bot');
+                }
+                bubble.textContent = data.reply;
+                return data;
+            }
+        }
+    }
+    throw new Error('Connection closed before reply finished');
+}
+
+// 滚动到底部
+function scrollToBottom() {
+    const chatMessages = document.getElementById('chat-messages');
+    if (chatMessages) {
+        chatMessages.scrollTop = chatMessages.scrollHeight;
+    }
+}
+
 // 添加消息到聊天区域
 function addMessage(text, sender, isError = false) {
     const chatMessages = document.getElementById('chat-messages');
@@ -126,10 +188,10 @@ function addMessage(text, sender, isError = false) {
     
     const avatarImg = document.createElement('img');
     if (sender === 'user') {
-        avatarImg.src = '/static/images/avatar/user_avatar.png';
+        avatarImg.src = avatarUrls.user || '/static/images/avatar/user_avatar.png';
         avatarImg.alt = 'User';
     } else {
-        avatarImg.src = `/static/images/avatar/${currentStudentId}.png`;
+        avatarImg.src = avatarUrls.student || `/static/images/avatar/${currentStudentId}.png`;
         avatarImg.alt = currentStudentName;
     }
     
@@ -169,6 +231,8 @@ function addMessage(text, sender, isError = false) {
     
     // 滚动到底部
     chatMessages.scrollTop = chatMessages.scrollHeight;
+    
+    return messageBubble;
 }
 
 // 清空聊天
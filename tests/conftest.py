@@ -0,0 +1,98 @@
+# tests/conftest.py - 导入 app 之前关掉会写项目数据的后台功能（全文索引、归档、GitHub 同步）
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, "bench"))
+
+for key in [key for key in os.environ if key.startswith("GITHUB_")]:
+    del os.environ[key]
+os.environ.setdefault("OPENAI_API_KEY", "test")
+os.environ["SEARCH_ENABLED"] = "false"
+os.environ["ARCHIVE_AFTER_DAYS"] = "0"
+
+import threading
+
+import pytest
+
+import app
+import fake_openai
+
+
+@pytest.fixture(scope="session")
+def fake_server():
+    config = fake_openai.parse_args(["--port", "0", "--latency", "0.05", "--tokens-per-second", "1000",
+                                     "--reply-tokens", "10", "--failing-models", "broken-model"])
+    server = fake_openai.serve(config)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{server.server_address[1]}/v1"
+    server.shutdown()
+
+
+def make_dispatcher(base_url, primary_model="gpt-4o-mini", hedging=False):
+    gateway = app.LLMGateway(max_retries=0)
+    primary = app.ModelRoute("primary", primary_model, base_url=base_url, api_key="test",
+                             breaker=app.CircuitBreaker(min_calls=2, cooldown=0))
+    fallback = app.ModelRoute("fallback", "gpt-4o-mini", base_url=base_url, api_key="test")
+    return app.CompletionDispatcher(gateway, primary, fallback, hedging=hedging)
+
+
+@pytest.fixture
+def dispatcher(fake_server, monkeypatch):
+    # 聊天和批量访谈都改走本地假服务
+    dispatcher = make_dispatcher(fake_server)
+    monkeypatch.setattr(app, "chat_dispatcher", dispatcher)
+    return dispatcher
+
+
+def make_store(directory):
+    return app.JsonlConversationStore(log_dir=str(directory / "conversation_log"),
+                                      legacy_file=str(directory / "conversation_data.json"),
+                                      archive_dir=str(directory / "conversation_archive"))
+
+
+def conversation_record(conv_id, timestamp, student_id="student001", scene_context="", session_id=None):
+    return {"id": conv_id, "timestamp": timestamp, "session_id": session_id or f"s-{timestamp[:10]}",
+            "student_id": student_id, "student_name": app.name_dict.get(student_id, "Unknown"),
+            "user_message": f"message {conv_id}", "ai_response": "ok", "scene_context": scene_context,
+            "response_time_ms": 100, "message_length": 10, "day_of_week": "Monday", "hour": int(timestamp[11:13])}
+
+
+@pytest.fixture
+def monitor(tmp_path, monkeypatch):
+    # 对话写进临时目录，不碰项目里的 conversation_log
+    monitor = app.ConversationMonitor(make_store(tmp_path))
+    monkeypatch.setattr(app, "monitor", monitor)
+    return monitor
+
+
+@pytest.fixture
+def seeded_monitor(tmp_path, monkeypatch):
+    """Build the app's monitor over a temp store that already holds the given conversations."""
+    def build(conversations, hot_limit=20000, archive_before=None, store=None):
+        store = store or make_store(tmp_path)
+        for conv in conversations:
+            store.append(conv)
+        if archive_before:
+            store.roll_archive(archive_before)
+        monkeypatch.setenv("HOT_CONVERSATION_LIMIT", str(hot_limit))
+        monitor = app.ConversationMonitor(store)
+        monkeypatch.setattr(app, "monitor", monitor)
+        return monitor
+    return build
+
+
+@pytest.fixture
+def fresh_limiters(monkeypatch):
+    # 沿用默认配置的限流器，只清空各自的桶
+    monkeypatch.setattr(app.session_limiter, "buckets", app.OrderedDict())
+    monkeypatch.setattr(app.ip_limiter, "buckets", app.OrderedDict())
+
+
+@pytest.fixture
+def admin_client():
+    client = app.app.test_client()
+    with client.session_transaction() as session:
+        session["admin_authenticated"] = True
+    return client
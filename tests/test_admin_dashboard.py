@@ -0,0 +1,65 @@
+import threading
+import time
+
+import app
+
+
+def test_dashboard_page_is_served_with_an_etag(admin_client):
+    response = admin_client.get("/admin")
+    assert response.status_code == 200
+    etag = response.headers["ETag"]
+
+    cached = admin_client.get("/admin", headers={"If-None-Match": etag})
+    assert cached.status_code == 304
+    assert cached.get_data() == b""
+    assert app.app.test_client().get("/admin").status_code == 302
+
+
+def test_analytics_etag_changes_when_a_conversation_is_logged(monitor, admin_client):
+    first = admin_client.get("/admin/api/analytics")
+    assert first.status_code == 200
+    assert first.get_json()["total_conversations"] == 0
+    etag = first.headers["ETag"]
+
+    assert admin_client.get("/admin/api/analytics", headers={"If-None-Match": etag}).status_code == 304
+
+    monitor.log_conversation("student001", "hello", "hi")
+    updated = admin_client.get("/admin/api/analytics", headers={"If-None-Match": etag})
+    assert updated.status_code == 200
+    assert updated.headers["ETag"] != etag
+    assert updated.get_json()["total_conversations"] == 1
+    assert updated.get_json()["version"] == monitor.last_id
+
+
+def test_feed_returns_immediately_when_behind(monitor, admin_client):
+    monitor.log_conversation("student001", "first", "reply")
+    monitor.log_conversation("student002", "second", "reply")
+
+    body = admin_client.get("/admin/api/feed?since=0").get_json()
+    assert body["version"] == monitor.last_id
+    assert [conv["user_message"] for conv in body["conversations"]] == ["first", "second"]
+    assert set(body["conversations"][0]) == set(app.FEED_FIELDS)
+
+
+def test_feed_long_polls_until_a_new_conversation(monitor, admin_client):
+    monitor.log_conversation("student001", "first", "reply")
+    version = monitor.last_id
+    timer = threading.Timer(0.3, monitor.log_conversation, ("student002", "while waiting", "reply"))
+    timer.start()
+
+    started = time.monotonic()
+    body = admin_client.get(f"/admin/api/feed?since={version}&timeout=5").get_json()
+    elapsed = time.monotonic() - started
+    timer.join()
+
+    assert 0.2 < elapsed < 3
+    assert [conv["user_message"] for conv in body["conversations"]] == ["while waiting"]
+    assert body["version"] == version + 1
+
+
+def test_feed_times_out_with_no_new_conversations(monitor, admin_client):
+    started = time.monotonic()
+    body = admin_client.get("/admin/api/feed?since=0&timeout=0.2").get_json()
+    assert time.monotonic() - started >= 0.2
+    assert body == {"version": 0, "conversations": []}
+    assert admin_client.get("/admin/api/feed?since=abc").status_code == 400
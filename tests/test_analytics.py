@@ -0,0 +1,42 @@
+import datetime
+
+import app
+
+
+def log_turns(monitor, turns):
+    for student_id, response_time_ms in turns:
+        monitor.log_conversation(student_id, "hello", "hi there", response_time_ms=response_time_ms,
+                                 extra={'prompt_tokens': 100, 'cached_tokens': 40})
+
+
+def test_incremental_aggregates_match_a_full_rebuild(monitor):
+    log_turns(monitor, [('student001', 100), ('student002', 300), ('student001', 200)])
+
+    snapshot = monitor.get_analytics_dashboard_data()
+    rebuilt = app.ConversationAnalytics()
+    rebuilt.rebuild(monitor.data['conversations'])
+    assert snapshot == rebuilt.snapshot()
+
+    assert snapshot['total_conversations'] == 3
+    assert snapshot['unique_students'] == 2
+    assert snapshot['student_stats']['Jaden'] == {'total_conversations': 2, 'avg_response_time': 150,
+                                                  'total_response_time': 300}
+    assert snapshot['most_active_student'] == 'Jaden'
+    assert snapshot['cache_hit_rate'] == 0.4
+
+
+def test_recent_window_drops_conversations_older_than_a_day():
+    analytics = app.ConversationAnalytics()
+    now = datetime.datetime.now()
+    conversations = [
+        {'student_id': 'student001', 'student_name': 'Jaden', 'hour': 9,
+         'timestamp': (now - datetime.timedelta(hours=hours)).isoformat()}
+        for hours in (30, 2, 1)
+    ]
+    analytics.rebuild(conversations)
+    assert analytics.snapshot()['recent_conversations'] == 2
+
+    # 窗口滑过之后，快照时把过期的时间戳弹出
+    analytics.recent_timestamps[0] -= datetime.timedelta(hours=23)
+    assert analytics.snapshot()['recent_conversations'] == 1
+    assert analytics.snapshot()['total_conversations'] == 3
@@ -0,0 +1,27 @@
+import pytest
+
+import app
+
+
+@pytest.fixture
+def dist(tmp_path, monkeypatch):
+    monkeypatch.setattr(app, 'ASSET_DIST_DIR', str(tmp_path))
+    (tmp_path / 'app.abc123.js').write_text('plain')
+    (tmp_path / 'app.abc123.js.gz').write_bytes(b'gzip')
+    (tmp_path / 'app.abc123.js.br').write_bytes(b'brotli')
+    return tmp_path
+
+
+@pytest.mark.parametrize('accept, expected', [
+    ('gzip, deflate, br', 'br'),
+    ('br;q=0, gzip', 'gzip'),
+    ('gzip;q=1, br;q=0.5', 'gzip'),
+    ('x-gzip', None),
+    ('gzip;q=0, br;q=0', None),
+    ('identity', None),
+])
+def test_asset_encoding_follows_accept_encoding_qualities(dist, accept, expected):
+    response = app.app.test_client().get('/assets/app.abc123.js', headers={'Accept-Encoding': accept})
+    assert response.status_code == 200
+    assert response.headers.get('Content-Encoding') == expected
+    response.close()
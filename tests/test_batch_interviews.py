@@ -0,0 +1,68 @@
+import json
+
+import app
+
+QUESTIONS = ["How was school today?", "Who do you talk to when you're upset?"]
+STUDENTS = ["student001", "student002"]
+SCENES = ["At school"]
+
+
+def make_run(tmp_path, mode="live", run_id="run1"):
+    return app.BatchInterviewRun(run_id, QUESTIONS, STUDENTS, SCENES, mode=mode, workers=2,
+                                 run_dir=str(tmp_path / "batch_runs"))
+
+
+def checkpoint_answers(run, skip=()):
+    with open(run.checkpoint_path, encoding="utf-8") as f:
+        entries = [json.loads(line) for line in f if line.strip() not in skip]
+    return [entry for entry in entries if "answer" in entry]
+
+
+def test_live_run_goes_through_the_chat_dispatcher(tmp_path, dispatcher, monitor):
+    run = make_run(tmp_path)
+    assert run.run() == "completed"
+    assert run.progress()["answered"] == len(STUDENTS) * len(QUESTIONS)
+    logged = monitor.data["conversations"]
+    assert len(logged) == len(STUDENTS) * len(QUESTIONS)
+    assert all(conv["attempts"][0]["route"] == "primary" for conv in logged)
+
+
+def test_live_run_resumes_from_a_truncated_checkpoint(tmp_path, dispatcher, monitor):
+    make_run(tmp_path).run()
+    with open(tmp_path / "batch_runs" / "run1.jsonl", encoding="utf-8") as f:
+        lines = f.readlines()
+    # 只留下配置行和第一条回答，再加上写到一半的一行
+    torn = lines[2][:15]
+    with open(tmp_path / "batch_runs" / "run1.jsonl", "w", encoding="utf-8") as f:
+        f.write(lines[0] + lines[1] + torn)
+    logged_before = len(monitor.data["conversations"])
+
+    run = app.BatchInterviewRun.resume("run1", workers=2, run_dir=str(tmp_path / "batch_runs"))
+    assert run.progress()["answered"] == 1
+    assert run.run() == "completed"
+
+    total = len(STUDENTS) * len(QUESTIONS)
+    assert len(monitor.data["conversations"]) - logged_before == total - 1
+    answers = checkpoint_answers(run, skip={torn.strip()})
+    assert sorted((a["student_id"], a["question_index"]) for a in answers) == sorted(
+        (student_id, index) for student_id in STUDENTS for index in range(len(QUESTIONS)))
+
+
+def test_provider_batch_mode_uses_the_primary_route_endpoint(tmp_path, dispatcher, monitor):
+    run = make_run(tmp_path, mode="batch", run_id="batched")
+    assert run.run(poll_interval=0) == "completed"
+    assert run.progress()["answered"] == len(STUDENTS) * len(QUESTIONS)
+    assert sorted(run.provider_batches) == list(range(len(QUESTIONS)))
+
+    # 已完成的运行恢复后不再提交新的批次
+    resumed = app.BatchInterviewRun.resume("batched", run_dir=str(tmp_path / "batch_runs"))
+    assert resumed.provider_batches == run.provider_batches
+    assert resumed.run(poll_interval=0) == "completed"
+    assert len(checkpoint_answers(resumed)) == len(STUDENTS) * len(QUESTIONS)
+
+
+def test_batch_model_comes_from_the_primary_route(tmp_path, dispatcher, monkeypatch):
+    monkeypatch.setattr(dispatcher.primary, "model", "route-model")
+    run = make_run(tmp_path, mode="batch", run_id="routed")
+    assert run.model == "route-model"
+    assert app.BatchInterviewRun.resume("routed", run_dir=str(tmp_path / "batch_runs")).model == "route-model"
@@ -0,0 +1,85 @@
+import asyncio
+import json
+import threading
+import time
+
+import app
+from conftest import make_dispatcher
+
+
+class StaggeredDispatcher(app.CompletionDispatcher):
+    """Delays the n-th submitted completion by delays[n] and records how many ran at once."""
+
+    def __init__(self, *args, delays=(), **kwargs):
+        super().__init__(*args, **kwargs)
+        self.delays = list(delays)
+        self.submitted = 0
+        self.running = 0
+        self.max_running = 0
+        self.counter_lock = threading.Lock()
+
+    def submit(self, **kwargs):
+        with self.counter_lock:
+            delay = self.delays[self.submitted] if self.submitted < len(self.delays) else 0
+            self.submitted += 1
+
+        async def delayed():
+            with self.counter_lock:
+                self.running += 1
+                self.max_running = max(self.max_running, self.running)
+            try:
+                await asyncio.sleep(delay)
+                return await self._dispatch(kwargs)
+            finally:
+                with self.counter_lock:
+                    self.running -= 1
+        return asyncio.run_coroutine_threadsafe(delayed(), self.gateway.ensure_started())
+
+
+def staggered(fake_server, monkeypatch, delays):
+    base = make_dispatcher(fake_server)
+    dispatcher = StaggeredDispatcher(base.gateway, base.primary, base.fallback, hedging=False, delays=delays)
+    # 先热身一次，建连接的耗时不计入顺序比较
+    dispatcher.complete(messages=[{"role": "user", "content": "hi"}], max_tokens=5)
+    monkeypatch.setattr(app, "chat_dispatcher", dispatcher)
+    return dispatcher
+
+
+def read_events(response):
+    return [json.loads(block[len("data: "):]) for block in response.get_data(as_text=True).split("\n\n") if block]
+
+
+def test_replies_stream_in_completion_order(fake_server, monkeypatch, monitor, fresh_limiters):
+    students = ["student001", "student002", "student003"]
+    staggered(fake_server, monkeypatch, delays=[0.6, 0.3, 0])
+
+    started = time.monotonic()
+    response = app.app.test_client().post("/api/broadcast", json={"student_ids": students, "message": "How are you?"})
+    events = read_events(response)
+    elapsed = time.monotonic() - started
+
+    assert response.mimetype == "text/event-stream"
+    assert [event["student_id"] for event in events[:-1]] == ["student003", "student002", "student001"]
+    assert all(event["success"] and event["reply"] for event in events[:-1])
+    assert events[-1]["done"] is True
+    # 并发执行：总耗时接近最慢的一个，而不是三个相加
+    assert elapsed < 0.6 + 0.3 + 0.5
+    assert sorted(conv["student_id"] for conv in monitor.data["conversations"]) == students
+
+
+def test_broadcast_pool_is_bounded(fake_server, monkeypatch, monitor, fresh_limiters):
+    dispatcher = staggered(fake_server, monkeypatch, delays=[0.1] * 5)
+    monkeypatch.setattr(app, "BROADCAST_CONCURRENCY", 2)
+
+    response = app.app.test_client().post("/api/broadcast", json={"group": "middle_adolescence", "message": "Hi"})
+    events = read_events(response)
+
+    assert len(events) == len(app.group_student_ids("middle_adolescence")) + 1
+    assert dispatcher.max_running == 2
+
+
+def test_broadcast_rejects_unknown_students(monitor, fresh_limiters):
+    client = app.app.test_client()
+    response = client.post("/api/broadcast", json={"student_ids": ["student001", "nobody"], "message": "Hi"})
+    assert response.status_code == 400
+    assert client.post("/api/broadcast", json={"group": "nope", "message": "Hi"}).status_code == 400
@@ -0,0 +1,28 @@
+from werkzeug.test import EnvironBuilder
+
+import app
+
+
+def client_ip_for(monkeypatch, forwarded_for, remote_addr='10.0.0.1'):
+    seen = {}
+
+    def capture(environ, start_response):
+        with app.app.request_context(environ):
+            seen['ip'] = app.client_ip()
+        start_response('204 No Content', [])
+        return []
+
+    # 只替换 ProxyFix 后面的 Flask 应用，让请求照常经过部署时的中间件
+    monkeypatch.setattr(app.app.wsgi_app, 'app', capture)
+    environ = EnvironBuilder(path='/', headers={'X-Forwarded-For': forwarded_for},
+                             environ_base={'REMOTE_ADDR': remote_addr}).get_environ()
+    app.app.wsgi_app(environ, lambda *args: None)
+    return seen['ip']
+
+
+def test_client_ip_ignores_client_supplied_forwarded_hops(monkeypatch):
+    assert client_ip_for(monkeypatch, '1.2.3.4, 203.0.113.7') == '203.0.113.7'
+
+
+def test_client_ip_uses_proxy_appended_hop(monkeypatch):
+    assert client_ip_for(monkeypatch, '203.0.113.7') == '203.0.113.7'
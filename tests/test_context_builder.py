@@ -0,0 +1,33 @@
+import app
+
+
+def make_builder(budget, summary_budget=200):
+    counter = app.TokenCounter.__new__(app.TokenCounter)
+    counter.encoding = None
+    return app.ContextBuilder(counter, budget=budget, summary_budget=summary_budget, excerpt_words=30)
+
+
+def long_turn(i):
+    words = ' '.join(f'w{i}x{j}' for j in range(40))
+    return (f'question {i} {words}', f'answer {i} {words}')
+
+
+def test_context_stays_within_budget_right_after_a_fold():
+    builder = make_builder(budget=400)
+    system = [{"role": "system", "content": "You are a student."}]
+    state = {'history': [], 'summary': '', 'summarized': 0}
+    for i in range(12):
+        messages, stats = builder.build(system, state, f'message {i}')
+        assert stats['context_tokens'] <= builder.budget
+        state['history'].append(long_turn(i))
+    assert state['summarized'] > 0
+
+
+def test_first_fold_rechecks_budget():
+    builder = make_builder(budget=400)
+    system = [{"role": "system", "content": "You are a student."}]
+    state = {'history': [long_turn(i) for i in range(5)], 'summary': '', 'summarized': 0}
+    messages, stats = builder.build(system, state, 'hello')
+    assert state['summarized'] >= 1
+    assert stats['context_tokens'] <= builder.budget
+    assert messages[1]['content'].startswith('Summary of earlier parts')
@@ -0,0 +1,128 @@
+import itertools
+
+import pytest
+
+import app
+from conftest import conversation_record
+
+STUDENTS = ["student001", "student002", "student003"]
+SCENES = ["At school", "At home"]
+FILTERS = [
+    {},
+    {"student_id": "student002"},
+    {"scene": "At home"},
+    {"student_id": "student001", "scene": "At school"},
+    {"start": "2024-01-03", "end": "2024-02-02"},
+    {"student_id": "student003", "start": "2024-02-01"},
+    {"session_id": "s-2024-01-05"},
+]
+
+
+def history():
+    # 跨两个月，每天若干条；同一时间戳出现多次，靠 id 区分先后
+    conversations = []
+    for day in ["2024-01-01", "2024-01-03", "2024-01-05", "2024-02-01", "2024-02-02", "2024-02-04"]:
+        for i in range(7):
+            conv_id = len(conversations) + 1
+            conversations.append(conversation_record(conv_id, f"{day}T10:0{i // 2}:00", STUDENTS[conv_id % 3],
+                                                     SCENES[conv_id % 2]))
+    return conversations
+
+
+def expected_ids(conversations, order, student_id=None, scene=None, session_id=None, start=None, end=None):
+    start, end = app.parse_date_filter(start), app.parse_date_filter(end, end=True)
+    matching = [conv for conv in sorted(conversations, key=app.conversation_key)
+                if (not student_id or conv["student_id"] == student_id)
+                and (not scene or conv["scene_context"] == scene)
+                and (not session_id or conv["session_id"] == session_id)
+                and (not start or conv["timestamp"] >= start)
+                and (not end or conv["timestamp"] < end)]
+    ids = [conv["id"] for conv in matching]
+    return ids[::-1] if order == "desc" else ids
+
+
+def fetch_all(client, limit, **params):
+    ids, cursor, pages = [], None, 0
+    while True:
+        query = dict(params, limit=limit, **({"cursor": cursor} if cursor else {}))
+        response = client.get("/admin/api/conversations", query_string=query)
+        assert response.status_code == 200, response.get_json()
+        body = response.get_json()
+        assert body["count"] <= limit
+        ids += [conv["id"] for conv in body["conversations"]]
+        pages += 1
+        cursor = body["next_cursor"]
+        if not cursor:
+            return ids, pages
+
+
+@pytest.mark.parametrize("order, filters", list(itertools.product(["desc", "asc"], FILTERS)))
+def test_cursor_pages_match_a_full_scan(seeded_monitor, admin_client, order, filters):
+    conversations = history()
+    seeded_monitor(conversations)
+    ids, _ = fetch_all(admin_client, 4, order=order, **filters)
+    assert ids == expected_ids(conversations, order, **filters)
+
+
+def test_conversations_logged_between_pages_do_not_shift_the_cursor(seeded_monitor, admin_client):
+    conversations = history()
+    monitor = seeded_monitor(conversations)
+    first = admin_client.get("/admin/api/conversations", query_string={"limit": 5}).get_json()
+    monitor.log_conversation("student001", "new message", "reply")
+
+    rest, _ = fetch_all(admin_client, 5, cursor=first["next_cursor"])
+    assert [conv["id"] for conv in first["conversations"]] + rest == expected_ids(conversations, "desc")
+
+    # 新记录出现在下一次从头开始的查询里，并进入该学生的索引
+    newest = admin_client.get("/admin/api/conversations", query_string={"limit": 1, "student_id": "student001"})
+    assert newest.get_json()["conversations"][0]["user_message"] == "new message"
+
+
+def test_query_rejects_bad_parameters(seeded_monitor, admin_client):
+    seeded_monitor(history())
+    assert admin_client.get("/admin/api/conversations?cursor=not-a-cursor").status_code == 400
+    assert admin_client.get("/admin/api/conversations?order=sideways").status_code == 400
+    assert admin_client.get("/admin/api/conversations?start=last-week").status_code == 400
+    assert app.app.test_client().get("/admin/api/conversations").status_code == 401
+
+
+@pytest.mark.parametrize("backend", ["jsonl", "sqlite"])
+@pytest.mark.parametrize("hot_limit", [5, 17])
+@pytest.mark.parametrize("order", ["desc", "asc"])
+def test_hot_and_cold_tiers_merge_into_one_ordering(tmp_path, seeded_monitor, admin_client, backend, hot_limit, order):
+    conversations = history()
+    store = None
+    if backend == "sqlite":
+        store = app.SqliteConversationStore(str(tmp_path / "conversations.db"), log_dir=str(tmp_path / "log"),
+                                            legacy_file=str(tmp_path / "conversation_data.json"))
+    monitor = seeded_monitor(conversations, hot_limit=hot_limit, store=store,
+                             archive_before="2024-02-02" if backend == "jsonl" else None)
+    assert len(monitor.data["conversations"]) == hot_limit
+    assert monitor.cold_before == app.conversation_key(conversations[-hot_limit])
+
+    for filters in FILTERS:
+        # 页大小 4 让翻页正好跨过冷热边界
+        ids, _ = fetch_all(admin_client, 4, order=order, **filters)
+        assert ids == expected_ids(conversations, order, **filters), filters
+
+
+def test_export_covers_the_cold_tier(seeded_monitor):
+    conversations = history()
+    monitor = seeded_monitor(conversations, hot_limit=3, archive_before="2024-02-01")
+    assert [conv["id"] for conv in monitor.iter_conversations(page_size=10)] == expected_ids(conversations, "asc")
+    assert monitor.get_analytics_dashboard_data()["total_conversations"] == len(conversations)
+
+
+def test_eviction_moves_the_cold_boundary(seeded_monitor, admin_client):
+    conversations = history()[:10]
+    monitor = seeded_monitor(conversations, hot_limit=10)
+    assert monitor.cold_before is None
+    # 超出上限 10% 才批量淘汰，这里第二条新记录触发
+    monitor.log_conversation("student001", "new message", "reply")
+    assert monitor.cold_before is None
+    monitor.log_conversation("student001", "another message", "reply")
+    assert len(monitor.data["conversations"]) == 10
+    assert monitor.cold_before == app.conversation_key(conversations[2])
+
+    ids, _ = fetch_all(admin_client, 3, order="asc")
+    assert ids[:10] == expected_ids(conversations, "asc") and len(ids) == 12
@@ -0,0 +1,83 @@
+import json
+import os
+
+import app
+from conftest import conversation_record, make_store
+
+
+def legacy_conversations():
+    return [
+        {'timestamp': f'2024-03-0{day}T10:0{i}:00', 'student_id': 'student001',
+         'user_message': f'day {day} message {i}', 'bot_response': 'ok'}
+        for day in (1, 2) for i in range(3)
+    ]
+
+
+def test_interrupted_legacy_migration_resumes_without_duplicates(tmp_path):
+    legacy_file = tmp_path / 'conversation_data.json'
+    legacy_file.write_text(json.dumps({'conversations': legacy_conversations()}), encoding='utf-8')
+    store = app.JsonlConversationStore(log_dir=str(tmp_path / 'log'), legacy_file=str(legacy_file),
+                                       archive_dir=str(tmp_path / 'archive'))
+
+    # 模拟上次迁移写到第一天一半时进程退出：一条完整记录加半行
+    os.makedirs(store.log_dir)
+    first_day = [json.dumps(conv, ensure_ascii=False) for conv in legacy_conversations()[:2]]
+    with open(store.segment_path('2024-03-01'), 'w', encoding='utf-8') as f:
+        f.write(first_day[0] + '\n' + first_day[1][:20])
+
+    conversations = store.load()
+
+    assert [conv['user_message'] for conv in conversations] == [conv['user_message'] for conv in legacy_conversations()]
+    assert not legacy_file.exists()
+    assert (tmp_path / 'conversation_data.json.migrated').exists()
+    assert store.migrate_legacy_file() is False
+
+
+def write_history(store, days, per_day=3):
+    conversations = []
+    for day in days:
+        for i in range(per_day):
+            conv = conversation_record(len(conversations) + 1, f'{day}T09:0{i}:00')
+            store.append(conv)
+            conversations.append(conv)
+    return conversations
+
+
+def test_load_recent_fills_the_hot_tier_from_archives(tmp_path):
+    store = make_store(tmp_path)
+    history = write_history(store, ['2024-01-30', '2024-02-01', '2024-02-02', '2024-03-05'])
+    store.roll_archive('2024-03-01')
+    assert [os.path.basename(path) for path in store.files()] == ['2024-03-05.jsonl']
+
+    recent, has_older = store.load_recent(7)
+    assert recent == history[-7:]
+    assert has_older
+
+    recent, has_older = store.load_recent(100)
+    assert recent == history
+    assert not has_older
+
+
+def test_restart_after_archiving_keeps_a_hot_tier(tmp_path, monkeypatch):
+    store = make_store(tmp_path)
+    history = write_history(store, ['2024-01-30', '2024-02-01', '2024-02-02'])
+    store.roll_archive('2024-03-01')
+    monkeypatch.setenv('HOT_CONVERSATION_LIMIT', '4')
+
+    monitor = app.ConversationMonitor(store)
+
+    assert monitor.data['conversations'] == history[-4:]
+    assert monitor.cold_before == app.conversation_key(history[-4])
+    page, cursor = monitor.query_conversations(limit=3)
+    assert [conv['id'] for conv in page] == [9, 8, 7] and cursor
+
+
+def test_month_cache_is_bounded_by_record_count(tmp_path):
+    store = make_store(tmp_path)
+    store.cache_records = 5
+    history = write_history(store, ['2024-01-01', '2024-02-01', '2024-03-01', '2024-03-02'])
+
+    assert list(store.iter_range()) == history
+    # 一月、二月各 3 条，三月 6 条超过上限不缓存；上限 5 条时只剩最近读过的二月
+    assert store.cached_records == sum(len(entry[1]) for entry in store.segment_cache.values()) == 3
+    assert [key[0] for key in store.segment_cache] == ['2024-02']
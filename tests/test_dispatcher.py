@@ -0,0 +1,66 @@
+import pytest
+
+import app
+from conftest import make_dispatcher
+
+
+MESSAGES = [{"role": "user", "content": "hi"}]
+
+
+def open_breaker(breaker):
+    breaker.record(False)
+    breaker.record(False)
+    assert breaker.state == "open"
+
+
+def test_cancelled_stream_trial_does_not_wedge_breaker(fake_server):
+    dispatcher = make_dispatcher(fake_server)
+    breaker = dispatcher.primary.breaker
+    open_breaker(breaker)
+
+    # 冷却已过：这次流式调用就是试探请求，拿到第一个块后客户端断开
+    attempts = []
+    stream = dispatcher.stream(attempts, messages=MESSAGES, max_tokens=10)
+    next(stream)
+    stream.close()
+    assert attempts[0]["route"] == "primary"
+    assert attempts[0]["outcome"] == "cancelled"
+    assert breaker.state == "open"
+
+    # 下一次调用重新试探主路由，成功后熔断关闭
+    _, attempts = dispatcher.complete(messages=MESSAGES, max_tokens=10)
+    assert [attempt["route"] for attempt in attempts] == ["primary"]
+    assert breaker.state == "closed"
+
+
+def test_failed_trial_reopens_breaker(fake_server):
+    dispatcher = make_dispatcher(fake_server, primary_model="broken-model")
+    breaker = dispatcher.primary.breaker
+    open_breaker(breaker)
+
+    _, attempts = dispatcher.complete(messages=MESSAGES, max_tokens=10)
+    assert [(attempt["route"], attempt["outcome"]) for attempt in attempts] == [("primary", "error"), ("fallback", "ok")]
+    assert breaker.state == "open"
+
+
+def test_local_rejections_do_not_open_breaker(fake_server):
+    dispatcher = make_dispatcher(fake_server)
+    gateway = dispatcher.gateway
+    gateway.ensure_started()
+    # 模拟本地并发和队列都已占满
+    gateway.in_flight, gateway.waiting = gateway.max_concurrency, gateway.max_queue
+    try:
+        for _ in range(5):
+            with pytest.raises(app.AdmissionRejected):
+                dispatcher.complete(messages=MESSAGES, max_tokens=10)
+    finally:
+        gateway.in_flight = gateway.waiting = 0
+    assert dispatcher.primary.breaker.state == "closed"
+
+    _, attempts = dispatcher.complete(messages=MESSAGES, max_tokens=10)
+    assert attempts[0]["outcome"] == "ok"
+
+
+def test_failover_worthy_only_for_provider_side_errors():
+    assert not app.failover_worthy(app.AdmissionRejected("busy", 1))
+    assert not app.failover_worthy(ValueError("bad"))
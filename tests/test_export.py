@@ -0,0 +1,54 @@
+import csv
+import io
+
+import pyarrow.parquet as pq
+
+import app
+from conftest import conversation_record
+
+
+def history():
+    return [
+        conversation_record(1, "2024-01-01T09:00:00", "student001", "At school"),
+        conversation_record(2, "2024-01-02T10:00:00", "student002", "At home"),
+        conversation_record(3, "2024-01-03T11:00:00", "student001", "At home"),
+        conversation_record(4, "2024-01-04T12:00:00", "student001", "At school"),
+    ]
+
+
+def csv_ids(response):
+    return [int(row["id"]) for row in csv.DictReader(io.StringIO(response.get_data(as_text=True)))]
+
+
+def test_csv_export_streams_in_chunks(seeded_monitor):
+    monitor = seeded_monitor(history())
+    chunks = list(monitor.iter_csv_export(chunk_rows=1))
+    # 表头跟第一行一起发出，之后每行一块
+    assert [len(chunk.splitlines()) for chunk in chunks] == [2, 1, 1, 1, 0]
+    assert "".join(chunks).splitlines()[0] == ",".join(app.EXPORT_FIELDS)
+
+
+def test_csv_export_applies_filters(seeded_monitor, admin_client):
+    seeded_monitor(history())
+    response = admin_client.get("/admin/export/csv")
+    assert response.is_streamed
+    assert csv_ids(response) == [1, 2, 3, 4]
+    assert csv_ids(admin_client.get("/admin/export/csv?student_id=student001&scene=At+school")) == [1, 4]
+    assert csv_ids(admin_client.get("/admin/export/csv?start=2024-01-02&end=2024-01-03")) == [2, 3]
+    assert admin_client.get("/admin/export/csv?start=yesterday").status_code == 400
+
+
+def test_parquet_export_writes_the_filtered_rows(seeded_monitor, admin_client):
+    seeded_monitor(history())
+    response = admin_client.get("/admin/export/parquet?student_id=student001")
+    assert response.status_code == 200
+    table = pq.read_table(io.BytesIO(response.get_data()))
+    assert table.column("id").to_pylist() == [1, 3, 4]
+    assert table.column("scene_context").to_pylist() == ["At school", "At home", "At school"]
+
+
+def test_exports_require_admin(seeded_monitor):
+    seeded_monitor(history())
+    client = app.app.test_client()
+    assert client.get("/admin/export/csv").status_code == 302
+    assert client.get("/admin/export/parquet").status_code == 302
@@ -0,0 +1,25 @@
+import app
+
+
+def failing_worker(monkeypatch, max_retries=3):
+    sleeps, uploads = [], []
+    monkeypatch.setattr(app.time, 'sleep', sleeps.append)
+    worker = app.GitHubSyncWorker(lambda path: uploads.append(path) and False, max_retries=max_retries)
+    return worker, sleeps, uploads
+
+
+def test_no_backoff_after_the_final_attempt(monkeypatch, capsys):
+    worker, sleeps, uploads = failing_worker(monkeypatch)
+    assert worker.upload_with_retry('conversation_log/2024-01-01.jsonl') is False
+    assert len(uploads) == 3
+    assert len(sleeps) == 2
+    assert 'after 3 attempts' in capsys.readouterr().out
+
+
+def test_shutdown_retries_once_without_sleeping(monkeypatch, capsys):
+    worker, sleeps, uploads = failing_worker(monkeypatch, max_retries=5)
+    worker.stopping = True
+    assert worker.upload_with_retry('conversation_log/2024-01-01.jsonl') is False
+    assert len(uploads) == 2
+    assert sleeps == []
+    assert 'after 2 attempts' in capsys.readouterr().out
@@ -0,0 +1,37 @@
+import pytest
+
+import app
+
+
+def test_acquire_charges_the_full_cost():
+    limiter = app.TokenBucketLimiter(rate=0.01, burst=5)
+    assert limiter.acquire('a', 3) == 0
+    assert limiter.acquire('a', 3) > 0
+    assert limiter.acquire('a', 2) == 0
+    assert limiter.acquire('a') > 0
+
+
+def test_cost_above_burst_is_admitted_from_a_full_bucket_and_leaves_debt():
+    limiter = app.TokenBucketLimiter(rate=1, burst=5)
+    assert limiter.acquire('a', 10) == 0
+    assert limiter.acquire('a') == pytest.approx(6, abs=0.1)
+
+
+def test_default_config_group_broadcast_after_normal_chats(fresh_limiters):
+    group = app.group_student_ids('middle_adolescence')
+    with app.app.test_request_context('/', environ_base={'REMOTE_ADDR': '10.0.0.9'}):
+        app.admit_chat_request('sid')
+        app.admit_chat_request('sid')
+        app.admit_chat_request('sid', len(group))
+        app.admit_chat_request('sid', len(app.name_dict))
+        # 广播之后这个会话还能正常继续聊天
+        app.admit_chat_request('sid')
+
+
+def test_broadcast_charges_the_ip_bucket_per_completion(fresh_limiters):
+    with app.app.test_request_context('/', environ_base={'REMOTE_ADDR': '10.0.0.9'}):
+        app.admit_chat_request('sid', 10)
+    tokens, _ = app.ip_limiter.buckets['10.0.0.9']
+    assert tokens == pytest.approx(app.ip_limiter.burst - 10, abs=0.5)
+    tokens, _ = app.session_limiter.buckets['sid']
+    assert tokens == pytest.approx(app.session_limiter.burst - 1, abs=0.5)
@@ -0,0 +1,82 @@
+import json
+import os
+import time
+
+import pytest
+
+import app
+
+
+def timing_names(response):
+    headers = response.headers.getlist("Server-Timing")
+    return [entry.split(";")[0].strip() for header in headers for entry in header.split(",")]
+
+
+def chat(client):
+    return client.post("/api/send_message", json={"student_id": "student001", "message": "How was your day?"})
+
+
+def chat_profiles(client):
+    return [name for name in client.get("/admin/api/profiling").get_json()["profiles"] if "-send_message-" in name]
+
+
+@pytest.fixture
+def slow_log(tmp_path, monkeypatch):
+    path = tmp_path / "slow_requests.jsonl"
+    monkeypatch.setattr(app, "SLOW_REQUEST_LOG", str(path))
+    monkeypatch.setattr(app, "SLOW_REQUEST_MS", 0)
+    return path
+
+
+@pytest.fixture
+def profiler(tmp_path, monkeypatch):
+    profile_dir = tmp_path / "profiles"
+    profiler = app.SamplingProfiler(str(profile_dir), interval=0.001, check_interval=0)
+    monkeypatch.setattr(app, "profiler", profiler)
+    monkeypatch.setattr(app, "PROFILE_DIR", str(profile_dir))
+    yield profiler
+    profiler.enabled = False
+
+
+def test_chat_response_carries_a_server_timing_breakdown(dispatcher, monitor, fresh_limiters):
+    response = chat(app.app.test_client())
+    assert response.status_code == 200
+    names = timing_names(response)
+    for stage in ("session_open", "admission", "prompt", "openai", "save_data_to_file", "app", "session_save"):
+        assert stage in names
+    assert "metrics_endpoint" not in names
+    assert not app.app.test_client().get("/metrics").headers.getlist("Server-Timing")
+
+
+def test_slow_requests_are_logged_with_their_spans(dispatcher, monitor, fresh_limiters, slow_log):
+    chat(app.app.test_client())
+    entries = [json.loads(line) for line in slow_log.read_text().splitlines()]
+    entry = next(entry for entry in entries if entry["endpoint"] == "send_message")
+    assert entry["status"] == 200
+    assert entry["spans_ms"]["openai"] > 0
+    assert entry["duration_ms"] >= entry["spans_ms"]["openai"]
+    assert entry["profile"] is None
+
+
+def test_admin_flag_turns_profiling_on_and_off(dispatcher, monitor, fresh_limiters, slow_log, profiler,
+                                               admin_client):
+    assert admin_client.get("/admin/api/profiling").get_json()["enabled"] is False
+    assert admin_client.post("/admin/api/profiling", json={"enabled": "yes"}).status_code == 400
+
+    assert admin_client.post("/admin/api/profiling", json={"enabled": True}).get_json()["enabled"] is True
+    assert os.path.exists(profiler.flag_path())
+    chat(app.app.test_client())
+
+    # 阈值为 0 时每个请求都算慢请求，只看聊天请求留下的剖析
+    profiles = chat_profiles(admin_client)
+    assert len(profiles) == 1
+    folded = admin_client.get(f"/admin/api/profiling/{profiles[0]}").get_data(as_text=True)
+    assert "send_message" in folded
+    assert admin_client.get("/admin/api/profiling/..%2Fapp.py").status_code == 404
+
+    assert admin_client.post("/admin/api/profiling", json={"enabled": False}).get_json()["enabled"] is False
+    assert not os.path.exists(profiler.flag_path())
+    time.sleep(0.05)
+    assert not profiler.sampler.is_alive()
+    chat(app.app.test_client())
+    assert chat_profiles(admin_client) == profiles
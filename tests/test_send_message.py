@@ -0,0 +1,8 @@
+import app
+
+
+def test_unknown_student_id_is_rejected_before_metrics():
+    client = app.app.test_client()
+    response = client.post('/api/send_message', json={'student_id': 'attacker-123', 'message': 'hi'})
+    assert response.status_code == 400
+    assert 'attacker-123' not in app.metrics.render()